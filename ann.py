@@ -0,0 +1,154 @@
+"""
+Approximate nearest-neighbour indexes for the NumPy vector store.
+
+Both indexes are built offline from the stored embeddings (build_index.py --ann)
+and act as candidate generators: they return row numbers for each query, and the
+store scores those rows exactly (or with its compressed codes, then re-ranks).
+
+- IVFIndex:  k-means coarse quantizer with inverted lists; `nprobe` lists are
+             scanned per query.
+- HNSWIndex: hnswlib graph (optional dependency) with configurable M and
+             ef_construction; `ef_search` is set per query.
+
+Rows appended after the index was built are not in it; the store scans that
+tail exactly until the index is rebuilt.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+from quantization import kmeans, assign_to_centroids
+from vector_store import top_k
+from config import *
+
+
+class IVFIndex:
+    """Inverted-file index: rows grouped by their nearest k-means centroid."""
+
+    kind = "ivf"
+    data_file = "ivf.npz"
+
+    def __init__(self, centroids, list_offsets, list_rows, built_rows, nprobe=IVF_NPROBE):
+        self.centroids = centroids
+        self.list_offsets = list_offsets  # list i holds list_rows[list_offsets[i]:list_offsets[i + 1]]
+        self.list_rows = list_rows
+        self.built_rows = built_rows
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, vectors, live, nlist=IVF_NLIST, train_size=QUANTIZATION_TRAIN_SIZE, block_rows=65536):
+        live_rows = np.flatnonzero(live)
+        if nlist <= 0:
+            nlist = max(1, int(4 * np.sqrt(len(live_rows))))
+        sample = np.random.default_rng(0).choice(live_rows, size=min(train_size, len(live_rows)), replace=False)
+        centroids, _ = kmeans(np.asarray(vectors[np.sort(sample)], dtype=np.float32), nlist)
+
+        assignments = np.empty(len(live_rows), dtype=np.int64)
+        for start in range(0, len(live_rows), block_rows):
+            rows = live_rows[start:start + block_rows]
+            assignments[start:start + block_rows] = assign_to_centroids(np.asarray(vectors[rows], dtype=np.float32), centroids)
+
+        order = np.argsort(assignments, kind="stable")
+        list_offsets = np.searchsorted(assignments[order], np.arange(len(centroids) + 1))
+        return cls(centroids, list_offsets, live_rows[order], built_rows=len(vectors))
+
+    def candidates(self, queries, k, nprobe=None, ef_search=None):
+        """Rows of the `nprobe` closest inverted lists for each query."""
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = top_k(queries @ self.centroids.T, nprobe)
+        return [np.concatenate([self.list_rows[self.list_offsets[l]:self.list_offsets[l + 1]] for l in lists])
+                for lists in probes]
+
+    def save(self, directory):
+        np.savez(os.path.join(directory, self.data_file), centroids=self.centroids,
+                 list_offsets=self.list_offsets, list_rows=self.list_rows)
+        return {"nlist": len(self.centroids)}
+
+    @classmethod
+    def load(cls, directory, meta):
+        with np.load(os.path.join(directory, cls.data_file)) as data:
+            return cls(data["centroids"], data["list_offsets"], data["list_rows"], meta["built_rows"])
+
+
+class HNSWIndex:
+    """Hierarchical navigable small-world graph backed by hnswlib (inner-product space)."""
+
+    kind = "hnsw"
+    data_file = "hnsw.bin"
+
+    def __init__(self, index, built_rows, ef_search=HNSW_SEARCH_EF):
+        self.index = index
+        self.built_rows = built_rows
+        self.ef_search = ef_search
+        self._lock = threading.Lock()  # hnswlib's ef is index-wide state
+
+    @staticmethod
+    def _hnswlib():
+        try:
+            import hnswlib
+        except ImportError:
+            raise ImportError("HNSW indexes need the optional hnswlib package: pip install hnswlib")
+        return hnswlib
+
+    @classmethod
+    def build(cls, vectors, live, m=HNSW_M, ef_construction=HNSW_CONSTRUCTION_EF, block_rows=65536):
+        hnswlib = cls._hnswlib()
+        live_rows = np.flatnonzero(live)
+        index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+        index.init_index(max_elements=max(len(live_rows), 1), M=m, ef_construction=ef_construction)
+        for start in range(0, len(live_rows), block_rows):
+            rows = live_rows[start:start + block_rows]
+            index.add_items(np.asarray(vectors[rows], dtype=np.float32), rows)
+        return cls(index, built_rows=len(vectors))
+
+    def candidates(self, queries, k, nprobe=None, ef_search=None):
+        """The graph's `max(k, ef_search)` nearest rows for each query."""
+        ef = max(ef_search or self.ef_search, k)
+        n = min(ef, self.index.get_current_count())
+        if n == 0:
+            return [np.empty(0, dtype=np.int64) for _ in queries]
+        with self._lock:
+            self.index.set_ef(ef)
+            labels, _ = self.index.knn_query(queries, k=n)
+        return [row_labels.astype(np.int64) for row_labels in labels]
+
+    def save(self, directory):
+        self.index.save_index(os.path.join(directory, self.data_file))
+        return {"dim": self.index.dim, "elements": self.index.get_current_count()}
+
+    @classmethod
+    def load(cls, directory, meta):
+        index = cls._hnswlib().Index(space='ip', dim=meta["dim"])
+        index.load_index(os.path.join(directory, cls.data_file), max_elements=max(meta["elements"], 1))
+        return cls(index, meta["built_rows"])
+
+
+ANN_INDEXES = {index.kind: index for index in (IVFIndex, HNSWIndex)}
+ANN_META_FILE = "ann.json"
+
+
+def save_ann(index, directory):
+    """Write an ANN index and its ann.json descriptor into a NumPy store directory."""
+    meta = index.save(directory)
+    meta.update(kind=index.kind, built_rows=int(index.built_rows))
+    with open(os.path.join(directory, ANN_META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+def load_ann(directory):
+    """Load the ANN index of a NumPy store directory, or None if it has none."""
+    path = os.path.join(directory, ANN_META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        meta = json.load(f)
+    return ANN_INDEXES[meta["kind"]].load(directory, meta)
+
+
+def remove_ann(directory):
+    """Delete a NumPy store's ANN index files."""
+    for name in [ANN_META_FILE] + [index.data_file for index in ANN_INDEXES.values()]:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,213 @@
+"""
+Streaming access to COCO annotation files.
+
+`json.load` on captions_train2017.json (or a large instances file) holds the whole
+document in memory before a single caption is used. Here the file is read in
+fixed-size chunks and the elements of its top-level arrays are decoded one at a
+time (iter_json_arrays), so memory stays bounded by the largest single element.
+
+AnnotationCache turns a captions file into a SQLite table in one such pass, indexed
+by image. Ingestion and evaluation then stream captions grouped by image, look up
+single images and draw samples from SQLite; the JSON is only read again when its
+size or modification time changes.
+"""
+
+import os
+import re
+import json
+import sqlite3
+from itertools import groupby
+from config import *
+
+_WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+class _JsonStream:
+    """Chunked reader over a JSON text that decodes one value at a time."""
+
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        """Append the next chunk (dropping consumed text); False at end of file."""
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Next non-whitespace character ('' at end of file)."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ""
+
+    def expect(self, chars):
+        """Consume one of `chars` and return it."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed JSON: expected one of {chars!r}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that ends the buffer may continue in the next chunk
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_arrays(path, keys=None):
+    """
+    Yield (key, element) for every element of the top-level arrays of a JSON object
+    file (only the arrays named in `keys`, if given), decoding one element at a time.
+    Other top-level values are skipped.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        stream = _JsonStream(f)
+        stream.expect("{")
+        if stream.peek() == "}":
+            return
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if stream.peek() == "[":
+                stream.expect("[")
+                if stream.peek() == "]":
+                    stream.expect("]")
+                else:
+                    while True:
+                        element = stream.value()
+                        if keys is None or key in keys:
+                            yield key, element
+                        if stream.expect(",]") == "]":
+                            break
+            else:
+                stream.value()
+            if stream.expect(",}") == "}":
+                return
+
+
+class AnnotationCache:
+    """
+    Captions of a COCO captions file, cached in SQLite and grouped by image.
+    The cache is (re)built with one streaming pass whenever the JSON file is new or
+    its size or mtime changed; captions keep their order within the file.
+    """
+
+    def __init__(self, path=DATASET_PATH, cache_dir=ANNOTATION_CACHE_DIR):
+        self.path = path
+        self.cache_path = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}.sqlite3")
+        stat = os.stat(path)
+        self.source = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if self._cached_source() != self.source:
+            self._build()
+        self._conn = sqlite3.connect(self.cache_path)
+
+    def _cached_source(self):
+        if not os.path.exists(self.cache_path):
+            return None
+        try:
+            conn = sqlite3.connect(self.cache_path)
+            try:
+                return conn.execute("SELECT source FROM cache_source").fetchone()[0]
+            finally:
+                conn.close()
+        except (sqlite3.Error, TypeError):
+            return None  # Unreadable or half-written cache: rebuild it
+
+    def _build(self):
+        print(f"📚 Caching annotations of {self.path} in {self.cache_path}...")
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        tmp_path = f"{self.cache_path}.tmp-{os.getpid()}"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        conn = sqlite3.connect(tmp_path)
+        try:
+            conn.execute("PRAGMA journal_mode = OFF")
+            conn.execute("PRAGMA synchronous = OFF")
+            with conn:
+                conn.execute(
+                    "CREATE TABLE annotations (position INTEGER PRIMARY KEY, image_id INTEGER NOT NULL, "
+                    "annotation_id INTEGER, caption TEXT NOT NULL)"
+                )
+                rows = ((position, item['image_id'], item['id'], item['caption'])
+                        for position, (_, item) in enumerate(iter_json_arrays(self.path, ("annotations",))))
+                conn.executemany("INSERT INTO annotations VALUES (?, ?, ?, ?)", rows)
+                conn.execute("CREATE INDEX annotations_image_id ON annotations(image_id, position)")
+                conn.execute("CREATE TABLE cache_source (source TEXT)")
+                conn.execute("INSERT INTO cache_source VALUES (?)", (self.source,))
+        finally:
+            conn.close()
+        os.replace(tmp_path, self.cache_path)
+
+    def annotation_count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM annotations").fetchone()[0]
+
+    def image_count(self):
+        return self._conn.execute("SELECT COUNT(DISTINCT image_id) FROM annotations").fetchone()[0]
+
+    def __contains__(self, image_id):
+        return self._conn.execute("SELECT 1 FROM annotations WHERE image_id = ? LIMIT 1", (int(image_id),)).fetchone() is not None
+
+    def image_ids(self):
+        """Annotated image ids, ascending."""
+        return (row[0] for row in self._conn.execute("SELECT DISTINCT image_id FROM annotations ORDER BY image_id"))
+
+    def iter_images(self):
+        """Yield (image_id, [(annotation_id, caption), ...]) per image, ascending by image id."""
+        rows = self._conn.execute("SELECT image_id, annotation_id, caption FROM annotations ORDER BY image_id, position")
+        for image_id, group in groupby(rows, key=lambda row: row[0]):
+            yield image_id, [(annotation_id, caption) for _, annotation_id, caption in group]
+
+    def captions_for(self, image_ids):
+        """{image_id: [(annotation_id, caption), ...]} for the given images."""
+        image_ids = [int(image_id) for image_id in image_ids]
+        result = {image_id: [] for image_id in image_ids}
+        for start in range(0, len(image_ids), 500):
+            chunk = image_ids[start:start + 500]
+            rows = self._conn.execute(
+                f"SELECT image_id, annotation_id, caption FROM annotations WHERE image_id IN ({','.join('?' * len(chunk))}) "
+                "ORDER BY image_id, position", chunk
+            )
+            for image_id, annotation_id, caption in rows:
+                result[image_id].append((annotation_id, caption))
+        return result
+
+    def annotations(self, positions=None):
+        """[(image_id, caption), ...] in file order: all annotations, or those at the given sorted positions."""
+        if positions is None:
+            return self._conn.execute("SELECT image_id, caption FROM annotations ORDER BY position").fetchall()
+        rows = []
+        for start in range(0, len(positions), 500):
+            chunk = [int(position) for position in positions[start:start + 500]]
+            rows.extend(self._conn.execute(
+                f"SELECT image_id, caption FROM annotations WHERE position IN ({','.join('?' * len(chunk))}) "
+                "ORDER BY position", chunk
+            ))
+        return rows
+
+    def close(self):
+        self._conn.close()
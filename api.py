@@ -1,15 +1,30 @@
-import torch
-import chromadb
-from transformers import CLIPProcessor, CLIPModel
-from fastapi import FastAPI, Query
+import io
+import json
+import time
+import asyncio
+import hashlib
+from collections import namedtuple
+from fastapi import FastAPI, Query, File, UploadFile, Request
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse
+from pydantic import BaseModel, Field
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 import os
+import numpy as np
+from typing import List, Optional
+from PIL import Image
+import runtime
+import metrics
+from metrics import span
+from batching import MicroBatcher
+from cache import LRUCache, IndexVersion, normalize_query
+from thumbnails import is_digest, media_type
+from captions import SearchFilter
+from text_encoder import expand_query, ensemble_embedding
+from rerank import rerank_hits
 from config import *
 
-# --- Configuration ---
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
 # --- Initialize FastAPI App ---
 app = FastAPI()
 
@@ -25,103 +40,622 @@ app.add_middleware(
 # --- Serve Static Files ---
 app.mount("/data", StaticFiles(directory="data"), name="data")
 
-# --- Load CLIP Model (run once at startup) ---
-print("Loading CLIP model for API...")
-model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-print("CLIP model loaded.")
-
-# --- Initialize ChromaDB Client ---
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-try:
-    collection = client.get_collection(name=COLLECTION_NAME)
-    doc_count = collection.count()
-    print(f"✅ Connected to ChromaDB collection '{COLLECTION_NAME}' with {doc_count} items.")
-    if doc_count == 0:
-        print("⚠️  WARNING: Collection is empty! Run ingest_data.py first.")
-except Exception as e:
-    print(f"❌ ERROR: Could not connect to collection '{COLLECTION_NAME}': {e}")
-    print("   Make sure to run ingest_data.py first to create the database.")
-    collection = None
+# --- Model and Vector Store (shared runtime, loaded lazily or by the startup warm-up) ---
+def get_store():
+    """The shared vector store, or None if it does not exist yet (run ingest_data.py first)."""
+    try:
+        return runtime.get_store()
+    except Exception:
+        return None
+
+
+def warmup():
+    """Open the vector store and load the CLIP model before the first request arrives."""
+    try:
+        store = runtime.get_store()
+        doc_count = store.count()
+        print(f"✅ Connected to {store.name} vector store '{COLLECTION_NAME}' with {doc_count} images.")
+        if doc_count == 0:
+            print("⚠️  WARNING: Vector store is empty! Run ingest_data.py first.")
+    except Exception as e:
+        print(f"❌ ERROR: Could not open {VECTOR_STORE} vector store '{COLLECTION_NAME}': {e}")
+        print("   Make sure to run ingest_data.py first to create the database.")
+    runtime.warmup(store=False)
+
+# --- Query Caches ---
+# Level 1: normalized query text (or ("ensemble", text)) -> embedding (independent of the collection)
+# Level 2: (query, k, nprobe, ef_search, mode, filters, ensemble, mmr_lambda, index version) -> final results
+# Cursors: token of (search request, index version) -> its SEARCH_PAGE_DEPTH-deep Ranking, paged without re-querying
+embedding_cache = LRUCache(EMBEDDING_CACHE_SIZE)
+result_cache = LRUCache(RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+ranking_cache = LRUCache(RANKING_CACHE_SIZE, ttl=RANKING_CACHE_TTL)
+index_version = IndexVersion(INDEX_VERSION_PATH)
+loaded_version = index_version.current()
+
+REQUEST_SECONDS = metrics.Histogram("http_request_duration_seconds", "End-to-end request latency per route.", label="route")
+MODEL_BATCH_SIZES = metrics.Histogram("model_batch_size", "Inputs per model forward pass.", label="model",
+                                      buckets=metrics.SIZE_BUCKETS)
+
+
+def sync_index(version):
+    """Reload the store when another process (ingestion, index builds) has changed the collection."""
+    global loaded_version
+    if version == loaded_version:
+        return
+    store = runtime.get_store()
+    if hasattr(store, "refresh"):
+        store.refresh()
+    result_cache.clear()  # Entries keyed by older versions can never hit again
+    loaded_version = version
+
+
+def encode_queries(queries, ensemble=None):
+    """
+    Text embeddings for normalized queries, running the model only for cache misses.
+    Queries flagged in `ensemble` are averaged over their prompt variants; the variants
+    of every missing query share the one forward pass, and the averaged vector is cached.
+    """
+    keys = [("ensemble", query) if ensemble is not None and ensemble[i] else query for i, query in enumerate(queries)]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    missing = list(dict.fromkeys(key for key, embedding in zip(keys, embeddings) if embedding is None))
+    if missing:
+        variants = {key: expand_query(key[1]) if isinstance(key, tuple) else [key] for key in missing}
+        texts = list(dict.fromkeys(text for key_variants in variants.values() for text in key_variants))
+        MODEL_BATCH_SIZES.observe(len(texts), "text")
+        encoded_texts = dict(zip(texts, runtime.encode_text(texts)))
+        encoded = {key: ensemble_embedding([encoded_texts[text] for text in key_variants]) if isinstance(key, tuple)
+                   else encoded_texts[key] for key, key_variants in variants.items()}
+        for key, embedding in encoded.items():
+            embedding_cache.put(key, embedding)
+        embeddings = [encoded[key] if embedding is None else embedding for key, embedding in zip(keys, embeddings)]
+    return np.stack(embeddings)
+
+
+# --- Batched Search (runs on the inference thread, off the event loop) ---
+SEARCH_MODES = ["vector", "keyword", "hybrid"]
+
+# query is normalized text or a ready embedding (query-by-example); exclude_id drops the
+# example image from its own results; filters is an active SearchFilter or None;
+# ensemble averages a text query over QUERY_PROMPT_TEMPLATES for its vector ranking;
+# mmr_lambda (None = off) re-ranks the vector candidates exactly, with MMR diversity below 1.0;
+# ranking returns the Ranking instead of hydrated results (paginated and streamed searches)
+SearchRequest = namedtuple("SearchRequest", "query k nprobe ef_search exclude_id mode filters ensemble mmr_lambda ranking",
+                           defaults=(None, None, None, "vector", None, False, None, False))
+
+# Ranked image ids of a search, with the store metadata already known for them
+Ranking = namedtuple("Ranking", "ids metadatas")
+
+
+def candidate_count(request):
+    """Hits each ranking contributes: k, or HYBRID_CANDIDATES when two rankings are fused."""
+    return max(request.k, HYBRID_CANDIDATES) if request.mode == "hybrid" else request.k
+
+
+def fetch_count(request):
+    """Hits the vector store returns: the ranking's candidates, or RERANK_CANDIDATES for the re-ranking stage."""
+    count = candidate_count(request)
+    return max(count, RERANK_CANDIDATES) if request.mmr_lambda is not None else count
+
+
+def vector_search(requests, allowed_ids):
+    """
+    Ranked vector hits per request, encoding text queries in one forward pass. Requests
+    with an mmr_lambda get their candidates re-ranked against the stored vectors.
+    """
+    if not requests:
+        return []
+    query_embeddings = [request.query for request in requests]
+    text_rows = [i for i, query in enumerate(query_embeddings) if isinstance(query, str)]
+    if text_rows:
+        embeddings = encode_queries([query_embeddings[i] for i in text_rows], [requests[i].ensemble for i in text_rows])
+        for i, embedding in zip(text_rows, embeddings):
+            query_embeddings[i] = embedding
+    query_embeddings = np.stack(query_embeddings)
+
+    # One multi-vector store query per distinct (nprobe, ef_search, filters), fetching the largest k of the group
+    groups = {}
+    for i, request in enumerate(requests):
+        groups.setdefault((request.nprobe, request.ef_search, request.filters), []).append(i)
+    hits = [None] * len(requests)
+    for (nprobe, ef_search, filters), members in groups.items():
+        group_k = max(fetch_count(requests[i]) + (requests[i].exclude_id is not None) for i in members)
+        with span("vector_query"):
+            group_hits = runtime.get_store().query(query_embeddings[members], group_k, nprobe=nprobe,
+                                                   ef_search=ef_search, ids=allowed_ids.get(filters))
+        for i, request_hits in zip(members, group_hits):
+            request = requests[i]
+            hits[i] = [hit for hit in request_hits if hit['id'] != request.exclude_id][:fetch_count(request)]
+
+    rerank_rows = [i for i, request in enumerate(requests) if request.mmr_lambda is not None and hits[i]]
+    if rerank_rows:
+        with span("rerank"):
+            # One store read for the candidates of every re-ranked request in the batch
+            found = runtime.get_store().get(list({hit['id'] for i in rerank_rows for hit in hits[i]}))
+            vectors = dict(zip(found['ids'], found['embeddings']))
+            for i in rerank_rows:
+                hits[i] = rerank_hits(query_embeddings[i], hits[i], vectors, candidate_count(requests[i]),
+                                      requests[i].mmr_lambda)
+    return hits
+
+
+def reciprocal_rank_fusion(rankings, k):
+    """Fuse ranked id lists: each id scores sum(1 / (RRF_K + rank)); returns the best k ids."""
+    scores = {}
+    for ranking in rankings:
+        for rank, image_id in enumerate(ranking, start=1):
+            scores[image_id] = scores.get(image_id, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores, key=lambda image_id: -scores[image_id])[:k]
+
+
+def run_search_batch(requests):
+    """
+    Search a batch of SearchRequests together. "vector" requests rank by CLIP similarity,
+    "keyword" requests by BM25 over the captions, and "hybrid" requests fuse both rankings
+    with reciprocal-rank fusion. Filters are applied inside both searches, before ranking.
+    Returns hydrated results per request, or its Ranking when request.ranking is set.
+    """
+    ranked_ids, metadatas = rank_search_batch(requests)
+    hydrate_rows = [i for i, request in enumerate(requests) if not request.ranking]
+    results = {}
+    if hydrate_rows:
+        with span("hydrate"):
+            results = dict(zip(hydrate_rows, hydrate_results([ranked_ids[i] for i in hydrate_rows], metadatas)))
+    return [results[i] if i in results else
+            Ranking(ids, {image_id: metadatas[image_id] for image_id in ids if image_id in metadatas})
+            for i, ids in enumerate(ranked_ids)]
+
+
+def rank_search_batch(requests):
+    """Ranked image ids per request, and the store metadata of the vector hits ({id: metadata})."""
+    sync_index(index_version.current())
+    caption_store = runtime.get_caption_store()
+    # Each distinct filter is resolved to its image ids once per batch
+    with span("filter"):
+        allowed_ids = {filters: caption_store.filter_ids(filters)
+                       for filters in {request.filters for request in requests} if filters is not None}
+
+    vector_rows = [i for i, request in enumerate(requests) if request.mode != "keyword"]
+    vector_hits = dict(zip(vector_rows, vector_search([requests[i] for i in vector_rows], allowed_ids)))
+    metadatas = {hit['id']: hit['metadata'] for request_hits in vector_hits.values() for hit in request_hits}
+
+    ranked_ids = []
+    for i, request in enumerate(requests):
+        rankings = []
+        if request.mode != "keyword":
+            rankings.append([hit['id'] for hit in vector_hits[i]])
+        if request.mode != "vector":
+            with span("keyword_query"):
+                keyword_hits = caption_store.search_text(
+                    request.query, candidate_count(request) + (request.exclude_id is not None), request.filters
+                )
+            rankings.append([image_id for image_id, _ in keyword_hits if image_id != request.exclude_id])
+        if len(rankings) > 1:
+            with span("fuse"):
+                ranked_ids.append(reciprocal_rank_fusion(rankings, request.k))
+        else:
+            ranked_ids.append(rankings[0][:request.k])
+    return ranked_ids, metadatas
+
+
+def hydrate_results(ranked_ids, metadatas):
+    """Turn ranked image ids into result dicts: path, thumbnail URL and one caption per image."""
+    # Keyword-only hits take their metadata from the store (which also drops ids it no longer holds)
+    missing = list({image_id for ids in ranked_ids for image_id in ids if image_id not in metadatas})
+    if missing:
+        found = runtime.get_store().get(missing)
+        metadatas.update(zip(found['ids'], found['metadatas']))
+    hits = [[metadatas[image_id] for image_id in ids if image_id in metadatas] for ids in ranked_ids]
+
+    # Attach one caption per image from the caption sidecar, and its thumbnail URL if it has one
+    image_ids = list({metadata['image_id'] for request_hits in hits for metadata in request_hits})
+    captions = runtime.get_caption_store().first_captions(image_ids)
+    thumbnail_store = runtime.get_thumbnail_store()
+    thumbnails = thumbnail_store.digests(image_ids) if THUMBNAIL_SIZES else {}
+    return [[{
+        # Normalize path for web (replace backslashes with forward slashes)
+        "path": metadata['image_path'].replace("\\", "/"),
+        "thumbnail": thumbnail_store.url(thumbnails[metadata['image_id']]) if metadata['image_id'] in thumbnails else None,
+        "caption": captions[metadata['image_id']]
+    } for metadata in request_hits] for request_hits in hits]
+
+
+def hydrate_ranking(ranking, offset, count):
+    """Results offset .. offset + count of a Ranking (runs on the inference thread)."""
+    with span("hydrate"):
+        return hydrate_results([ranking.ids[offset:offset + count]], dict(ranking.metadatas))[0]
+
+
+search_batcher = MicroBatcher(run_search_batch)
+
+
+# --- Cursors: paginated and streamed searches page through one cached ranking ---
+async def search_ranking(request):
+    """
+    Cursor token and Ranking of a search, ranked SEARCH_PAGE_DEPTH deep once per index
+    version; later pages and repeats of the search are served from ranking_cache.
+    """
+    token = hashlib.sha1(repr((request, index_version.current())).encode()).hexdigest()[:20]
+    ranking = ranking_cache.get(token)
+    if ranking is None:
+        ranking = await search_batcher.submit(request._replace(k=SEARCH_PAGE_DEPTH, ranking=True))
+        ranking_cache.put(token, ranking)
+    return token, ranking
+
+
+def parse_cursor(cursor):
+    """(token, offset) of a cursor "<token>:<offset>", or None if it is malformed."""
+    token, _, offset = cursor.partition(":")
+    return (token, int(offset)) if token and offset.isdigit() else None
+
+
+async def hydrate_page(ranking, offset, count):
+    """Results of one page of a Ranking, hydrated on the inference thread that owns the stores."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(search_batcher.executor, metrics.run_with_timings,
+                                      [metrics.request_timings()], hydrate_ranking, ranking, offset, count)
+
+
+def next_cursor(token, ranking, end):
+    """Cursor of the page after one ending at `end`, or None on the last page."""
+    return f"{token}:{end}" if end < len(ranking.ids) else None
+
+
+def stream_page(token, ranking, offset, k, sse=False):
+    """
+    Stream results offset .. offset + k of a Ranking as they are hydrated, STREAM_CHUNK_SIZE
+    at a time: one {"rank", "path", "thumbnail", "caption"} line per result, then a final
+    {"next_cursor"} line. NDJSON, or Server-Sent Events ("data: <json>") when `sse` is set.
+    """
+    end = min(offset + k, len(ranking.ids))
+
+    def frame(line):
+        return f"data: {json.dumps(line)}\n\n" if sse else json.dumps(line) + "\n"
+
+    async def lines():
+        for start in range(offset, end, STREAM_CHUNK_SIZE):
+            try:
+                results = await hydrate_page(ranking, start, min(STREAM_CHUNK_SIZE, end - start))
+            except Exception as e:
+                print(f"Search stream error: {e}")
+                yield frame({"error": f"Search failed: {str(e)}"})
+                return
+            yield "".join(frame(dict(result, rank=start + i + 1)) for i, result in enumerate(results))
+        yield frame({"next_cursor": next_cursor(token, ranking, end)})
+
+    return StreamingResponse(lines(), media_type="text/event-stream" if sse else "application/x-ndjson")
+
+
+# --- Query-by-example: image decoding and batched image encoding ---
+def decode_upload(data):
+    """Decode and preprocess uploaded image bytes into CLIP pixel values (runs in a worker thread)."""
+    with span("image_decode"):
+        image = Image.open(io.BytesIO(data))
+        size = runtime.get_image_processor().crop_size["height"]
+        image.draft("RGB", (size, size))  # Let JPEG decoding downscale while it decodes
+        image = image.convert("RGB")
+        return runtime.get_image_processor()(images=image, return_tensors="np")["pixel_values"][0]
+
+
+def stored_embedding(image_id):
+    """The stored vector of an indexed image, or None (runs on the inference thread)."""
+    sync_index(index_version.current())
+    with span("store_get"):
+        found = runtime.get_store().get([image_id])
+    return found['embeddings'][0] if found['ids'] else None
+
+
+def encode_image_batch(pixel_batch):
+    MODEL_BATCH_SIZES.observe(len(pixel_batch), "image")
+    return runtime.encode_images(pixel_batch)
+
+
+# Image encoding has its own thread, so uploads never hold up text query batches
+image_batcher = MicroBatcher(encode_image_batch, max_batch_size=IMAGE_QUERY_BATCH_SIZE, name="image-inference")
+
+
+# --- Metrics (stage timings are recorded by metrics.span in the code paths themselves) ---
+caches = {"embeddings": embedding_cache, "results": result_cache, "rankings": ranking_cache}
+metrics.Gauge("microbatch_queue_depth", "Requests waiting for the next micro-batch.",
+              lambda: {batcher.name: batcher.queue_depth() for batcher in (search_batcher, image_batcher)}, label="batcher")
+metrics.Gauge("cache_hits_total", "Cache hits.", lambda: {name: cache.hits for name, cache in caches.items()},
+              label="cache", kind="counter")
+metrics.Gauge("cache_misses_total", "Cache misses.", lambda: {name: cache.misses for name, cache in caches.items()},
+              label="cache", kind="counter")
+metrics.Gauge("cache_hit_ratio", "Cache hit ratio since startup.",
+              lambda: {name: cache.stats()["hit_rate"] for name, cache in caches.items()}, label="cache")
+metrics.Gauge("cache_entries", "Entries held per cache.",
+              lambda: {name: cache.stats()["size"] for name, cache in caches.items()}, label="cache")
+metrics.Gauge("model_loaded", "1 once the CLIP model (or text encoder) is loaded.", lambda: int(runtime.model_loaded()))
+
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """Record request latency per route; add the per-stage X-Timing header when configured or asked for."""
+    timings = metrics.start_request_timings()
+    start = time.perf_counter()
+    response = await call_next(request)
+    elapsed = time.perf_counter() - start
+    route = request.scope.get("route")
+    REQUEST_SECONDS.observe(elapsed, route.path if route is not None else "unmatched")
+    if TIMING_HEADER or request.headers.get("x-timing"):
+        timings["total"] = elapsed
+        response.headers["X-Timing"] = metrics.format_timings(timings)
+    return response
+
+
+@app.on_event("startup")
+async def startup():
+    if API_WARMUP:
+        # Warm up on the inference thread: the server accepts requests immediately and
+        # the first search batch simply queues behind the model load
+        asyncio.get_running_loop().run_in_executor(search_batcher.executor, warmup)
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await search_batcher.close()
+    await image_batcher.close()
+
+# --- Metrics Endpoint ---
+@app.get("/metrics")
+async def metrics_api():
+    """Prometheus text-format metrics: stage and request latency histograms, batch sizes, queues and caches."""
+    # In a worker process the model_loaded gauge asks the inference server: keep it off the event loop
+    return PlainTextResponse(await run_in_threadpool(metrics.render), media_type="text/plain; version=0.0.4")
 
 # --- Health Check Endpoint ---
 @app.get("/health")
 async def health_check():
     """Check if the API and database are working properly."""
-    if collection is None:
+    store = get_store()
+    if store is None:
         return {"status": "error", "message": "Database not connected. Run ingest_data.py first."}
     
     try:
-        doc_count = collection.count()
+        doc_count = store.count()
         return {
             "status": "healthy", 
             "database": "connected",
-            "documents": doc_count,
-            "collection": COLLECTION_NAME
+            "images": doc_count,
+            "captions": runtime.get_caption_store().count(),
+            "collection": COLLECTION_NAME,
+            "backend": store.name,
+            "shards": len(getattr(store, "shards", [store])),
+            "model_loaded": await run_in_threadpool(runtime.model_loaded),
+            "cache": {
+                "embeddings": embedding_cache.stats(),
+                "results": result_cache.stats(),
+                "rankings": ranking_cache.stats()
+            }
         }
     except Exception as e:
         return {"status": "error", "message": f"Database error: {str(e)}"}
 
 # --- Search Endpoint ---
 @app.get("/search")
-async def search_images_api(query: str = Query(..., min_length=1), k: int = Query(5, ge=1, le=20)):
+async def search_images_api(
+    http_request: Request,
+    query: Optional[str] = Query(None, min_length=1),
+    k: int = Query(5, ge=1, le=20),
+    nprobe: Optional[int] = Query(None, ge=1),
+    ef_search: Optional[int] = Query(None, ge=1),
+    mode: str = Query("vector"),
+    split: Optional[str] = Query(None),
+    image_id_min: Optional[int] = Query(None),
+    image_id_max: Optional[int] = Query(None),
+    tag: List[str] = Query([]),
+    ensemble: Optional[bool] = Query(None),
+    mmr_lambda: Optional[float] = Query(None, ge=0.0, le=1.0),
+    paginate: bool = Query(False),
+    cursor: Optional[str] = Query(None)
+):
     """
     Search the image collection based on a text query.
-    k: Number of results to return (1-20)
+    k: Number of results to return (1-20); the page size with paginate / cursor
+    nprobe: IVF lists to scan (NumPy store with an IVF index)
+    ef_search: HNSW candidate list size (NumPy store with an HNSW index)
+    mode: "vector" (CLIP), "keyword" (BM25 over captions) or "hybrid" (both, rank-fused)
+    split, image_id_min, image_id_max, tag: pre-filters applied before ranking (tags may repeat; all must match)
+    ensemble: average the query over prompt templates and "|"-separated sub-queries (default QUERY_ENSEMBLE)
+    mmr_lambda: re-rank the top RERANK_CANDIDATES exactly; below 1.0 trades relevance for diversity (default MMR_LAMBDA)
+    paginate: rank SEARCH_PAGE_DEPTH hits once and return the first page with a "next_cursor"
+    cursor: fetch the page after a previous response's next_cursor (no query or other parameters needed)
+    With "Accept: application/x-ndjson" or "text/event-stream", the page is streamed as results are hydrated.
     """
+    accept = http_request.headers.get("accept", "")
+    stream = "application/x-ndjson" in accept or "text/event-stream" in accept
+    if cursor is not None:
+        position = parse_cursor(cursor)
+        ranking = ranking_cache.get(position[0]) if position else None
+        if ranking is None:
+            return {"error": "Invalid or expired cursor; run the search again."}
+        token, offset = position
+        if stream:
+            return stream_page(token, ranking, offset, k, sse="text/event-stream" in accept)
+        try:
+            retrieved_results = await hydrate_page(ranking, offset, k)
+        except Exception as e:
+            print(f"Search error: {e}")
+            return {"error": f"Search failed: {str(e)}"}
+        return {"results": retrieved_results, "next_cursor": next_cursor(token, ranking, offset + k)}
+
+    if query is None:
+        return {"error": "Provide a query or a cursor."}
+    if mode not in SEARCH_MODES:
+        return {"error": f"Unknown search mode: {mode} (expected one of {', '.join(SEARCH_MODES)})."}
     # Check if database is available
-    if collection is None:
+    if get_store() is None:
         return {"error": "Database not available. Please run ingest_data.py first."}
     
     try:
-        # Generate text embedding from the query
-        inputs = processor(text=[query], return_tensors="pt", padding=True).to(device)
-        with torch.no_grad():
-            text_embedding = model.get_text_features(**inputs).cpu().numpy().tolist()[0]
-
-        # Query the ChromaDB collection (get more results to filter duplicates)
-        results = collection.query(
-            query_embeddings=[text_embedding],
-            n_results=min(k * 3, 100),  # Get 3x more results to filter duplicates
-            include=['metadatas', 'distances', 'documents']
-        )
-
-        # Process results and return unique images with captions
-        retrieved_metadata = results['metadatas'][0]
-        retrieved_distances = results['distances'][0]
-        retrieved_documents = results['documents'][0]
-
-        # Deduplicate by image_id
-        unique_images = {}
-        for i, meta in enumerate(retrieved_metadata):
-            image_id = meta['image_id']
-            image_path = meta['image_path']
-            caption = retrieved_documents[i]  # Get the caption from documents
-            distance = retrieved_distances[i]
-            
-            # Keep the closest match per image_id
-            if image_id not in unique_images or distance < unique_images[image_id]['distance']:
-                unique_images[image_id] = {
-                    'path': image_path,
-                    'caption': caption,
-                    'distance': distance
-                }
-
-        # Sort by similarity (distance)
-        sorted_images = sorted(unique_images.values(), key=lambda x: x['distance'])
-
-        # Return top-k unique results with web-friendly paths
-        retrieved_results = []
-        for img in sorted_images[:k]:
-            # Normalize path for web (replace backslashes with forward slashes)
-            web_path = img['path'].replace("\\", "/")
-            retrieved_results.append({
-                "path": web_path,
-                "caption": img['caption']
-            })
-
+        # Repeat queries against an unchanged collection are answered from the result cache
+        query = normalize_query(query)
+        filters = SearchFilter(split, image_id_min, image_id_max, tag)
+        filters = filters if filters.active else None
+        ensemble = QUERY_ENSEMBLE if ensemble is None else ensemble
+        mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+        if paginate or stream:
+            # The ranking is computed once; this page and every later one are slices of it
+            token, ranking = await search_ranking(
+                SearchRequest(query, None, nprobe, ef_search, None, mode, filters, ensemble, mmr_lambda)
+            )
+            if stream:
+                return stream_page(token, ranking, 0, k, sse="text/event-stream" in accept)
+            return {"results": await hydrate_page(ranking, 0, k), "next_cursor": next_cursor(token, ranking, k)}
+        version = index_version.current()
+        cache_key = (query, k, nprobe, ef_search, mode, filters, ensemble, mmr_lambda, version)
+        retrieved_results = result_cache.get(cache_key)
+        if retrieved_results is None:
+            # Encoding and the store query are micro-batched with concurrent requests on the inference thread
+            retrieved_results = await search_batcher.submit(
+                SearchRequest(query, k, nprobe, ef_search, None, mode, filters, ensemble, mmr_lambda)
+            )
+            result_cache.put(cache_key, retrieved_results)
         return {"results": retrieved_results}
         
     except Exception as e:
         print(f"Search error: {e}")
-        return {"error": f"Search failed: {str(e)}"}
\ No newline at end of file
+        return {"error": f"Search failed: {str(e)}"}
+
+
+# --- Image Search Endpoint ---
+@app.post("/search/image")
+async def search_by_image_api(
+    file: Optional[UploadFile] = File(None),
+    image_id: Optional[str] = Query(None, min_length=1),
+    k: int = Query(5, ge=1, le=20),
+    nprobe: Optional[int] = Query(None, ge=1),
+    ef_search: Optional[int] = Query(None, ge=1),
+    mmr_lambda: Optional[float] = Query(None, ge=0.0, le=1.0)
+):
+    """
+    Find images similar to an uploaded image (multipart field "file") or to an indexed image_id.
+    An indexed image reuses its stored vector and is left out of its own results.
+    k: Number of results to return (1-20)
+    mmr_lambda: exact / diversity re-ranking as in GET /search (default MMR_LAMBDA)
+    """
+    if (file is None) == (image_id is None):
+        return {"error": "Provide either an uploaded image file or an image_id."}
+    if get_store() is None:
+        return {"error": "Database not available. Please run ingest_data.py first."}
+
+    loop = asyncio.get_running_loop()
+    try:
+        if image_id is not None:
+            source_key = ("image_id", image_id)
+        else:
+            data = await file.read(MAX_UPLOAD_BYTES + 1)
+            if len(data) > MAX_UPLOAD_BYTES:
+                return {"error": f"Image is larger than {MAX_UPLOAD_BYTES // 2**20} MiB."}
+            source_key = ("upload", hashlib.sha1(data).hexdigest())
+
+        mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+        version = index_version.current()
+        cache_key = source_key + (k, nprobe, ef_search, mmr_lambda, version)
+        retrieved_results = result_cache.get(cache_key)
+        if retrieved_results is not None:
+            return {"results": retrieved_results}
+
+        if image_id is not None:
+            # Stored vectors are read on the inference thread that owns the store
+            embedding = await loop.run_in_executor(search_batcher.executor, metrics.run_with_timings,
+                                                   [metrics.request_timings()], stored_embedding, image_id)
+            if embedding is None:
+                return {"error": f"Image {image_id} is not in the index."}
+        else:
+            try:
+                pixel_values = await loop.run_in_executor(None, metrics.run_with_timings,
+                                                          [metrics.request_timings()], decode_upload, data)
+            except Exception as e:
+                return {"error": f"Could not read the uploaded image: {e}"}
+            embedding = await image_batcher.submit(pixel_values)
+
+        retrieved_results = await search_batcher.submit(
+            SearchRequest(embedding, k, nprobe, ef_search, image_id, mmr_lambda=mmr_lambda)
+        )
+        result_cache.put(cache_key, retrieved_results)
+        return {"results": retrieved_results}
+
+    except Exception as e:
+        print(f"Image search error: {e}")
+        return {"error": f"Search failed: {str(e)}"}
+
+
+# --- Batch Search Endpoint ---
+class BatchQuery(BaseModel):
+    query: str = Field(..., min_length=1)
+    k: int = Field(5, ge=1, le=100)
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[BatchQuery]
+    nprobe: Optional[int] = Field(None, ge=1)
+    ef_search: Optional[int] = Field(None, ge=1)
+    mode: str = "vector"
+    split: Optional[str] = None
+    image_id_min: Optional[int] = None
+    image_id_max: Optional[int] = None
+    tags: List[str] = []
+    ensemble: Optional[bool] = None
+    mmr_lambda: Optional[float] = Field(None, ge=0.0, le=1.0)
+
+
+@app.post("/search/batch")
+async def search_batch_api(request: BatchSearchRequest):
+    """
+    Search many text queries in one request. Queries are encoded and searched in chunks of
+    BATCH_SEARCH_CHUNK_SIZE (one forward pass and one multi-vector store query per chunk), and
+    results stream back as NDJSON, one {"index", "query", "results"} line per query in input order.
+    mode, ensemble, mmr_lambda and the split / image_id / tags filters apply to every query, as in GET /search.
+    """
+    if len(request.queries) > BATCH_SEARCH_MAX_QUERIES:
+        return {"error": f"At most {BATCH_SEARCH_MAX_QUERIES} queries per batch request."}
+    if request.mode not in SEARCH_MODES:
+        return {"error": f"Unknown search mode: {request.mode} (expected one of {', '.join(SEARCH_MODES)})."}
+    if get_store() is None:
+        return {"error": "Database not available. Please run ingest_data.py first."}
+
+    filters = SearchFilter(request.split, request.image_id_min, request.image_id_max, request.tags)
+    filters = filters if filters.active else None
+    ensemble = QUERY_ENSEMBLE if request.ensemble is None else request.ensemble
+    mmr_lambda = MMR_LAMBDA if request.mmr_lambda is None else request.mmr_lambda
+
+    async def stream_results():
+        loop = asyncio.get_running_loop()
+        queries = request.queries
+        for start in range(0, len(queries), BATCH_SEARCH_CHUNK_SIZE):
+            chunk = queries[start:start + BATCH_SEARCH_CHUNK_SIZE]
+            chunk_requests = [SearchRequest(normalize_query(item.query), item.k, request.nprobe, request.ef_search,
+                                            None, request.mode, filters, ensemble, mmr_lambda)
+                              for item in chunk]
+            try:
+                # Runs on the inference thread between interactive batches, so /search stays responsive
+                chunk_results = await loop.run_in_executor(search_batcher.executor, run_search_batch, chunk_requests)
+                lines = [{"index": start + i, "query": item.query, "results": results}
+                         for i, (item, results) in enumerate(zip(chunk, chunk_results))]
+            except Exception as e:
+                print(f"Batch search error: {e}")
+                lines = [{"index": start + i, "query": item.query, "error": f"Search failed: {str(e)}"}
+                         for i, item in enumerate(chunk)]
+            yield "".join(json.dumps(line) + "\n" for line in lines)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+
+# --- Thumbnail Endpoint ---
+@app.get("/thumbnails/{size}/{filename}")
+async def thumbnail_api(size: int, filename: str, request: Request):
+    """
+    Serve a precomputed thumbnail. Names are content hashes of the original image, so a
+    URL's bytes never change: responses are cacheable forever and revalidate by ETag.
+    """
+    digest, _, extension = filename.partition(".")
+    if size not in THUMBNAIL_SIZES or extension != THUMBNAIL_FORMAT or not is_digest(digest):
+        return Response(status_code=404)
+    headers = {"ETag": f'"{digest}-{size}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if request.headers.get("if-none-match") == headers["ETag"]:
+        return Response(status_code=304, headers=headers)
+    path = runtime.get_thumbnail_store().path(digest, size)
+    if not os.path.exists(path):
+        return Response(status_code=404)
+    return FileResponse(path, media_type=media_type(), headers=headers)
@@ -0,0 +1,113 @@
+"""
+Dynamic micro-batching for the search API.
+
+Requests submitted within `max_wait_ms` of each other (up to `max_batch_size`)
+are handed to a blocking batch handler in one call. The handler runs on a
+dedicated inference thread, so the event loop keeps serving other requests
+(including /health) while the model and vector store work. While one batch
+runs, new requests queue up and form the next, larger batch, so throughput
+grows with load instead of staying at one query per forward pass.
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from config import *
+
+BATCH_SIZES = metrics.Histogram("microbatch_size", "Requests per micro-batch handed to the inference thread.",
+                                label="batcher", buckets=metrics.SIZE_BUCKETS)
+
+
+class MicroBatcher:
+    """Collect concurrent requests into batches for a blocking `handler(items) -> results`."""
+
+    def __init__(self, handler, max_batch_size=SEARCH_MAX_BATCH_SIZE, max_wait_ms=SEARCH_BATCH_WAIT_MS, name="inference"):
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._executor = None
+        self._queue = None
+        self._worker = None
+
+    @property
+    def executor(self):
+        """The inference thread, created on first use (and again after close())."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=self.name)
+        return self._executor
+
+    async def submit(self, item):
+        """Queue one request and wait for its result (exceptions from the handler are re-raised)."""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.get_loop() is not loop:
+            # First request, or the app is now served by another event loop (a new lifespan
+            # without close()): the queue and batching task are bound to their loop, so start new ones
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run(self._queue))
+        future = loop.create_future()
+        # The request's timing dict rides along, so batch stages are reported per request
+        await self._queue.put((item, future, time.perf_counter(), metrics.request_timings()))
+        return await future
+
+    def queue_depth(self):
+        """Requests waiting for the next batch."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _collect(self, queue):
+        """Wait for one request, then gather whatever else arrives within the batching window."""
+        batch = [await queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Take requests that are already waiting without yielding to the timer
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self, queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect(queue)
+            batch = [entry for entry in batch if not entry[1].cancelled()]
+            if not batch:
+                continue
+            BATCH_SIZES.observe(len(batch), self.name)
+            started = time.perf_counter()
+            for _, _, submitted, timings in batch:
+                metrics.add_timing("queue_wait", started - submitted, [timings] if timings is not None else [])
+            try:
+                results = await loop.run_in_executor(self.executor, metrics.run_with_timings,
+                                                     [timings for _, _, _, timings in batch],
+                                                     self.handler, [item for item, _, _, _ in batch])
+            except Exception as e:
+                for _, future, _, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def close(self):
+        """Stop the batching task and the inference thread; the next submit() starts new ones."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._worker = None
+        self._queue = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
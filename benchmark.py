@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+Offline latency and throughput benchmarks on a synthetic collection.
+
+Suites:
+    encode  text-encoder latency per batch size (TEXT_ENCODER backend)
+    query   NumPy vector-store query latency per collection size and k (random unit vectors)
+    search  end-to-end GET /search p50/p95/p99 under concurrent load (in-process ASGI client)
+    ingest  ingest_data.py images per second on random JPEGs and captions
+
+Everything runs in a scratch working directory, so the relative paths in config.py
+(stores, captions, thumbnails, manifest, data/) point at synthetic files and the real
+index is never touched; only the model cache is shared. Results are written as JSON;
+--compare prints the p50 change against an earlier run.
+
+Usage:
+    python benchmark.py                                   # all suites, default sizes
+    python benchmark.py --suites query --sizes 100000,1000000 --ks 10,100
+    python benchmark.py --output after.json --compare before.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy as np
+import runtime
+from evaluate_model import parse_list, parse_int_list
+from config import *
+
+SUITES = ["encode", "query", "search", "ingest"]
+WORDS = ("a an the man woman child dog cat horse bus train pizza table kitchen street field beach snow "
+         "red blue green white black small large old young sitting standing riding eating holding "
+         "on in with near next to under playing walking parked plate of two three people").split()
+SCRATCH_PATHS = {"CHROMA_DB_PATH": CHROMA_DB_PATH, "NUMPY_INDEX_DIR": NUMPY_INDEX_DIR, "THUMBNAIL_DIR": THUMBNAIL_DIR,
+                 "DATASET_PATH": DATASET_PATH, "IMAGE_DIR": IMAGE_DIR,
+                 "ANNOTATION_CACHE_DIR": ANNOTATION_CACHE_DIR, "EMBEDDING_CACHE_DIR": EMBEDDING_CACHE_DIR}
+
+
+def random_captions(n, rng):
+    """Caption-like strings of 6-12 common COCO words."""
+    return [" ".join(rng.choice(WORDS, size=rng.integers(6, 13))) for _ in range(n)]
+
+
+def random_unit_vectors(n, dim, rng):
+    vectors = rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def latency_stats(seconds):
+    """p50/p95/p99/mean in milliseconds from per-call durations in seconds."""
+    ms = np.asarray(seconds) * 1000
+    return {"p50_ms": round(float(np.percentile(ms, 50)), 3), "p95_ms": round(float(np.percentile(ms, 95)), 3),
+            "p99_ms": round(float(np.percentile(ms, 99)), 3), "mean_ms": round(float(ms.mean()), 3), "calls": len(ms)}
+
+
+def timed(call, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def environment():
+    """Where and on what the numbers were measured."""
+    import torch
+    info = {
+        "python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count(),
+        "numpy": np.__version__, "torch": torch.__version__, "device": runtime.device(),
+        "model": MODEL_NAME, "text_encoder": TEXT_ENCODER, "vector_store": VECTOR_STORE,
+        "quantization": NUMPY_INDEX_QUANTIZATION, "shards": len(SHARD_ADDRESSES) or NUM_SHARDS,
+    }
+    try:
+        info["git_commit"] = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        info["git_commit"] = None
+    return info
+
+
+# --- Suites ---
+def bench_encode(args, rng):
+    """Text-encoder latency per batch size."""
+    print("\n--- Text encoding ---")
+    runtime.encode_text(["warmup"])
+    results = []
+    for batch_size in args.batch_sizes:
+        texts = random_captions(batch_size, rng)
+        runtime.encode_text(texts)
+        repeats = max(3, args.queries // batch_size)
+        stats = latency_stats(timed(lambda: runtime.encode_text(texts), repeats))
+        stats.update(batch_size=batch_size, texts_per_s=round(batch_size * 1000 / stats["mean_ms"], 1))
+        results.append(stats)
+        print(f"batch {batch_size:>4}: p50 {stats['p50_ms']:.2f} ms, p95 {stats['p95_ms']:.2f} ms, "
+              f"{stats['texts_per_s']:.0f} texts/s")
+    return results
+
+
+def bench_query(args, rng, dim):
+    """Single-query latency and batched throughput of the NumPy store per collection size and k."""
+    from vector_store import NumpyVectorStore
+    print("\n--- Vector queries (NumPy store) ---")
+    results = []
+    for size in args.sizes:
+        store = NumpyVectorStore(os.path.join("bench_query", str(size)), create=True)
+        for start in range(0, size, 100000):
+            n = min(100000, size - start)
+            store.upsert([str(i) for i in range(start, start + n)], random_unit_vectors(n, dim, rng),
+                         [{"image_id": str(i), "image_path": ""} for i in range(start, start + n)])
+        if args.quantize != "none":
+            store.quantize(args.quantize)
+        if args.ann != "none":
+            store.build_ann(args.ann)
+        queries = random_unit_vectors(args.queries, dim, rng)
+        for k in args.ks:
+            store.query(queries[:1], k)
+            stats = latency_stats([timed(lambda: store.query(query[None, :], k), 1)[0] for query in queries])
+            batch_seconds = timed(lambda: store.query(queries, k), 1)[0]
+            stats.update(size=size, k=k, quantize=args.quantize, ann=args.ann,
+                         batched_qps=round(len(queries) / batch_seconds, 1))
+            results.append(stats)
+            print(f"{size:>9} images, k={k:<4}: p50 {stats['p50_ms']:.3f} ms, p99 {stats['p99_ms']:.3f} ms, "
+                  f"batched {stats['batched_qps']:.0f} queries/s")
+        shutil.rmtree(store.directory)
+    return results
+
+
+def fill_configured_store(size, dim, rng):
+    """Replace the configured (scratch) collection with `size` random vectors and captions."""
+    from vector_store import open_vector_store
+    from captions import CaptionStore
+    from cache import IndexVersion
+    store = open_vector_store(create=True)
+    store.clear()
+    caption_store = CaptionStore(CAPTION_DB_PATH)
+    caption_store.clear()
+    for start in range(0, size, 10000):
+        ids = [str(i) for i in range(start, min(start + 10000, size))]
+        store.upsert(ids, random_unit_vectors(len(ids), dim, rng),
+                     [{"image_id": i, "image_path": get_relative_image_path(f"{int(i):012d}.jpg")} for i in ids])
+        caption_store.replace_captions({i: [(i, caption)] for i, caption in zip(ids, random_captions(len(ids), rng))})
+    caption_store.close()
+    IndexVersion(INDEX_VERSION_PATH).bump()
+
+
+async def search_load(client, queries, concurrency, k):
+    """Send `queries` to /search from `concurrency` concurrent clients; returns (latencies, wall seconds)."""
+    pending = iter(queries)
+    latencies = []
+
+    async def client_loop():
+        for query in pending:
+            start = time.perf_counter()
+            response = await client.get("/search", params={"query": query, "k": k})
+            body = response.json()
+            if response.status_code != 200 or "error" in body:
+                raise RuntimeError(f"/search failed: {response.status_code} {body}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client_loop() for _ in range(concurrency)])
+    return latencies, time.perf_counter() - start
+
+
+def bench_search(args, rng, dim):
+    """End-to-end /search latency under concurrent load, through the real app and micro-batcher."""
+    try:
+        import httpx
+    except ImportError:
+        raise ImportError("The search benchmark needs httpx: pip install httpx")
+    print(f"\n--- End-to-end /search ({args.search_size} images) ---")
+    fill_configured_store(args.search_size, dim, rng)
+    os.makedirs("data", exist_ok=True)  # api.py serves data/ as static files
+    import api
+
+    async def run():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=600) as client:
+            await search_load(client, ["warmup"], 1, args.k)
+            results = []
+            for concurrency in args.concurrency:
+                # Distinct queries, so every request misses the caches and reaches the model and the store
+                queries = [f"{caption} {i}" for i, caption in enumerate(random_captions(args.search_requests, rng))]
+                latencies, wall = await search_load(client, queries, concurrency, args.k)
+                stats = latency_stats(latencies)
+                stats.update(concurrency=concurrency, k=args.k, size=args.search_size,
+                             requests_per_s=round(len(latencies) / wall, 1))
+                results.append(stats)
+                print(f"concurrency {concurrency:>3}: p50 {stats['p50_ms']:.1f} ms, p95 {stats['p95_ms']:.1f} ms, "
+                      f"p99 {stats['p99_ms']:.1f} ms, {stats['requests_per_s']:.0f} req/s")
+        await api.search_batcher.close()
+        await api.image_batcher.close()
+        return results
+
+    return asyncio.run(run())
+
+
+def write_synthetic_dataset(n_images, rng):
+    """Random JPEGs in IMAGE_DIR and five captions each in a COCO-format DATASET_PATH."""
+    from PIL import Image
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    os.makedirs(os.path.dirname(DATASET_PATH), exist_ok=True)
+    annotations = []
+    for image_id in range(1, n_images + 1):
+        # Smooth random colour fields compress like photos; pure noise would inflate decode cost
+        small = rng.integers(0, 256, size=(6, 8, 3), dtype=np.uint8)
+        Image.fromarray(small).resize((640, 480), Image.BILINEAR).save(
+            get_absolute_image_path(f"{image_id:012d}.jpg"), quality=90)
+        for caption in random_captions(5, rng):
+            annotations.append({"id": len(annotations) + 1, "image_id": image_id, "caption": caption})
+    with open(DATASET_PATH, 'w') as f:
+        json.dump({"annotations": annotations}, f)
+
+
+def bench_ingest(args, rng):
+    """Images per second of a full ingest_data.py --rebuild run (model load excluded)."""
+    import ingest_data
+    print(f"\n--- Ingestion ({args.ingest_images} images) ---")
+    write_synthetic_dataset(args.ingest_images, rng)
+    runtime.get_model()
+    argv = sys.argv
+    sys.argv = ["ingest_data.py", "--rebuild"]
+    try:
+        start = time.perf_counter()
+        ingest_data.main()
+        seconds = time.perf_counter() - start
+    finally:
+        sys.argv = argv
+    result = {"images": args.ingest_images, "seconds": round(seconds, 3),
+              "images_per_s": round(args.ingest_images / seconds, 1), "decode_workers": NUM_DECODE_WORKERS,
+              "decode_pool": DECODE_POOL, "inference_batch_size": INFERENCE_BATCH_SIZE,
+              "thumbnails": list(THUMBNAIL_SIZES)}
+    print(f"Ingested {args.ingest_images} images in {seconds:.1f}s ({result['images_per_s']:.1f} images/s)")
+    return result
+
+
+# --- Comparison ---
+def _entries(results):
+    """{(suite, parameters): p50 or throughput} for every measurement in a results dict."""
+    flat = {}
+    for suite, entries in results.items():
+        for entry in entries if isinstance(entries, list) else [entries]:
+            params = tuple(sorted((key, value) for key, value in entry.items()
+                                  if key in ("batch_size", "size", "k", "quantize", "ann", "concurrency", "images")))
+            flat[(suite, params)] = entry.get("p50_ms", entry.get("images_per_s"))
+    return flat
+
+
+def compare(baseline_path, results):
+    with open(baseline_path, 'r') as f:
+        baseline = _entries(json.load(f)["results"])
+    print(f"\n--- Compared with {baseline_path} (p50 ms; images/s for ingest) ---")
+    for key, value in _entries(results).items():
+        if key in baseline and baseline[key]:
+            change = (value - baseline[key]) / baseline[key] * 100
+            params = ", ".join(f"{name}={param}" for name, param in key[1])
+            print(f"{key[0]:<7} {params:<48} {baseline[key]:>10.3f} -> {value:>10.3f} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark text encoding, vector queries, /search and ingestion offline.")
+    parser.add_argument("--suites", type=parse_list, default=SUITES, help=f"Comma-separated subset of {','.join(SUITES)}")
+    parser.add_argument("--output", default=f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json", help="JSON results file")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-sizes", type=parse_int_list, default=[1, 8, 32, 128], help="Text-encoder batch sizes")
+    parser.add_argument("--queries", type=int, default=200, help="Timed calls per setting")
+    parser.add_argument("--sizes", type=parse_int_list, default=[10000, 100000], help="Collection sizes for the query suite")
+    parser.add_argument("--ks", type=parse_int_list, default=[1, 10, 100], help="k values for the query suite")
+    parser.add_argument("--quantize", choices=["none", "fp16", "int8", "pq"], default="none", help="Codes for the query suite")
+    parser.add_argument("--ann", choices=["none", "ivf", "hnsw"], default="none", help="ANN index for the query suite")
+    parser.add_argument("--search-size", type=int, default=10000, help="Images in the /search collection")
+    parser.add_argument("--search-requests", type=int, default=300, help="/search requests per concurrency level")
+    parser.add_argument("--concurrency", type=parse_int_list, default=[1, 8, 32], help="Concurrent /search clients")
+    parser.add_argument("--k", type=int, default=K_RESULTS, help="k for /search")
+    parser.add_argument("--ingest-images", type=int, default=256, help="Synthetic images for the ingest suite")
+    parser.add_argument("--keep", action="store_true", help="Keep the scratch directory")
+    args = parser.parse_args()
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error(f"Unknown suites: {', '.join(sorted(unknown))}")
+    absolute = [name for name, path in SCRATCH_PATHS.items() if os.path.isabs(path)]
+    if absolute:
+        parser.error(f"{', '.join(absolute)} must be relative paths so the benchmark can redirect them to a scratch directory")
+
+    output = os.path.abspath(args.output)
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    rng = np.random.default_rng(args.seed)
+
+    # Relative paths resolve inside the scratch directory from here on; the model cache is linked in
+    scratch = tempfile.mkdtemp(prefix="clip-benchmark-")
+    if MODEL_CACHE_DIR and not os.path.isabs(MODEL_CACHE_DIR) and os.path.isdir(MODEL_CACHE_DIR):
+        os.symlink(os.path.abspath(MODEL_CACHE_DIR), os.path.join(scratch, MODEL_CACHE_DIR))
+    os.chdir(scratch)
+    print(f"🧪 Benchmarking in {scratch}")
+
+    results = {}
+    try:
+        dim = runtime.encode_text(["dimension"]).shape[1] if set(args.suites) & {"encode", "search"} else 512
+        if "encode" in args.suites:
+            results["encode"] = bench_encode(args, rng)
+        if "query" in args.suites:
+            results["query"] = bench_query(args, rng, dim)
+        if "ingest" in args.suites:
+            results["ingest"] = bench_ingest(args, rng)
+        if "search" in args.suites:
+            results["search"] = bench_search(args, rng, dim)
+    finally:
+        if not args.keep:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(),
+              "arguments": vars(args), "results": results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n💾 Results written to {output}")
+    if compare_path:
+        compare(compare_path, results)
+
+
+if __name__ == "__main__":
+    main()
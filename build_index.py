@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Build a search index offline from embeddings that are already stored.
+No model inference is needed; vectors are copied from one store to another.
+
+Usage:
+    python build_index.py                       # ChromaDB collection -> memory-mapped NumPy store
+    python build_index.py --source numpy --target chroma
+    python build_index.py --quantize pq         # ... and write product-quantized codes
+    python build_index.py --quantize int8 --in-place        # re-quantize the existing NumPy store
+    python build_index.py --ann ivf --nlist 1024 --in-place # IVF index over the existing NumPy store
+    python build_index.py --ann hnsw --hnsw-m 32 --in-place # HNSW index (needs hnswlib)
+    python build_index.py --source numpy --seed-cache       # only add stored embeddings to the embedding cache
+"""
+
+import argparse
+from vector_store import open_vector_store, copy_store
+from cache import IndexVersion
+from embedding_cache import open_embedding_cache, cache_store_embeddings
+from ingest_data import IngestManifest
+from config import *
+
+
+def quantize_store(store, mode):
+    """Write compressed codes for a NumPy store and report their size."""
+    print(f"🗜️  Quantizing {store.count()} vectors with mode '{mode}'...")
+    store.quantize(mode)
+    if store.codec is None:
+        print("   No codes written; queries use exact full-precision search.")
+        return
+    dim = store.get(store.ids()[:1])['embeddings'].shape[1]
+    full = store.count() * dim * 4
+    codes = store.count() * store.codec.bytes_per_vector(dim)
+    print(f"   Codes: {codes / 2**20:.1f} MiB vs {full / 2**20:.1f} MiB float32 ({full / max(codes, 1):.0f}x smaller)")
+
+
+def build_ann(store, args):
+    """Build (or remove) the NumPy store's approximate nearest-neighbour index."""
+    if args.ann == "ivf":
+        params = {"nlist": args.nlist}
+    elif args.ann == "hnsw":
+        params = {"m": args.hnsw_m, "ef_construction": args.ef_construction}
+    else:
+        params = {}
+    print(f"🧭 Building ANN index '{args.ann}' {params}...")
+    store.build_ann(args.ann, **params)
+    print("   Tune per query with /search?nprobe=... (IVF) or /search?ef_search=... (HNSW).")
+
+
+def seed_embedding_cache(store):
+    """Add a store's vectors to the embedding cache, keyed by the content hashes in the ingest manifest."""
+    cache = open_embedding_cache()
+    if cache is None:
+        print("EMBEDDING_CACHE_DIR is not set; nothing to seed.")
+        return
+    digests = {image_id: entry.get('sha1') for image_id, entry in IngestManifest(INGEST_MANIFEST_PATH).images.items()}
+    print(f"♻️  Caching embeddings of {store.count()} images from the {store.name} store...")
+    added = cache_store_embeddings(cache, store, digests)
+    print(f"   Added {added} embeddings ({len(cache)} cached for {MODEL_NAME}); new collections reuse them.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a vector index from stored embeddings.")
+    parser.add_argument("--source", choices=["chroma", "numpy"], default="chroma", help="Store to read embeddings from")
+    parser.add_argument("--target", choices=["chroma", "numpy"], default="numpy", help="Store to write")
+    parser.add_argument("--quantize", choices=["none", "fp16", "int8", "pq"], default=NUMPY_INDEX_QUANTIZATION,
+                        help="Compressed codes to write for the NumPy store")
+    parser.add_argument("--ann", choices=["none", "ivf", "hnsw"], default="none",
+                        help="Approximate index to build for the NumPy store")
+    parser.add_argument("--nlist", type=int, default=IVF_NLIST, help="IVF inverted lists (0 = 4 * sqrt(images))")
+    parser.add_argument("--hnsw-m", type=int, default=HNSW_M, help="HNSW graph degree")
+    parser.add_argument("--ef-construction", type=int, default=HNSW_CONSTRUCTION_EF, help="HNSW build candidate list size")
+    parser.add_argument("--seed-cache", action="store_true",
+                        help="Only add the --source store's embeddings to the embedding cache (EMBEDDING_CACHE_DIR)")
+    parser.add_argument("--in-place", action="store_true",
+                        help="Skip the copy and only (re)write codes / ANN index for the existing NumPy store")
+    args = parser.parse_args()
+
+    if args.seed_cache:
+        seed_embedding_cache(open_vector_store(args.source))
+        return
+
+    if args.in_place:
+        store = open_vector_store("numpy")
+        quantize_store(store, args.quantize)
+        build_ann(store, args)
+        IndexVersion(INDEX_VERSION_PATH).bump()
+        return
+
+    if args.source == args.target:
+        parser.error("--source and --target must differ")
+
+    source = open_vector_store(args.source)
+    target = open_vector_store(args.target, create=True)
+    target.clear()
+
+    print(f"📦 Building {target.name} index from {source.count()} images in the {source.name} store...")
+    copied = copy_store(source, target)
+    print(f"✅ {target.name} index ready with {target.count()} images ({copied} copied).")
+    if target.name == "numpy":
+        quantize_store(target, args.quantize)
+        build_ann(target, args)
+    IndexVersion(INDEX_VERSION_PATH).bump()
+    print(f"   Set VECTOR_STORE = \"{target.name}\" in config.py to serve it.")
+
+
+if __name__ == "__main__":
+    main()
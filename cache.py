@@ -0,0 +1,91 @@
+"""
+Query caches for the search API and the index version that invalidates them.
+
+- LRUCache: bounded, thread-safe LRU with an optional TTL and hit/miss counters.
+- IndexVersion: a small token file next to the index. Every process that changes
+  the collection (ingestion, pruning, migration, index builds) bumps it; the API
+  compares it per request, so cached results never outlive the data they came from.
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from config import *
+
+
+def normalize_query(query):
+    """Cache key for query text: case- and whitespace-insensitive (CLIP's tokenizer lowercases anyway)."""
+    return " ".join(query.lower().split())
+
+
+class LRUCache:
+    """Least-recently-used cache with at most `maxsize` entries that expire after `ttl` seconds (None = never)."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.monotonic()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+
+class IndexVersion:
+    """Version token of the collection, stored in a file shared by the API and the indexing scripts."""
+
+    def __init__(self, path=INDEX_VERSION_PATH):
+        self.path = path
+
+    def current(self):
+        """Cheap per-request check: the token is the file's inode and mtime (None before the first bump)."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def bump(self):
+        """Mark the collection as changed; readers see a new version on their next check."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(f"{time.time_ns()}\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,197 @@
+"""
+Caption sidecar for the image-level index.
+The vector collection stores one embedding per image; all COCO captions live
+in a small SQLite table keyed by image_id so they are not duplicated per vector.
+
+The sidecar also holds what lexical and filtered search need:
+- caption_index: an FTS5 inverted index with one document per image (its captions
+  joined), ranked with BM25, kept in sync whenever captions are written.
+- images / image_tags: per-image metadata (split, custom tags) used as pre-filters.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+
+
+class SearchFilter(namedtuple("SearchFilter", "split image_id_min image_id_max tags")):
+    """Metadata pre-filter: an exact split, an inclusive image_id range and tags that must all be present."""
+
+    __slots__ = ()
+
+    def __new__(cls, split=None, image_id_min=None, image_id_max=None, tags=()):
+        return super().__new__(cls, split, image_id_min, image_id_max, tuple(sorted(set(tags))))
+
+    @property
+    def active(self):
+        return any(value not in (None, ()) for value in self)
+
+    def sql(self, column="images.image_id"):
+        """WHERE clauses and parameters over the images table (joined on `column`)."""
+        clauses, params = [], []
+        if self.split is not None:
+            clauses.append("images.split = ?")
+            params.append(self.split)
+        if self.image_id_min is not None:
+            clauses.append(f"{column} >= ?")
+            params.append(self.image_id_min)
+        if self.image_id_max is not None:
+            clauses.append(f"{column} <= ?")
+            params.append(self.image_id_max)
+        for tag in self.tags:
+            clauses.append(f"{column} IN (SELECT image_id FROM image_tags WHERE tag = ?)")
+            params.append(tag)
+        return clauses, params
+
+
+def match_expression(query):
+    """FTS5 query matching any of the query's words (quoted, so operators in user text are literal)."""
+    return " OR ".join(f'"{term}"' for term in re.findall(r"\w+", query.lower()))
+
+
+class CaptionStore:
+    """SQLite table of (annotation_id, image_id, caption) rows, safe to share across threads."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "annotation_id TEXT PRIMARY KEY, image_id TEXT NOT NULL, caption TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS captions_image_id ON captions(image_id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS images (image_id INTEGER PRIMARY KEY, split TEXT)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS image_tags ("
+                "tag TEXT NOT NULL, image_id INTEGER NOT NULL, PRIMARY KEY (tag, image_id)) WITHOUT ROWID"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS image_tags_image_id ON image_tags(image_id)")
+            exists = self._conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'caption_index'"
+            ).fetchone()
+            if not exists:
+                # One FTS document per image, keyed by the numeric image_id; sidecars written
+                # before the index existed are indexed from their caption rows once
+                self._conn.execute("CREATE VIRTUAL TABLE caption_index USING fts5(captions)")
+                self._conn.execute(
+                    "INSERT INTO caption_index (rowid, captions) "
+                    "SELECT CAST(image_id AS INTEGER), group_concat(caption, ' ') FROM captions GROUP BY image_id"
+                )
+
+    def replace_captions(self, captions_by_image):
+        """Replace the captions of each image in {image_id: [(annotation_id, caption), ...]}."""
+        with self._lock, self._conn:
+            for image_id, captions in captions_by_image.items():
+                self._conn.execute("DELETE FROM captions WHERE image_id = ?", (str(image_id),))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO captions (annotation_id, image_id, caption) VALUES (?, ?, ?)",
+                    [(str(annotation_id), str(image_id), caption) for annotation_id, caption in captions]
+                )
+                self._conn.execute("DELETE FROM caption_index WHERE rowid = ?", (int(image_id),))
+                if captions:
+                    self._conn.execute(
+                        "INSERT INTO caption_index (rowid, captions) VALUES (?, ?)",
+                        (int(image_id), " ".join(caption for _, caption in captions))
+                    )
+
+    def delete_images(self, image_ids):
+        """Remove all captions of the given images."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM captions WHERE image_id = ?", [(str(i),) for i in image_ids])
+            for table, column in (("caption_index", "rowid"), ("images", "image_id"), ("image_tags", "image_id")):
+                self._conn.executemany(f"DELETE FROM {table} WHERE {column} = ?", [(int(i),) for i in image_ids])
+
+    def get_captions(self, image_ids):
+        """Return {image_id: [caption, ...]} for the given images, in annotation order."""
+        image_ids = [str(i) for i in image_ids]
+        result = {image_id: [] for image_id in image_ids}
+        if not image_ids:
+            return result
+        placeholders = ",".join("?" * len(image_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT image_id, caption FROM captions WHERE image_id IN ({placeholders}) "
+                "ORDER BY image_id, CAST(annotation_id AS INTEGER)",
+                image_ids
+            ).fetchall()
+        for image_id, caption in rows:
+            result[image_id].append(caption)
+        return result
+
+    def first_captions(self, image_ids):
+        """Return {image_id: caption} with one representative caption per image ('' if none)."""
+        return {image_id: (captions[0] if captions else "")
+                for image_id, captions in self.get_captions(image_ids).items()}
+
+    def sync_metadata(self, metadata_by_image):
+        """
+        Store {image_id: (split, tags)} for filtering, rewriting only images whose split or
+        tags changed. Returns the number of images written.
+        """
+        with self._lock:
+            splits = dict(self._conn.execute("SELECT image_id, split FROM images"))
+            tags = {}
+            for tag, image_id in self._conn.execute("SELECT tag, image_id FROM image_tags"):
+                tags.setdefault(image_id, set()).add(tag)
+        changed = [(int(image_id), split, set(image_tags)) for image_id, (split, image_tags) in metadata_by_image.items()
+                   if splits.get(int(image_id), "") != split or tags.get(int(image_id), set()) != set(image_tags)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO images (image_id, split) VALUES (?, ?)",
+                                   [(image_id, split) for image_id, split, _ in changed])
+            self._conn.executemany("DELETE FROM image_tags WHERE image_id = ?", [(image_id,) for image_id, _, _ in changed])
+            self._conn.executemany("INSERT INTO image_tags (tag, image_id) VALUES (?, ?)",
+                                   [(tag, image_id) for image_id, _, image_tags in changed for tag in image_tags])
+        return len(changed)
+
+    def filter_ids(self, search_filter):
+        """Ids of the images that pass a SearchFilter, as strings."""
+        clauses, params = search_filter.sql()
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return [str(row[0]) for row in self._conn.execute(f"SELECT image_id FROM images {where}", params)]
+
+    def search_text(self, query, limit, search_filter=None):
+        """
+        BM25 keyword search over each image's captions. Returns up to `limit`
+        (image_id, score) pairs, best first (higher score = better match). The
+        filter is applied inside the query, so `limit` hits are returned whenever
+        that many matching images pass it.
+        """
+        expression = match_expression(query)
+        if not expression or limit <= 0:
+            return []
+        join, clauses, params = "", ["caption_index MATCH ?"], [expression]
+        if search_filter is not None and search_filter.active:
+            join = "JOIN images ON images.image_id = caption_index.rowid"
+            filter_clauses, filter_params = search_filter.sql()
+            clauses += filter_clauses
+            params += filter_params
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT caption_index.rowid, bm25(caption_index) FROM caption_index {join} "
+                f"WHERE {' AND '.join(clauses)} ORDER BY bm25(caption_index) LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        # SQLite's bm25() is negative (lower = better); flip it so scores read like similarities
+        return [(str(image_id), -score) for image_id, score in rows]
+
+    def clear(self):
+        """Remove every caption, e.g. when the collection is rebuilt from scratch."""
+        with self._lock, self._conn:
+            for table in ("captions", "caption_index", "images", "image_tags"):
+                self._conn.execute(f"DELETE FROM {table}")
+
+    def count(self):
+        """Number of caption rows in the sidecar."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
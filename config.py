@@ -9,22 +9,95 @@ import os
 DATA_SPLIT = 'val'  # Change to 'train' for larger dataset
 DATASET_PATH = f"data/annotations/captions_{DATA_SPLIT}2017.json"
 IMAGE_DIR = f"data/{DATA_SPLIT}2017/"
+IMAGE_TAGS_PATH = ""  # Optional tags for search filters: JSON {image_id: [tag, ...]} or a COCO instances file (categories become tags)
+ANNOTATION_CACHE_DIR = "./annotation_cache"  # SQLite copies of annotation files grouped by image (rebuilt when a file changes)
 
 # --- Model Configuration ---
 MODEL_NAME = "openai/clip-vit-base-patch32"
 DEVICE = "cuda"  # Will be set to "cpu" if CUDA not available
+MODEL_DTYPE = "auto"  # "auto" (float16 on CUDA, float32 on CPU), "float16" or "float32"
+MODEL_CACHE_DIR = "./model_cache"  # Local safetensors snapshots of MODEL_NAME (empty string disables)
+EMBEDDING_CACHE_DIR = "./embedding_cache"  # Image embeddings by (content sha1, model, preprocessing), shared across collections (empty string disables)
+EMBEDDING_PREPROCESS_VERSION = 1  # Bump when image decoding/preprocessing changes so cached embeddings are not reused
+TEXT_ENCODER = "torch"  # Query text encoder: "torch", "int8" (dynamic int8, CPU) or "onnx" (ONNX Runtime, CPU)
+TEXT_ENCODER_THREADS = 0  # Intra-op threads for the text encoder (0 = library default)
+TEXT_ENCODER_RECALL_MARGIN = 1.0  # Max Recall@K drop (points) for a backend to count as equivalent in evaluations
 
 # --- Database Configuration ---
-COLLECTION_NAME = f"image_search_{DATA_SPLIT}"
+COLLECTION_NAME = f"image_search_{DATA_SPLIT}_images"  # One vector per image
+LEGACY_COLLECTION_NAME = f"image_search_{DATA_SPLIT}"  # Old layout: one vector per caption (see migrate_index.py)
 CHROMA_DB_PATH = "./chroma_db"  # Persistent database directory
+CAPTION_DB_PATH = os.path.join(CHROMA_DB_PATH, f"{COLLECTION_NAME}_captions.sqlite3")  # Caption sidecar keyed by image_id
+HNSW_M = 16  # HNSW graph degree (ChromaDB collection and the NumPy store's hnsw index)
+HNSW_CONSTRUCTION_EF = 200  # HNSW candidate list size while building
+HNSW_SEARCH_EF = 64  # Default HNSW candidate list size per query (higher = better recall, slower)
+COLLECTION_METADATA = {  # Distance metric and HNSW parameters for the image collection
+    "hnsw:space": "cosine",
+    "hnsw:M": HNSW_M,
+    "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+    "hnsw:search_ef": HNSW_SEARCH_EF,
+}
+CHROMA_FILTER_CHUNK = 20000  # Most ids per ChromaDB filtered query (SQLite caps statement variables); larger selections are chunked
+VECTOR_STORE = "chroma"  # "chroma" or "numpy" (memory-mapped exact search, see vector_store.py)
+NUMPY_INDEX_DIR = f"./numpy_index/{COLLECTION_NAME}"  # Directory of the NumPy vector store
+NUMPY_INDEX_DTYPE = "float32"  # "float32" or "float16" storage for the NumPy store
+NUMPY_INDEX_QUANTIZATION = "none"  # "none", "fp16", "int8" or "pq": compressed codes scanned before exact re-rank
+RERANK_FACTOR = 10  # Candidates per result re-ranked with full-precision vectors (0 = codes only)
+PQ_SUBSPACES = 64  # Product-quantization subspaces (one byte per subspace per image)
+QUANTIZATION_TRAIN_SIZE = 50000  # Vectors sampled to fit int8 scales / PQ / IVF centroids
+IVF_NLIST = 0  # IVF inverted lists for the NumPy store's ANN index (0 = 4 * sqrt(images))
+IVF_NPROBE = 8  # Default IVF lists scanned per query (higher = better recall, slower)
+INGEST_MANIFEST_PATH = os.path.join(NUMPY_INDEX_DIR if VECTOR_STORE == "numpy" else CHROMA_DB_PATH, f"{COLLECTION_NAME}_manifest.jsonl")  # Committed images, for resumable ingestion
+INDEX_VERSION_PATH = os.path.join(NUMPY_INDEX_DIR if VECTOR_STORE == "numpy" else CHROMA_DB_PATH, f"{COLLECTION_NAME}_version")  # Bumped on every collection change; invalidates API caches
+
+# --- Sharding Configuration ---
+NUM_SHARDS = 1  # Local shard stores the collection is split across by image id hash (1 = one unsharded store)
+SHARD_ADDRESSES = []  # "host:port" of each shard_server.py, in shard order; when set, shards are remote and NUM_SHARDS is ignored
+SHARD_HOST = "127.0.0.1"  # Interface shard_server.py listens on
+SHARD_BASE_PORT = 7100  # shard_server.py --local serves shard i on SHARD_BASE_PORT + i
+SHARD_AUTHKEY = os.environ.get("CLIP_SHARD_AUTHKEY", "change-me").encode()  # Shared secret of shard servers and clients; must be set for non-loopback hosts (messages are pickled)
+
+# --- Thumbnail Configuration ---
+THUMBNAIL_DIR = "./thumbnails"  # Content-addressed thumbnail tier written during ingestion
+THUMBNAIL_SIZES = (256,)  # Longest side in pixels; the first size is used in search results (empty disables)
+THUMBNAIL_FORMAT = "webp"  # "webp" or "jpeg"
+THUMBNAIL_QUALITY = 80
 
 # --- API Configuration ---
 API_HOST = "127.0.0.1"
 API_PORT = 8000
 K_RESULTS = 5  # Number of search results to return
+API_WARMUP = True  # Load the model in the background at startup instead of on the first query
+SEARCH_MAX_BATCH_SIZE = 32  # Concurrent /search queries encoded in one forward pass
+SEARCH_BATCH_WAIT_MS = 5  # How long the first query of a batch waits for others to join
+EMBEDDING_CACHE_SIZE = 10000  # Normalized query text -> text embedding (LRU)
+RESULT_CACHE_SIZE = 5000  # (query, k, search params, index version) -> results (LRU)
+RESULT_CACHE_TTL = 600  # Seconds a cached result list stays valid
+IMAGE_QUERY_BATCH_SIZE = 16  # Uploaded query images encoded in one forward pass
+MAX_UPLOAD_BYTES = 10 * 2**20  # Largest accepted query image upload
+BATCH_SEARCH_CHUNK_SIZE = 256  # /search/batch queries encoded and searched per forward pass
+BATCH_SEARCH_MAX_QUERIES = 100000  # Largest accepted /search/batch request
+HYBRID_CANDIDATES = 100  # Vector and keyword hits per query fused by hybrid search
+RRF_K = 60  # Reciprocal-rank fusion constant: score = sum of 1 / (RRF_K + rank)
+TIMING_HEADER = False  # Add an X-Timing per-stage breakdown to every response (clients can also send "X-Timing: 1")
+QUERY_ENSEMBLE = False  # Default for /search?ensemble=: average each text query over QUERY_PROMPT_TEMPLATES
+QUERY_PROMPT_TEMPLATES = ("{}", "a photo of {}.", "a picture of {}.", "an image of {}.", "a close-up photo of {}.")  # "|" in a query adds sub-queries
+MMR_LAMBDA = None  # Default for ?mmr_lambda=: None skips re-ranking, 1.0 re-scores exactly, lower values diversify (MMR)
+RERANK_CANDIDATES = 50  # First-stage hits re-scored against stored vectors when re-ranking
+SEARCH_PAGE_DEPTH = 200  # Ranked hits kept per paginated / streamed search; its cursor pages through them
+RANKING_CACHE_SIZE = 1000  # Cursor token -> ranked hit list (LRU)
+RANKING_CACHE_TTL = 1800  # Seconds a cursor stays valid
+STREAM_CHUNK_SIZE = 5  # Streamed /search results hydrated and sent per chunk
+INFERENCE_SOCKET_PATH = "/tmp/clip-search-inference.sock"  # Unix socket of inference_server.py (run_search_engine.py --workers)
+INFERENCE_SOCKET = os.environ.get("CLIP_INFERENCE_SOCKET", "")  # Set in API workers: encode through the inference server instead of loading the model
 
 # --- Processing Configuration ---
-BATCH_SIZE = 50  # Batch size for data ingestion
+BATCH_SIZE = 50  # Rows per ChromaDB insert during ingestion
+INFERENCE_BATCH_SIZE = 32  # Images per get_image_features forward pass
+NUM_DECODE_WORKERS = os.cpu_count() or 1  # Workers decoding and preprocessing images
+DECODE_POOL = "process"  # "process" or "thread" pool for image decoding
+WRITE_QUEUE_SIZE = 8  # Embedded batches buffered ahead of the ChromaDB writer
+EVAL_BATCH_SIZE = 256  # Captions per text-encoder forward pass in evaluate_model.py
 
 # --- Path Configuration ---
 def get_relative_image_path(image_filename):
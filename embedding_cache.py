@@ -0,0 +1,168 @@
+"""
+Content-addressed cache of image embeddings, shared by every collection.
+
+An image's embedding only depends on its bytes, the model and the preprocessing, so
+it is keyed by (sha1 of the image file, MODEL_NAME, EMBEDDING_PREPROCESS_VERSION).
+Each model / preprocessing pair has its own directory under EMBEDDING_CACHE_DIR:
+
+    meta.json     model name, preprocessing version and embedding width
+    vectors.f32   float32 rows, appended
+    index.bin     20-byte sha1 digest of row i at offset 20 * i, appended after its row
+
+A row counts only once its digest is in the index, so an append interrupted by a
+crash leaves an unindexed tail that is truncated by the next writer. Several
+processes (concurrent ingests into different collections) can share a cache:
+appends hold an flock on `lock`, first pick up rows other processes appended and
+number new rows from the on-disk index size. Re-creating a
+collection (new DATA_SPLIT, COLLECTION_NAME or store layout) then reads vectors
+from here instead of running CLIP again.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+from contextlib import contextmanager
+from config import *
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking, so one writer at a time
+    fcntl = None
+
+_DIGEST_BYTES = 20
+
+
+class EmbeddingCache:
+    """Append-only sha1 -> embedding map for one model and preprocessing version."""
+
+    def __init__(self, directory=EMBEDDING_CACHE_DIR, model_name=MODEL_NAME, preprocess_version=EMBEDDING_PREPROCESS_VERSION):
+        self.model_name = model_name
+        self.preprocess_version = preprocess_version
+        self.directory = os.path.join(directory, f"{model_name.replace('/', '--')}-p{preprocess_version}")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.index_path = os.path.join(self.directory, "index.bin")
+        self.lock_path = os.path.join(self.directory, "lock")
+        self.dim = None
+        self._rows = {}  # hex digest -> row
+        self._indexed = 0  # Index entries read so far (rows on disk, duplicates included)
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._load()
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock against writers in other processes."""
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.lock_path, 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load(self):
+        if not os.path.exists(self.meta_path):
+            return
+        with self._file_lock():
+            self._read_meta()
+            self._read_index_tail()
+            self._truncate()
+
+    def _read_meta(self):
+        with open(self.meta_path, 'r') as f:
+            self.dim = json.load(f)['dim']
+
+    def _read_index_tail(self):
+        """Pick up index entries appended since the last read (by this or another process)."""
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, 'rb') as f:
+            f.seek(self._indexed * _DIGEST_BYTES)
+            tail = f.read()
+        for i in range(len(tail) // _DIGEST_BYTES):
+            self._rows.setdefault(tail[i * _DIGEST_BYTES:(i + 1) * _DIGEST_BYTES].hex(), self._indexed + i)
+        self._indexed += len(tail) // _DIGEST_BYTES
+
+    def _truncate(self):
+        """Drop a torn tail left by an interrupted append (only called under the file lock)."""
+        for path, row_bytes in ((self.index_path, _DIGEST_BYTES), (self.vectors_path, 4 * self.dim)):
+            if os.path.exists(path) and os.path.getsize(path) > self._indexed * row_bytes:
+                with open(path, 'r+b') as f:
+                    f.truncate(self._indexed * row_bytes)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, digest):
+        return digest in self._rows
+
+    def digests(self):
+        """Every cached digest (hex), e.g. for decode workers to skip known images."""
+        with self._lock:
+            if self.dim is None and os.path.exists(self.meta_path):
+                self._read_meta()
+            self._read_index_tail()
+            return set(self._rows)
+
+    def get(self, digests):
+        """(n, dim) float32 embeddings for hex digests that are all in the cache."""
+        with self._lock:
+            rows = [self._rows[digest] for digest in digests]
+            if not rows:
+                return np.empty((0, self.dim or 0), dtype=np.float32)
+            if self._matrix is None or max(rows) >= len(self._matrix):
+                self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r').reshape(-1, self.dim)
+            return np.array(self._matrix[rows], dtype=np.float32).reshape(len(rows), self.dim)
+
+    def put(self, digests, embeddings):
+        """Append embeddings for digests not cached yet. Returns the number of rows added."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        with self._lock, self._file_lock():
+            if self.dim is None and os.path.exists(self.meta_path):
+                self._read_meta()  # Created by another process since this one opened the cache
+            if self.dim is None:
+                self.dim = embeddings.shape[1]
+                tmp_path = f"{self.meta_path}.tmp-{os.getpid()}"
+                with open(tmp_path, 'w') as f:
+                    json.dump({"model": self.model_name, "preprocess_version": self.preprocess_version, "dim": self.dim}, f)
+                os.replace(tmp_path, self.meta_path)
+            # Rows other processes appended come first; rows are numbered from the index on disk
+            self._read_index_tail()
+            self._truncate()
+            new = {}
+            for digest, embedding in zip(digests, embeddings):
+                if digest and digest not in self._rows and digest not in new:
+                    new[digest] = embedding
+            if not new:
+                return 0
+            # Vectors first: an index entry is only written once its row is durable
+            for path, data in ((self.vectors_path, np.stack(list(new.values())).tobytes()),
+                               (self.index_path, b"".join(bytes.fromhex(digest) for digest in new))):
+                with open(path, 'ab') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+            for digest in new:
+                self._rows[digest] = self._indexed
+                self._indexed += 1
+            return len(new)
+
+
+def open_embedding_cache():
+    """The embedding cache for the configured model, or None if EMBEDDING_CACHE_DIR is empty."""
+    return EmbeddingCache() if EMBEDDING_CACHE_DIR else None
+
+
+def cache_store_embeddings(cache, store, digests_by_image, batch_size=10000):
+    """Add a store's embeddings to the cache, for images whose content digest is known. Returns rows added."""
+    added = 0
+    for ids, embeddings, _ in store.iter_batches(batch_size):
+        known = [(digests_by_image[image_id], position) for position, image_id in enumerate(ids)
+                 if digests_by_image.get(image_id)]
+        if known:
+            added += cache.put([digest for digest, _ in known], np.asarray(embeddings)[[p for _, p in known]])
+    return added
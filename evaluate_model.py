@@ -1,65 +1,299 @@
-import torch
-import json
-import os
-from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-import chromadb
+import time
+import argparse
+import numpy as np
+import runtime
+from text_encoder import make_text_encoder, expand_query, encode_ensembles
+from annotations import AnnotationCache
+from vector_store import normalize, scan_top_k
+from quantization import QuantizedIndex, make_codec
 from config import *
 
 # --- Configuration ---
-device = "cuda" if torch.cuda.is_available() else "cpu"
 K = 10  # Set the value for K (e.g., top 10 results)
+RECALL_KS = (1, 5, 10)
+QUANTIZATION_MODES = ["none", "fp16", "int8", "pq"]
 
-# --- Load Pre-trained CLIP Model ---
-print("Loading CLIP model for evaluation...")
-model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-
-# --- Initialize ChromaDB Client ---
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-collection = client.get_collection(name=COLLECTION_NAME)
-
-# --- Load COCO annotations for ground truth ---
-with open(DATASET_PATH, 'r') as f:
-    coco_data = json.load(f)
-
-print("Starting evaluation...")
-hits = 0
-total_queries = 0
-
-for item in coco_data['annotations']:
-    # Get the image ID from the annotation for ground-truth comparison
-    ground_truth_image_id = str(item['image_id'])
-    caption = item['caption']
-    
-    # Generate the embedding for the text query
-    inputs = processor(text=[caption], return_tensors="pt", padding=True).to(device)
-    with torch.no_grad():
-        text_embedding = model.get_text_features(**inputs).cpu().numpy().tolist()[0]
-
-    # Perform a search in the vector database
-    results = collection.query(
-        query_embeddings=[text_embedding],
-        n_results=K,
-        # Now include metadata to get the image_id
-        include=['metadatas']
-    )
-
-    # Check if the original image ID is in the search results
-    retrieved_metadata = results['metadatas'][0]
-    retrieved_image_ids = [meta['image_id'] for meta in retrieved_metadata]
-    
-    if ground_truth_image_id in retrieved_image_ids:
-        hits += 1
-
-    total_queries += 1
-    
-    if total_queries % 100 == 0:
-        print(f"Processed {total_queries} queries. Current Recall@{K}: {(hits / total_queries) * 100:.2f}%")
-
-# --- Final Results ---
-final_recall = (hits / total_queries) * 100 if total_queries > 0 else 0
-print("\n--- Final Evaluation Results ---")
-print(f"Total queries: {total_queries}")
-print(f"Successful retrievals (hits): {hits}")
-print(f"Final Recall@{K}: {final_recall:.2f}%")
\ No newline at end of file
+
+def encode_captions(captions, batch_size=EVAL_BATCH_SIZE):
+    """Encode captions in large batches. Returns an (n, dim) float32 array of L2-normalized embeddings."""
+    embeddings = []
+    for start in range(0, len(captions), batch_size):
+        embeddings.append(runtime.encode_text(captions[start:start + batch_size]))
+        done = min(start + batch_size, len(captions))
+        if done // batch_size % 20 == 0 or done == len(captions):
+            print(f"Encoded {done}/{len(captions)} captions...")
+    return normalize(np.concatenate(embeddings)) if embeddings else np.zeros((0, 0), dtype=np.float32)
+
+
+def load_image_matrix(store):
+    """All stored image vectors as one normalized matrix, with the image_id of every row."""
+    batches = list(store.iter_batches())
+    if not batches:
+        return np.zeros((0, 0), dtype=np.float32), np.array([], dtype=str)
+    matrix = normalize(np.concatenate([embeddings for _, embeddings, _ in batches]))
+    image_ids = np.array([meta['image_id'] for _, _, metadatas in batches for meta in metadatas])
+    return matrix, image_ids
+
+
+def ground_truth_ranks(text_embeddings, matrix, image_ids, ground_truth_ids, block_rows=1024):
+    """
+    1-based rank of each caption's ground-truth image among all images, from batched
+    caption x image similarity products. Captions whose image is not indexed get rank inf.
+    """
+    column_of = {image_id: column for column, image_id in enumerate(image_ids)}
+    columns = np.array([column_of.get(image_id, -1) for image_id in ground_truth_ids], dtype=np.int64)
+    ranks = np.full(len(columns), np.inf)
+    for start in range(0, len(columns), block_rows):
+        block_columns = columns[start:start + block_rows]
+        indexed = np.flatnonzero(block_columns >= 0)
+        if len(indexed) == 0:
+            continue
+        scores = text_embeddings[start:start + block_rows][indexed] @ matrix.T
+        target = scores[np.arange(len(indexed)), block_columns[indexed]]
+        ranks[start + indexed] = (scores > target[:, None]).sum(axis=1) + 1
+    return ranks
+
+
+def retrieval_metrics(ranks, ks=RECALL_KS):
+    """Recall@k (in %), median rank and mean reciprocal rank from ground-truth ranks."""
+    if len(ranks) == 0:
+        return {}
+    metrics = {f"R@{k}": float((ranks <= k).mean() * 100) for k in ks}
+    metrics["median_rank"] = float(np.median(ranks))
+    metrics["MRR"] = float((1.0 / ranks).mean())
+    return metrics
+
+
+def store_recall(store, text_embeddings, ground_truth_ids, k=K, batch_size=EVAL_BATCH_SIZE, **search_params):
+    """Recall@k (in %) of the served index (codes, ANN), querying it in multi-vector batches."""
+    hits = 0
+    for start in range(0, len(text_embeddings), batch_size):
+        results = store.query(text_embeddings[start:start + batch_size], k, **search_params)
+        for hits_for_query, ground_truth_image_id in zip(results, ground_truth_ids[start:start + batch_size]):
+            if ground_truth_image_id in [hit['metadata']['image_id'] for hit in hits_for_query]:
+                hits += 1
+    return hits / max(len(text_embeddings), 1) * 100
+
+
+def sample_annotations(annotations, sample, seed=0):
+    """A reproducible random subset of `sample` (image_id, caption) pairs from an AnnotationCache (all if sample is 0)."""
+    total = annotations.annotation_count()
+    if not sample or sample >= total:
+        return annotations.annotations()
+    picked = np.random.default_rng(seed).choice(total, size=sample, replace=False)
+    return annotations.annotations(np.sort(picked).tolist())
+
+
+def quantization_report(matrix, image_ids, text_embeddings, ground_truth_ids):
+    """Compare Recall@K, index memory and per-query latency of every quantization mode."""
+    if len(matrix) == 0:
+        print("Vector store is empty - nothing to compare.")
+        return
+    queries = text_embeddings
+    full_bytes = matrix.nbytes
+
+    print(f"\n--- Quantization Report (Recall@{K}, {len(matrix)} images, {len(queries)} queries) ---")
+    print(f"{'mode':<6} {'recall@' + str(K):>10} {'index MiB':>10} {'vs fp32':>8} {'ms/query':>9}")
+    for mode in QUANTIZATION_MODES:
+        if mode == "none":
+            search = lambda q: scan_top_k(lambda start, end: q @ matrix[start:end].T, len(matrix), K)
+            index_bytes = full_bytes
+        else:
+            sample = matrix[np.random.default_rng(0).choice(len(matrix), min(QUANTIZATION_TRAIN_SIZE, len(matrix)), replace=False)]
+            codec = make_codec(mode).fit(sample)
+            index = QuantizedIndex(codec, codec.encode(matrix), matrix)
+            search = lambda q, index=index: index.search(q, K)
+            index_bytes = index.nbytes()
+
+        hits = 0
+        start = time.perf_counter()
+        for query, ground_truth_image_id in zip(queries, ground_truth_ids):
+            _, rows = search(query[None, :])
+            if ground_truth_image_id in image_ids[rows[0]]:
+                hits += 1
+        latency_ms = (time.perf_counter() - start) * 1000 / max(len(queries), 1)
+        recall = hits / max(len(queries), 1) * 100
+        print(f"{mode:<6} {recall:>9.2f}% {index_bytes / 2**20:>10.1f} {full_bytes / index_bytes:>7.1f}x {latency_ms:>9.3f}")
+
+
+def ann_report(store, text_embeddings, ground_truth_ids, nprobes=(), ef_searches=()):
+    """Sweep the NumPy store's IVF nprobe / HNSW ef_search and report Recall@K and per-query latency."""
+    settings = [("nprobe", value) for value in nprobes] + [("ef_search", value) for value in ef_searches]
+    if not settings:
+        return
+    if getattr(store, "ann", None) is None:
+        print("No ANN index on this store - build one with `python build_index.py --ann ivf|hnsw --in-place`.")
+        return
+
+    print(f"\n--- ANN Report ({store.ann.kind}, Recall@{K}, {len(text_embeddings)} queries) ---")
+    print(f"{'setting':<16} {'recall@' + str(K):>10} {'ms/query':>9}")
+    for name, value in settings:
+        hits = 0
+        start = time.perf_counter()
+        for query, ground_truth_image_id in zip(text_embeddings, ground_truth_ids):
+            results = store.query(query[None, :], K, **{name: value})[0]
+            if ground_truth_image_id in [hit['metadata']['image_id'] for hit in results]:
+                hits += 1
+        latency_ms = (time.perf_counter() - start) * 1000 / max(len(text_embeddings), 1)
+        recall = hits / max(len(text_embeddings), 1) * 100
+        print(f"{name + '=' + str(value):<16} {recall:>9.2f}% {latency_ms:>9.3f}")
+
+
+def text_encoder_report(backends, captions, matrix, image_ids, ground_truth_ids, batch_size=EVAL_BATCH_SIZE):
+    """
+    Compare text-encoder backends against the stock PyTorch model: embedding cosine
+    parity, single-query and batched latency, and exact-search Recall@1/5/10. Recommends
+    the fastest backend whose Recall@K is within TEXT_ENCODER_RECALL_MARGIN of torch.
+    """
+    if len(matrix) == 0:
+        print("Vector store is empty - nothing to compare.")
+        return
+    reference = None
+    rows = []
+    for name in ["torch"] + [backend for backend in backends if backend != "torch"]:
+        try:
+            encoder = make_text_encoder(name)
+        except ImportError as e:
+            print(f"Skipping {name}: {e}")
+            continue
+        encoder.encode(captions[:1])  # warm-up
+
+        start = time.perf_counter()
+        embeddings = normalize(np.concatenate([encoder.encode(captions[i:i + batch_size])
+                                               for i in range(0, len(captions), batch_size)]))
+        batch_ms = (time.perf_counter() - start) * 1000 / len(captions)
+
+        single = captions[:min(len(captions), 200)]
+        start = time.perf_counter()
+        for caption in single:
+            encoder.encode([caption])
+        single_ms = (time.perf_counter() - start) * 1000 / len(single)
+
+        if reference is None:
+            reference = embeddings
+        cosine = (embeddings * reference).sum(axis=1)
+        metrics = retrieval_metrics(ground_truth_ranks(embeddings, matrix, image_ids, ground_truth_ids))
+        rows.append((name, cosine, single_ms, batch_ms, metrics))
+
+    print(f"\n--- Text Encoder Report ({len(captions)} captions, {TEXT_ENCODER_THREADS or 'default'} threads) ---")
+    print(f"{'backend':<8} {'min cos':>8} {'mean cos':>9} {'ms/query':>9} {'ms/caption@batch':>17} "
+          + " ".join(f"{'R@' + str(k):>7}" for k in RECALL_KS))
+    for name, cosine, single_ms, batch_ms, metrics in rows:
+        print(f"{name:<8} {cosine.min():>8.4f} {cosine.mean():>9.4f} {single_ms:>9.2f} {batch_ms:>17.3f} "
+              + " ".join(f"{metrics[f'R@{k}']:>6.2f}%" for k in RECALL_KS))
+
+    baseline = rows[0][4][f"R@{K}"]
+    eligible = [row for row in rows if baseline - row[4][f"R@{K}"] <= TEXT_ENCODER_RECALL_MARGIN]
+    best = min(eligible, key=lambda row: row[2])
+    print(f"Fastest backend within {TEXT_ENCODER_RECALL_MARGIN} points of torch Recall@{K}: {best[0]} "
+          f"(set TEXT_ENCODER = \"{best[0]}\" in config.py)")
+
+
+def ensemble_report(captions, text_embeddings, matrix, image_ids, ground_truth_ids, batch_size=EVAL_BATCH_SIZE):
+    """
+    Prompt-ensembled queries (QUERY_PROMPT_TEMPLATES) against plain ones: exact-search
+    Recall@1/5/10 and MRR, and single-query latency with all variants in one forward pass.
+    """
+    if len(matrix) == 0:
+        print("Vector store is empty - nothing to compare.")
+        return
+    variants = len(expand_query("x"))
+    step = max(1, batch_size // variants)  # Captions per forward pass, so each pass still holds ~batch_size texts
+    ensembled = np.concatenate([encode_ensembles(runtime.encode_text, captions[i:i + step])
+                                for i in range(0, len(captions), step)])
+
+    single = captions[:min(len(captions), 200)]
+    latencies = {}
+    for name, encode in (("plain", lambda caption: runtime.encode_text([caption])),
+                         ("ensemble", lambda caption: encode_ensembles(runtime.encode_text, [caption]))):
+        encode(single[0])  # warm-up
+        start = time.perf_counter()
+        for caption in single:
+            encode(caption)
+        latencies[name] = (time.perf_counter() - start) * 1000 / len(single)
+
+    print(f"\n--- Prompt Ensemble Report ({len(captions)} captions, {variants} variants per query) ---")
+    print(f"{'queries':<9} {'ms/query':>9} " + " ".join(f"{'R@' + str(k):>7}" for k in RECALL_KS) + f" {'MRR':>7}")
+    rows = {}
+    for name, embeddings in (("plain", text_embeddings), ("ensemble", ensembled)):
+        rows[name] = retrieval_metrics(ground_truth_ranks(embeddings, matrix, image_ids, ground_truth_ids))
+        print(f"{name:<9} {latencies[name]:>9.2f} " + " ".join(f"{rows[name][f'R@{k}']:>6.2f}%" for k in RECALL_KS)
+              + f" {rows[name]['MRR']:>7.4f}")
+    gain = rows["ensemble"][f"R@{K}"] - rows["plain"][f"R@{K}"]
+    print(f"Ensemble Recall@{K} {gain:+.2f} points for {latencies['ensemble'] / latencies['plain']:.2f}x single-query latency "
+          f"(enable with QUERY_ENSEMBLE = True or /search?ensemble=true)")
+
+
+def parse_list(value):
+    """Parse a comma-separated list of names, e.g. "torch,int8,onnx"."""
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+
+def parse_int_list(value):
+    """Parse a comma-separated list of integers, e.g. "1,4,16,64"."""
+    return [int(part) for part in value.split(",") if part.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate text-to-image retrieval (Recall@1/5/10, median rank, MRR) on the COCO captions.")
+    parser.add_argument("--sample", type=int, default=0,
+                        help="Evaluate a random sample of N captions instead of all of them (quick runs)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for --sample")
+    parser.add_argument("--batch-size", type=int, default=EVAL_BATCH_SIZE, help="Captions per text-encoder forward pass")
+    parser.add_argument("--quantization-report", action="store_true",
+                        help="Also compare fp16/int8/pq codes (with re-ranking) against exact search")
+    parser.add_argument("--text-encoders", type=parse_list, default=[],
+                        help="Compare text-encoder backends, e.g. torch,int8,onnx (parity, latency, recall)")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="Compare prompt-ensembled queries (QUERY_PROMPT_TEMPLATES) with plain ones: recall and latency")
+    parser.add_argument("--nprobe", type=parse_int_list, default=[],
+                        help="IVF nprobe values to sweep, e.g. 1,4,16,64 (NumPy store with an IVF index)")
+    parser.add_argument("--ef-search", type=parse_int_list, default=[],
+                        help="HNSW ef_search values to sweep, e.g. 16,64,256 (NumPy store with an HNSW index)")
+    args = parser.parse_args()
+
+    # --- Load Pre-trained CLIP Model and open the Vector Store ---
+    runtime.warmup()
+    store = runtime.get_store()
+    print(f"Evaluating {store.name} vector store '{COLLECTION_NAME}' with {store.count()} images.")
+    matrix, image_ids = load_image_matrix(store)
+
+    # --- Load COCO annotations for ground truth ---
+    annotations = sample_annotations(AnnotationCache(DATASET_PATH), args.sample, args.seed)
+    ground_truth_ids = [str(image_id) for image_id, _ in annotations]
+    captions = [caption for _, caption in annotations]
+
+    print(f"Starting evaluation on {len(annotations)} captions...")
+    start = time.perf_counter()
+    text_embeddings = encode_captions(captions, args.batch_size)
+    encode_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    metrics = retrieval_metrics(ground_truth_ranks(text_embeddings, matrix, image_ids, ground_truth_ids)) if len(matrix) else {}
+    rank_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index_recall = store_recall(store, text_embeddings, ground_truth_ids)
+    index_seconds = time.perf_counter() - start
+
+    # --- Final Results ---
+    print("\n--- Final Evaluation Results ---")
+    print(f"Total queries: {len(ground_truth_ids)} captions against {len(matrix)} images")
+    if metrics:
+        print("Exact search: " + ", ".join(f"R@{k} {metrics[f'R@{k}']:.2f}%" for k in RECALL_KS)
+              + f", median rank {metrics['median_rank']:g}, MRR {metrics['MRR']:.4f}")
+    print(f"Served {store.name} index: Recall@{K} {index_recall:.2f}%")
+    print(f"Timing: encode {encode_seconds:.1f}s, rank {rank_seconds:.1f}s, index queries {index_seconds:.1f}s")
+
+    if args.quantization_report:
+        quantization_report(matrix, image_ids, text_embeddings, ground_truth_ids)
+    ann_report(store, text_embeddings, ground_truth_ids, args.nprobe, args.ef_search)
+    if args.text_encoders:
+        text_encoder_report(args.text_encoders, captions,
+                            matrix, image_ids, ground_truth_ids, args.batch_size)
+    if args.ensemble:
+        ensemble_report(captions, text_embeddings, matrix, image_ids, ground_truth_ids, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
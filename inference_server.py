@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Local inference server: one process owns the CLIP model for every API worker on a node.
+
+With `run_search_engine.py --workers N`, N uvicorn worker processes serve HTTP and
+query the vector store, while text and image encoding goes to this process over a
+Unix socket (INFERENCE_SOCKET). The model is loaded once instead of N times, and
+its threads have the CPU to themselves. Calls arriving from different workers
+within SEARCH_BATCH_WAIT_MS are merged into one forward pass per input kind, on
+top of the micro-batching each worker already does.
+
+Usage:
+    python inference_server.py --socket /tmp/clip-search-inference.sock
+"""
+
+import os
+import sys
+import time
+import signal
+import queue
+import argparse
+import threading
+import numpy as np
+from multiprocessing.connection import Client, Listener
+import runtime
+from config import *
+
+_SERVER_METHODS = {"encode_text", "encode_images", "model_loaded"}
+
+
+class InferenceClient:
+    """Connection from an API worker to the inference server (one call at a time)."""
+
+    def __init__(self, address):
+        self.address = address
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def call(self, method, *args):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(self.address, family="AF_UNIX")
+                    self._conn.send((method, args))
+                    status, value = self._conn.recv()
+                    break
+                except (EOFError, OSError):
+                    # The inference server restarted: reconnect once, then give up
+                    self._conn = None
+                    if attempt:
+                        raise
+        if status == "error":
+            raise RuntimeError(f"Inference server failed: {value}")
+        return value
+
+
+class CrossWorkerBatcher:
+    """
+    Thread-side micro-batcher: encode calls queued within `max_wait_ms` of each other
+    (up to `max_batch_size` inputs) run as one forward pass per method.
+    """
+
+    def __init__(self, max_batch_size=SEARCH_MAX_BATCH_SIZE, max_wait_ms=SEARCH_BATCH_WAIT_MS):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, name="inference", daemon=True).start()
+
+    def submit(self, method, inputs):
+        """Encode `inputs` with `method` ("encode_text" or "encode_images"); blocks until done."""
+        call = {"method": method, "inputs": list(inputs), "done": threading.Event()}
+        self._queue.put(call)
+        call["done"].wait()
+        if "error" in call:
+            raise call["error"]
+        return call["result"]
+
+    def _collect(self):
+        calls = [self._queue.get()]
+        size = len(calls[0]["inputs"])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                call = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            calls.append(call)
+            size += len(call["inputs"])
+        return calls
+
+    def _run(self):
+        while True:
+            calls = self._collect()
+            for method in {call["method"] for call in calls}:
+                group = [call for call in calls if call["method"] == method]
+                try:
+                    outputs = getattr(runtime, method)([item for call in group for item in call["inputs"]])
+                    offsets = np.cumsum([0] + [len(call["inputs"]) for call in group])
+                    for call, start, end in zip(group, offsets[:-1], offsets[1:]):
+                        call["result"] = outputs[start:end]
+                except Exception as e:
+                    for call in group:
+                        call["error"] = e
+                for call in group:
+                    call["done"].set()
+
+
+def _serve_connection(conn, batcher):
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except EOFError:
+                return
+            try:
+                if method not in _SERVER_METHODS:
+                    raise AttributeError(f"Unknown inference method: {method}")
+                result = runtime.model_loaded() if method == "model_loaded" else batcher.submit(method, *args)
+                conn.send(("ok", result))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def serve(address, warmup=True):
+    """Serve encode calls on a Unix socket until interrupted, one thread per API worker connection."""
+    runtime.use_inference_server("")  # This process runs the model itself
+    if os.path.exists(address):
+        os.remove(address)  # Stale socket from a previous run
+    batcher = CrossWorkerBatcher()
+    if warmup:
+        runtime.warmup(store=False)  # Before listening, so the socket appearing means "ready"
+    # Messages are pickled: the socket is created owner-only, with no window before a chmod
+    umask = os.umask(0o077)
+    try:
+        listener = Listener(address, family="AF_UNIX")
+    finally:
+        os.umask(umask)
+    with listener:
+        print(f"🧠 Inference server for {MODEL_NAME} listening on {address}")
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=_serve_connection, args=(conn, batcher), daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve CLIP text and image encoding to local API workers.")
+    parser.add_argument("--socket", default=INFERENCE_SOCKET_PATH, help="Unix socket path to listen on")
+    parser.add_argument("--no-warmup", action="store_true", help="Load the model on the first request instead of at startup")
+    args = parser.parse_args()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # Remove the socket when stopped
+    try:
+        serve(args.socket, warmup=not args.no_warmup)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
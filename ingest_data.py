@@ -1,135 +1,628 @@
-import torch
 import os
+import io
 import json
+import queue
+import hashlib
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
-from transformers import CLIPProcessor, CLIPModel
-import chromadb
+import runtime
+import metrics
+from metrics import span
+from captions import CaptionStore
+from annotations import AnnotationCache, iter_json_arrays
+from thumbnails import ThumbnailStore, write_thumbnails, thumbnail_path
+from embedding_cache import open_embedding_cache
+from cache import IndexVersion
+from vector_store import open_vector_store
 from config import *
 
-# --- Configuration ---
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-# --- Load Pre-trained CLIP Model ---
-print("Loading pre-trained CLIP model...")
-model = CLIPModel.from_pretrained(MODEL_NAME).to(device)
-processor = CLIPProcessor.from_pretrained(MODEL_NAME)
-print("CLIP model loaded.")
-
-# --- Initialize ChromaDB Client ---
-client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-collection_exists = False
-
-try:
-    collection = client.get_collection(name=COLLECTION_NAME)
-    doc_count = collection.count()
-    print(f"✅ Collection '{COLLECTION_NAME}' already exists with {doc_count} documents.")
-    print("🚀 Skipping ingestion - database is ready to use!")
-    collection_exists = True
-except Exception:
-    # If the collection does not exist, create it
-    collection = client.get_or_create_collection(name=COLLECTION_NAME)
-    print(f"📦 ChromaDB collection '{COLLECTION_NAME}' created. Starting ingestion...")
-
-# Only run ingestion if the collection did not already exist
-if not collection_exists:
-    # --- Load COCO annotations and prepare data ---
-    with open(DATASET_PATH, 'r') as f:
-        coco_data = json.load(f)
+# Image processor used inside the decode workers (one per process)
+_image_processor = None
+# Content digests whose embeddings are in the embedding cache (decode workers skip them)
+_cached_digests = frozenset()
 
-    print("Starting data ingestion...")
 
-    # Lists to hold data for batch processing
-    batch_embeddings = []
-    batch_documents = []
-    batch_metadatas = []
-    batch_ids = []
+# --- Checkpoint Manifest ---
+class IngestManifest:
+    """
+    Append-only JSONL log of images whose rows are committed to the vector store.
+    Each line records the image's file fingerprint and annotation ids; the last
+    line for an image wins, so an interrupted run can be resumed at batch boundaries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.images = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # Torn last line from an interrupted run
+                    if entry.get('deleted'):
+                        self.images.pop(entry['image_id'], None)
+                    else:
+                        self.images[entry['image_id']] = entry
+
+    def _append(self, entries):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def record(self, entries):
+        """Mark images as committed. Call only after their rows are in the vector store."""
+        self._append(entries)
+        for entry in entries:
+            self.images[entry['image_id']] = entry
+
+    def forget(self, image_ids):
+        """Mark images as removed from the vector store."""
+        self._append([{'image_id': image_id, 'deleted': True} for image_id in image_ids])
+        for image_id in image_ids:
+            self.images.pop(image_id, None)
+
+    def reset(self):
+        """Drop the manifest, e.g. when the vector store is rebuilt from scratch."""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.images = {}
+
+
+def scan_image_dir(directory=IMAGE_DIR):
+    """Names of the files in IMAGE_DIR, from one directory scan instead of a lookup per image."""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name for entry in entries if entry.is_file()}
+    except FileNotFoundError:
+        return set()
+
+
+def file_fingerprint(absolute_image_path, sha1=None):
+    """Cheap change-detection key for an image file: size and mtime, plus content hash if known."""
+    stat = os.stat(absolute_image_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+
+
+def file_sha1(absolute_image_path):
+    """Content hash of an image file, used to confirm a changed mtime really changed pixels."""
+    digest = hashlib.sha1()
+    with open(absolute_image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# --- Stage 1: Decode and preprocess images in a worker pool ---
+def _init_decode_worker(model_source, cached_digests=frozenset()):
+    """Load the CLIP image processor once per decode worker."""
+    global _image_processor, _cached_digests
+    from transformers import CLIPImageProcessor
+    _image_processor = CLIPImageProcessor.from_pretrained(model_source)
+    _cached_digests = cached_digests
+
+
+def _write_thumbnails(image, sha1, absolute_image_path):
+    """Write the thumbnail tier of a decoded image; failures only cost the thumbnail."""
+    try:
+        write_thumbnails(image, sha1)
+    except Exception as e:
+        print(f"Could not write thumbnails for {absolute_image_path}: {e}")
+
+
+def _decode_image(absolute_image_path):
+    """
+    Read, hash, decode and preprocess one image into CLIP pixel values (and write its thumbnails).
+    Images whose embedding is cached are not preprocessed: pixel values are None.
+    """
+    try:
+        with open(absolute_image_path, 'rb') as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        if sha1 in _cached_digests:
+            if not all(os.path.exists(thumbnail_path(sha1, size)) for size in THUMBNAIL_SIZES):
+                _write_thumbnails(Image.open(io.BytesIO(data)).convert("RGB"), sha1, absolute_image_path)
+            return None, sha1, None
+        image = Image.open(io.BytesIO(data)).convert("RGB")
+        if THUMBNAIL_SIZES:
+            _write_thumbnails(image, sha1, absolute_image_path)
+        pixel_values = _image_processor(images=image, return_tensors="np")["pixel_values"][0]
+        return pixel_values, sha1, None
+    except Exception as e:
+        return None, None, str(e)
+
+
+def _thumbnail_image(absolute_image_path):
+    """Read, hash and decode one image only to write its thumbnails. Returns (sha1, error)."""
+    try:
+        with open(absolute_image_path, 'rb') as f:
+            data = f.read()
+        sha1 = hashlib.sha1(data).hexdigest()
+        write_thumbnails(Image.open(io.BytesIO(data)).convert("RGB"), sha1)
+        return sha1, None
+    except Exception as e:
+        return None, str(e)
 
-    # Statistics tracking
-    total_annotations = len(coco_data['annotations'])
-    processed_count = 0
-    skipped_count = 0
 
-    print(f"Starting data ingestion for {total_annotations} annotations...")
+def _make_decode_pool(cached_digests=frozenset()):
+    """Create the decode pool configured by DECODE_POOL and NUM_DECODE_WORKERS."""
+    if DECODE_POOL == "thread":
+        # Threads share one processor instance
+        _init_decode_worker(runtime.model_source(), cached_digests)
+        return ThreadPoolExecutor(max_workers=NUM_DECODE_WORKERS)
+    return ProcessPoolExecutor(max_workers=NUM_DECODE_WORKERS, initializer=_init_decode_worker,
+                               initargs=(runtime.model_source(), cached_digests))
 
-    for i, item in enumerate(coco_data['annotations']):
-        image_id = item['image_id']
-        caption = item['caption']
-        
-        # Use the unique annotation ID instead of the image ID
-        annotation_id = item['id']
 
+def iter_decoded_images(work_items, pool, window):
+    """
+    Yield (work_item, pixel_values, sha1, error) in input order.
+    At most `window` images are in flight so memory stays bounded on large splits.
+    """
+    pending = deque()
+    for item in work_items:
+        pending.append((item, pool.submit(_decode_image, item['absolute_image_path'])))
+        if len(pending) >= window:
+            item, future = pending.popleft()
+            with span("ingest_decode_wait"):
+                result = future.result()
+            yield (item,) + result
+    for item, future in pending:
+        with span("ingest_decode_wait"):
+            result = future.result()
+        yield (item,) + result
+
+
+# --- Stage 2: Batched vision-only inference ---
+def embed_pixel_batch(pixel_batch):
+    """Run one batched get_image_features pass and return L2-normalized float32 embeddings."""
+    return runtime.encode_images(pixel_batch)
+
+
+# --- Stage 3: Vector store writer overlapping inserts with compute ---
+class IndexWriter(threading.Thread):
+    """
+    Background thread that commits embedded images to the vector store in chunks of
+    BATCH_SIZE images. An image is recorded in the manifest only after its vector
+    and captions are stored, so every manifest entry is a safe resume point.
+    Each commit bumps the index version so running APIs drop their cached results.
+    """
+
+    def __init__(self, store, caption_store, thumbnail_store, manifest, index_version, max_queue_size=WRITE_QUEUE_SIZE):
+        super().__init__(daemon=True)
+        self.store = store
+        self.caption_store = caption_store
+        self.thumbnail_store = thumbnail_store
+        self.manifest = manifest
+        self.index_version = index_version
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.pending = []
+        self.committed_images = 0
+        self.error = None
+
+    def put(self, images):
+        """Queue a list of embedded image records; blocks when the writer falls behind."""
+        if self.error is not None:
+            raise RuntimeError(f"Vector store writer failed: {self.error}")
+        self.queue.put(images)
+
+    def close(self):
+        """Flush all queued images and stop the writer."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise RuntimeError(f"Vector store writer failed: {self.error}")
+
+    def _commit(self):
+        images, self.pending = self.pending, []
+        # Upsert keeps a retried batch idempotent if a previous run died before recording it
+        with span("ingest_upsert"):
+            self.store.upsert(
+                ids=[image['metadata']['image_id'] for image in images],
+                embeddings=[image['embedding'] for image in images],
+                metadatas=[image['metadata'] for image in images]
+            )
+        with span("ingest_captions"):
+            self.caption_store.replace_captions({image['metadata']['image_id']: image['captions'] for image in images})
+            self.thumbnail_store.record({image['metadata']['image_id']: image['manifest_entry']['sha1'] for image in images})
+        with span("ingest_manifest"):
+            self.manifest.record([image['manifest_entry'] for image in images])
+        self.index_version.bump()
+        self.committed_images += len(images)
+
+    def run(self):
+        while True:
+            images = self.queue.get()
+            if self.error is not None:
+                if images is None:
+                    return
+                continue  # Keep draining so the producer never blocks forever
+            try:
+                if images is None:
+                    if self.pending:
+                        self._commit()
+                    return
+                for image in images:
+                    self.pending.append(image)
+                    if len(self.pending) >= BATCH_SIZE:
+                        self._commit()
+            except Exception as e:
+                self.error = e
+                if images is None:
+                    return
+
+
+def image_metadata(image_id, image_filename):
+    """Metadata stored with each image vector; the image_id doubles as the vector id."""
+    return {
+        "image_id": str(image_id),
+        "image_path": get_relative_image_path(image_filename)  # Use relative path for web serving
+    }
+
+
+def build_image_record(item, captions, embedding, sha1):
+    """Build the single vector row of an image, its captions and its manifest entry."""
+    manifest_entry = {
+        'image_id': str(item['image_id']),
+        'ids': sorted(str(annotation_id) for annotation_id, _ in captions)
+    }
+    manifest_entry.update(item['fingerprint'])
+    manifest_entry['sha1'] = sha1
+    return {
+        'embedding': embedding,
+        'metadata': image_metadata(item['image_id'], item['image_filename']),
+        'captions': captions,
+        'manifest_entry': manifest_entry,
+    }
+
+
+def plan_ingestion(annotations, image_files, manifest, store, caption_store):
+    """
+    Split images into work that must be embedded and work that is already committed.
+    Images whose pixels are unchanged but whose captions changed only get their
+    caption sidecar rows rewritten; they are not re-embedded. Captions are streamed
+    from the annotation cache and are not kept in the work items.
+    Returns (work_items, up_to_date, refreshed, missing_images, skipped_annotations).
+    """
+    # Stores filled before the manifest existed: trust images already stored
+    existing = set()
+    if not manifest.images and store.count() > 0:
+        print("No ingest manifest found; diffing against IDs already in the vector store...")
+        existing = set(store.ids())
+
+    work_items = []
+    unchanged_pixels = {}
+    unchanged_entries = []
+    up_to_date = 0
+    refreshed = 0
+    missing_images = 0
+    skipped_count = 0
+
+    def flush_unchanged():
+        caption_store.replace_captions(unchanged_pixels)
+        manifest.record(unchanged_entries)
+        unchanged_pixels.clear()
+        unchanged_entries.clear()
+
+    for image_id, captions in annotations.iter_images():
         # Format image filename with leading zeros (e.g., 9 -> 000000000009)
         image_filename = f"{image_id:012d}.jpg"
         absolute_image_path = get_absolute_image_path(image_filename)
-        relative_image_path = get_relative_image_path(image_filename)
-
-        if not os.path.exists(absolute_image_path):
-            skipped_count += 1
-            if skipped_count % 100 == 0:
-                print(f"Skipped {skipped_count} missing images so far...")
+        try:
+            if image_filename not in image_files:
+                raise FileNotFoundError(absolute_image_path)
+            fingerprint = file_fingerprint(absolute_image_path)
+        except FileNotFoundError:
+            skipped_count += len(captions)
+            missing_images += 1
+            if missing_images % 100 == 0:
+                print(f"Skipped {missing_images} missing images so far...")
             continue # Skip if image file not found
 
-        try:
-            # Load and process the image
-            image = Image.open(absolute_image_path).convert("RGB")
-            
-            # Use CLIP to get the image embedding
-            inputs = processor(text=[caption], images=image, return_tensors="pt", padding=True).to(device)
-            with torch.no_grad():
-                outputs = model(**inputs)
-                image_embedding = outputs.image_embeds.cpu().numpy().tolist()[0]
-                
-            # Add to the current batch
-            batch_embeddings.append(image_embedding)
-            batch_documents.append(caption) # Store the caption as a document
-            # Store relative path for web serving and image_id for evaluation
-            batch_metadatas.append({
-                "image_id": str(image_id), 
-                "image_path": relative_image_path  # Use relative path for web serving
-            })
-            # Use the unique annotation_id for the ChromaDB id
-            batch_ids.append(str(annotation_id))
-            
-            processed_count += 1
-            
-            # Check if the batch is full
-            if len(batch_ids) >= BATCH_SIZE:
-                print(f"Adding batch of {len(batch_ids)} documents to ChromaDB... (Processed: {processed_count}/{total_annotations})")
-                collection.add(
-                    embeddings=batch_embeddings,
-                    documents=batch_documents,
-                    metadatas=batch_metadatas,
-                    ids=batch_ids
-                )
-                
-                # Clear lists for next batch
-                batch_embeddings = []
-                batch_documents = []
-                batch_metadatas = []
-                batch_ids = []
-
-        except Exception as e:
-            print(f"Error processing image {image_filename}: {e}")
-            skipped_count += 1
-
-    # Add any remaining items in the last batch
-    if len(batch_ids) > 0:
-        print(f"Adding final batch of {len(batch_ids)} documents...")
-        collection.add(
-            embeddings=batch_embeddings,
-            documents=batch_documents,
-            metadatas=batch_metadatas,
-            ids=batch_ids
-        )
+        key = str(image_id)
+        annotation_ids = sorted(str(annotation_id) for annotation_id, _ in captions)
+        entry = manifest.images.get(key)
+        if len(unchanged_entries) >= BATCH_SIZE:
+            flush_unchanged()
+
+        if entry is None and key in existing:
+            unchanged_pixels[key] = captions
+            unchanged_entries.append(dict(fingerprint, image_id=key, ids=annotation_ids))
+            up_to_date += 1
+            continue
+
+        if entry is not None:
+            same_file = entry['size'] == fingerprint['size'] and entry['mtime_ns'] == fingerprint['mtime_ns']
+            if not same_file:
+                # mtime changed: only re-embed if the bytes really changed
+                sha1 = file_sha1(absolute_image_path)
+                same_file = sha1 == entry.get('sha1')
+                fingerprint['sha1'] = sha1
+            else:
+                fingerprint['sha1'] = entry.get('sha1')
+
+            if same_file:
+                if entry['ids'] == annotation_ids and fingerprint['mtime_ns'] == entry['mtime_ns']:
+                    up_to_date += 1
+                else:
+                    unchanged_pixels[key] = captions
+                    unchanged_entries.append(dict(fingerprint, image_id=key, ids=annotation_ids))
+                    refreshed += 1
+                continue
+
+        work_items.append({
+            'image_id': image_id,
+            'caption_count': len(captions),
+            'image_filename': image_filename,
+            'absolute_image_path': absolute_image_path,
+            'fingerprint': fingerprint,
+        })
+
+    if unchanged_entries:
+        flush_unchanged()
+
+    return work_items, up_to_date, refreshed, missing_images, skipped_count
+
+
+def prune_removed_images(annotations, image_files, manifest, store, caption_store, thumbnail_store):
+    """Delete images that are in the manifest but no longer annotated or on disk."""
+    removed = []
+    for key in manifest.images:
+        image_id = int(key)
+        if f"{image_id:012d}.jpg" not in image_files or image_id not in annotations:
+            removed.append(key)
+    for start in range(0, len(removed), BATCH_SIZE):
+        chunk = removed[start:start + BATCH_SIZE]
+        store.delete(chunk)
+        caption_store.delete_images(chunk)
+        thumbnail_store.delete_images(chunk)
+        manifest.forget(chunk)
+    return len(removed)
+
+
+def backfill_thumbnails(manifest, thumbnail_store, skip=()):
+    """Write thumbnails for committed images that have none yet (e.g. ingested before thumbnails existed)."""
+    if not THUMBNAIL_SIZES:
+        return 0
+    missing = sorted(set(manifest.images) - thumbnail_store.image_ids() - set(skip), key=int)
+    if not missing:
+        return 0
+    print(f"🖼️  Writing thumbnails for {len(missing)} images...")
+    written = 0
+    with _make_decode_pool() as pool:
+        paths = [get_absolute_image_path(f"{int(image_id):012d}.jpg") for image_id in missing]
+        for start in range(0, len(missing), BATCH_SIZE * 20):
+            chunk = missing[start:start + BATCH_SIZE * 20]
+            results = pool.map(_thumbnail_image, paths[start:start + BATCH_SIZE * 20], chunksize=16)
+            written += thumbnail_store.record({image_id: sha1 for image_id, (sha1, _) in zip(chunk, results)})
+    return written
+
+
+def load_image_tags(path=IMAGE_TAGS_PATH):
+    """
+    Read {image_id: [tag, ...]} from IMAGE_TAGS_PATH. A COCO instances file is also
+    accepted: each image is tagged with the names of the object categories it contains.
+    """
+    if not path:
+        return {}
+    # Streamed: instances files are several times larger than the captions
+    names, category_ids, tags = {}, {}, {}
+    for key, element in iter_json_arrays(path):
+        if key == 'categories':
+            names[element['id']] = element['name']
+        elif key == 'annotations' and isinstance(element, dict):
+            category_ids.setdefault(element['image_id'], set()).add(element['category_id'])
+        elif key.isdigit():
+            tags.setdefault(int(key), []).append(element)
+    if names:
+        return {int(image_id): sorted({names[i] for i in ids}) for image_id, ids in category_ids.items()}
+    return tags
+
+
+def ensure_quantized(store, mode):
+    """Fit and write compressed codes once; later runs append codes with the same codec. Returns True if written."""
+    if store.name != "numpy" or mode == "none":
+        return False
+    if store.codec is None or store.codec.name != mode:
+        print(f"🗜️  Writing '{mode}' codes for {store.count()} images...")
+        store.quantize(mode)
+        return True
+    return False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Incrementally ingest COCO images into the vector store.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Drop the vector store and manifest and ingest everything from scratch")
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove images that disappeared from the annotations or IMAGE_DIR")
+    parser.add_argument("--quantize", choices=["none", "fp16", "int8", "pq"], default=NUMPY_INDEX_QUANTIZATION,
+                        help="Also write compressed codes (NumPy store only); new rows reuse the fitted codec")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # --- Open the vector store and caption sidecar ---
+    store = open_vector_store(create=True)
+    manifest = IngestManifest(INGEST_MANIFEST_PATH)
+    caption_store = CaptionStore(CAPTION_DB_PATH)
+    thumbnail_store = ThumbnailStore()
+    index_version = IndexVersion(INDEX_VERSION_PATH)
+
+    if args.rebuild:
+        store.clear()
+        print(f"🗑️  Cleared {store.name} vector store '{COLLECTION_NAME}' for rebuild.")
+        manifest.reset()
+        caption_store.clear()
+        thumbnail_store.clear()
+        index_version.bump()
+
+    print(f"📦 Using {store.name} vector store '{COLLECTION_NAME}' with {store.count()} images.")
+
+    # --- Load COCO annotations and prepare data ---
+    # Captions come grouped by image (so every image goes through the vision tower once)
+    # from a SQLite cache of DATASET_PATH, built by streaming the JSON on first use
+    annotations = AnnotationCache(DATASET_PATH)
+    image_files = scan_image_dir()
+
+    # Statistics tracking
+    total_annotations = annotations.annotation_count()
+    total_images = annotations.image_count()
+
+    if args.prune:
+        pruned = prune_removed_images(annotations, image_files, manifest, store, caption_store, thumbnail_store)
+        print(f"🧹 Pruned {pruned} images that are no longer available.")
+        if pruned:
+            index_version.bump()
+
+    work_items, up_to_date, refreshed, missing_images, skipped_count = plan_ingestion(
+        annotations, image_files, manifest, store, caption_store
+    )
+    print(f"📋 {up_to_date} images up to date, {refreshed} with unchanged pixels refreshed, "
+          f"{len(work_items)} to embed, {missing_images} missing on disk.")
+    if refreshed:
+        index_version.bump()
+
+    # Split and tags back the search pre-filters; only changed images are rewritten
+    image_tags = load_image_tags()
+    retagged = caption_store.sync_metadata({image_id: (DATA_SPLIT, image_tags.get(image_id, []))
+                                            for image_id in annotations.image_ids()})
+    if retagged:
+        print(f"🏷️  Updated split and tags of {retagged} images.")
+        index_version.bump()
+
+    if backfill_thumbnails(manifest, thumbnail_store, skip=[str(item['image_id']) for item in work_items]):
+        index_version.bump()
+
+    if not work_items:
+        if ensure_quantized(store, args.quantize):
+            index_version.bump()
+        print("🚀 Nothing to ingest - database is ready to use!")
+        print(f"\n📊 Final collection status: {store.count()} images in '{COLLECTION_NAME}'")
+        return
+
+    # Images whose bytes were already embedded by this model (in any collection) skip inference;
+    # the CLIP model itself is loaded by the first batch that needs it
+    embedding_cache = open_embedding_cache()
+    cached_digests = frozenset(embedding_cache.digests()) if embedding_cache is not None else frozenset()
+    if cached_digests:
+        print(f"♻️  Embedding cache has {len(cached_digests)} images for {MODEL_NAME}.")
+
+    total_to_embed = len(work_items)
+    print(f"Starting data ingestion for {total_to_embed} of {total_images} images ({total_annotations} annotations in split)...")
+    print(f"Pipeline: {NUM_DECODE_WORKERS} {DECODE_POOL} decode workers, inference batch {INFERENCE_BATCH_SIZE}, insert batch {BATCH_SIZE}")
+
+    writer = IndexWriter(store, caption_store, thumbnail_store, manifest, index_version)
+    writer.start()
+
+    processed_count = 0
+    written_images = 0
+    embedded_images = 0
+    cached_images = 0
+    batch_items = []
+    batch_pixels = []
+    batch_hashes = []
+    cached_items = []
+    cached_hashes = []
+
+    def write_records(items, embeddings, hashes):
+        nonlocal processed_count, written_images
+        captions = annotations.captions_for([item['image_id'] for item in items])
+        records = [build_image_record(item, captions[item['image_id']], embedding, sha1)
+                   for item, embedding, sha1 in zip(items, embeddings.tolist(), hashes)]
+        writer.put(records)
+        written_images += len(items)
+        processed_count += sum(len(record['captions']) for record in records)
+
+    def flush_inference_batch():
+        nonlocal embedded_images
+        embeddings = embed_pixel_batch(batch_pixels)
+        if embedding_cache is not None:
+            embedding_cache.put(batch_hashes, embeddings)
+        write_records(batch_items, embeddings, batch_hashes)
+        embedded_images += len(batch_items)
+        print(f"Embedded batch of {len(batch_items)} images... (Images: {written_images}/{total_to_embed})")
+        batch_items.clear()
+        batch_pixels.clear()
+        batch_hashes.clear()
+
+    def flush_cached_batch():
+        nonlocal cached_images
+        write_records(cached_items, embedding_cache.get(cached_hashes), cached_hashes)
+        cached_images += len(cached_items)
+        print(f"Reused {len(cached_items)} cached embeddings... (Images: {written_images}/{total_to_embed})")
+        cached_items.clear()
+        cached_hashes.clear()
+
+    interrupted = False
+    try:
+        with _make_decode_pool(cached_digests) as pool:
+            decoded = iter_decoded_images(work_items, pool, window=INFERENCE_BATCH_SIZE * 4)
+            for item, pixel_values, sha1, error in decoded:
+                if error is not None:
+                    print(f"Error processing image {item['image_filename']}: {error}")
+                    skipped_count += item['caption_count']
+                    continue
+
+                if pixel_values is None:
+                    # Same bytes already embedded by this model: reuse the cached vector
+                    cached_items.append(item)
+                    cached_hashes.append(sha1)
+                    if len(cached_items) >= INFERENCE_BATCH_SIZE:
+                        flush_cached_batch()
+                    continue
+
+                batch_items.append(item)
+                batch_pixels.append(pixel_values)
+                batch_hashes.append(sha1)
+
+                # Check if the inference batch is full
+                if len(batch_pixels) >= INFERENCE_BATCH_SIZE:
+                    flush_inference_batch()
+
+            # Embed any remaining images in the last batch
+            if batch_pixels:
+                flush_inference_batch()
+            if cached_items:
+                flush_cached_batch()
+    except KeyboardInterrupt:
+        interrupted = True
+        print("\n⏸️  Interrupted - committing batches already embedded...")
+    finally:
+        # Everything handed to the writer is committed and recorded before exiting
+        writer.close()
+
+    print(f"⏱️  Time by stage: {metrics.stage_report()}")
+    if interrupted:
+        print(f"💾 Committed {writer.committed_images} images this run. Re-run ingest_data.py to resume.")
+        return
+
+    if ensure_quantized(store, args.quantize):
+        index_version.bump()
 
     print("\n" + "="*50)
     print("🎉 INGESTION COMPLETE!")
     print("="*50)
     print(f"✅ Total annotations processed: {processed_count}")
-    print(f"⚠️  Images skipped (missing): {skipped_count}")
-    print(f"📊 Success rate: {(processed_count/(processed_count+skipped_count)*100):.1f}%")
-    print(f"🗄️  Total documents in collection: {collection.count()}")
+    print(f"🖼️  Images written this run: {written_images}/{total_to_embed}: {embedded_images} embedded, "
+          f"{cached_images} reused from the embedding cache ({up_to_date} already up to date)")
+    print(f"⚠️  Annotations skipped (missing or unreadable images): {skipped_count}")
+    if processed_count + skipped_count > 0:
+        print(f"📊 Success rate: {(processed_count/(processed_count+skipped_count)*100):.1f}%")
+    print(f"🗄️  Total images in vector store: {store.count()} ({caption_store.count()} captions)")
     print("="*50)
 
-# Always show final collection status
-print(f"\n📊 Final collection status: {collection.count()} documents in '{COLLECTION_NAME}'")
\ No newline at end of file
+    # Always show final collection status
+    print(f"\n📊 Final collection status: {store.count()} images in '{COLLECTION_NAME}'")
+
+
+if __name__ == "__main__":
+    main()
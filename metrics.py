@@ -0,0 +1,164 @@
+"""
+Timing spans and Prometheus-style metrics (no client library needed).
+
+- span(stage): times a block into the stage_duration_seconds histogram and into the
+  timing dicts of the requests being served, which become the X-Timing header.
+- Histogram / Gauge: small thread-safe metric families rendered by render() in the
+  Prometheus text exposition format for GET /metrics.
+
+Request timing dicts travel in context variables: the API middleware starts one per
+request, and MicroBatcher hands the dicts of a whole batch to the inference thread
+(run_with_timings), so a batch's stages show up in every request it served.
+"""
+
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+_registry = []
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+_timing_sinks = contextvars.ContextVar("timing_sinks", default=None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(label, value):
+    return f'{{{label}="{_escape(value)}"}}' if label else ""
+
+
+class Histogram:
+    """Cumulative-bucket histogram with one optional label."""
+
+    def __init__(self, name, help, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series = {}  # label value -> [count per bucket..., +Inf count, sum]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, label_value=""):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += 1
+            series[-1] += value
+
+    def summary(self):
+        """{label value: (count, sum)}."""
+        with self._lock:
+            return {label_value: (series[-2], series[-1]) for label_value, series in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series_items = sorted((label_value, list(series)) for label_value, series in self._series.items())
+        for label_value, series in series_items:
+            prefix = f'{self.label}="{_escape(label_value)}",' if self.label else ""
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {count}')
+            labels = _format_labels(self.label, label_value)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {series[-2]}")
+        return lines
+
+
+class Gauge:
+    """Value read at scrape time from `read()`, which returns a number or {label value: number}."""
+
+    def __init__(self, name, help, read, label=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        self.kind = kind  # "counter" for monotonically increasing totals
+        _registry.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.read()
+        except Exception:
+            return lines  # A metric that cannot be read right now (e.g. no store yet) is left out
+        if not isinstance(values, dict):
+            values = {"": values}
+        for label_value, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label, label_value)} {value}")
+        return lines
+
+
+def render():
+    """Every registered metric in the Prometheus text format."""
+    return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+
+
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Time spent per search / ingestion stage.", label="stage")
+
+
+# --- Request timings ---
+def start_request_timings():
+    """Begin collecting the stage timings of the current request; returns its {stage: seconds} dict."""
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def request_timings():
+    """The current request's timing dict (None outside a request)."""
+    return _request_timings.get()
+
+
+def run_with_timings(timings, function, *args):
+    """Call function(*args) on this thread with spans also recorded into each dict in `timings`."""
+    token = _timing_sinks.set([sink for sink in timings if sink is not None])
+    try:
+        return function(*args)
+    finally:
+        _timing_sinks.reset(token)
+
+
+def add_timing(stage, seconds, timings=None):
+    """Record a duration measured elsewhere (e.g. queue wait) into the histogram and timing dicts."""
+    STAGE_SECONDS.observe(seconds, stage)
+    for sink in timings if timings is not None else _current_sinks():
+        sink[stage] = sink.get(stage, 0.0) + seconds
+
+
+def _current_sinks():
+    sinks = _timing_sinks.get()
+    if sinks is not None:
+        return sinks
+    timings = _request_timings.get()
+    return [timings] if timings is not None else []
+
+
+@contextmanager
+def span(stage):
+    """Time a block as `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(stage, time.perf_counter() - start)
+
+
+def format_timings(timings):
+    """Server-Timing style header value: "stage;dur=<ms>, ..." in recording order."""
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+
+def stage_report():
+    """One line of total seconds per stage, largest first."""
+    totals = {stage: total for stage, (_, total) in STAGE_SECONDS.summary().items()}
+    return ", ".join(f"{stage} {total:.1f}s" for stage, total in sorted(totals.items(), key=lambda item: -item[1]))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Migrate an existing chroma_db directory from the old per-caption layout
+(one vector per COCO caption) to the image-level layout (one vector per image in
+the configured VECTOR_STORE, captions in the SQLite sidecar). No model inference is needed: every caption
+row already carries its image's embedding.
+
+Usage:
+    python migrate_index.py                 # migrate LEGACY_COLLECTION_NAME -> COLLECTION_NAME
+    python migrate_index.py --drop-legacy   # also delete the old collection afterwards
+"""
+
+import argparse
+import chromadb
+from captions import CaptionStore
+from vector_store import open_vector_store
+from cache import IndexVersion
+from ingest_data import IngestManifest, file_fingerprint, file_sha1
+from embedding_cache import open_embedding_cache
+from config import *
+
+
+def iter_legacy_rows(collection, page_size):
+    """Page through the legacy collection yielding (annotation_id, embedding, metadata, caption)."""
+    offset = 0
+    while True:
+        page = collection.get(
+            include=['embeddings', 'metadatas', 'documents'],
+            limit=page_size,
+            offset=offset
+        )
+        if not page['ids']:
+            return
+        for row in zip(page['ids'], page['embeddings'], page['metadatas'], page['documents']):
+            yield row
+        offset += len(page['ids'])
+
+
+def migrate(client, source_name, page_size=BATCH_SIZE * 20):
+    """Copy one vector per image into the configured vector store and every caption into the sidecar."""
+    source = client.get_collection(name=source_name)
+    target = open_vector_store(create=True)
+    caption_store = CaptionStore(CAPTION_DB_PATH)
+    manifest = IngestManifest(INGEST_MANIFEST_PATH)
+    embedding_cache = open_embedding_cache()
+
+    print(f"📦 Migrating {source.count()} caption rows from '{source_name}' to {target.name} store '{COLLECTION_NAME}'...")
+
+    # Group caption rows by image; the first row's embedding represents the image
+    images = {}
+    for annotation_id, embedding, meta, caption in iter_legacy_rows(source, page_size):
+        image = images.setdefault(meta['image_id'], {
+            'embedding': list(embedding),
+            'metadata': {"image_id": meta['image_id'], "image_path": meta['image_path']},
+            'captions': []
+        })
+        image['captions'].append((annotation_id, caption))
+
+    image_ids = list(images)
+    for start in range(0, len(image_ids), BATCH_SIZE):
+        chunk = image_ids[start:start + BATCH_SIZE]
+        target.upsert(
+            ids=chunk,
+            embeddings=[images[i]['embedding'] for i in chunk],
+            metadatas=[images[i]['metadata'] for i in chunk]
+        )
+        caption_store.replace_captions({i: images[i]['captions'] for i in chunk})
+
+        # Record migrated images so incremental ingestion does not re-embed them; with their
+        # content hash, other collections of the same images reuse the vectors from the embedding cache
+        entries = []
+        for image_id in chunk:
+            absolute_image_path = get_absolute_image_path(f"{int(image_id):012d}.jpg")
+            try:
+                fingerprint = file_fingerprint(absolute_image_path, sha1=file_sha1(absolute_image_path))
+            except FileNotFoundError:
+                continue
+            ids = sorted(annotation_id for annotation_id, _ in images[image_id]['captions'])
+            entries.append(dict(fingerprint, image_id=image_id, ids=ids))
+        manifest.record(entries)
+        if embedding_cache is not None and entries:
+            embedding_cache.put([entry['sha1'] for entry in entries],
+                                [images[entry['image_id']]['embedding'] for entry in entries])
+        print(f"Migrated {min(start + BATCH_SIZE, len(image_ids))}/{len(image_ids)} images...")
+
+    IndexVersion(INDEX_VERSION_PATH).bump()
+    return len(image_ids), caption_store.count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate a per-caption collection to the image-level layout.")
+    parser.add_argument("--source", default=LEGACY_COLLECTION_NAME, help="Per-caption collection to read")
+    parser.add_argument("--drop-legacy", action="store_true", help="Delete the source collection afterwards")
+    args = parser.parse_args()
+
+    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+    try:
+        client.get_collection(name=args.source)
+    except Exception:
+        print(f"❌ Collection '{args.source}' not found in {CHROMA_DB_PATH} - nothing to migrate.")
+        return
+
+    image_count, caption_count = migrate(client, args.source)
+    print(f"✅ Migrated {image_count} images and {caption_count} captions into '{COLLECTION_NAME}'.")
+
+    if args.drop_legacy:
+        client.delete_collection(name=args.source)
+        print(f"🗑️  Dropped legacy collection '{args.source}'.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+"""
+Compressed vector codes for the NumPy index.
+
+A codec turns L2-normalized float32 embeddings into compact codes and scores
+queries directly against those codes:
+
+- fp16: half-precision copy of each vector (2x smaller).
+- int8: scalar quantization with one scale per dimension (4x smaller).
+- pq:   product quantization, one byte per subspace (512-d / 64 subspaces = 32x smaller).
+
+QuantizedIndex scans the codes for the top k * rerank_factor candidates and then
+re-ranks only those candidates with the full-precision vectors, which can stay
+memory-mapped on disk.
+"""
+
+import numpy as np
+from vector_store import top_k, scan_top_k, gather_scores
+from config import *
+
+
+def kmeans(vectors, k, iterations=20, seed=0):
+    """Plain Lloyd's k-means (squared L2). Returns (centroids, assignments)."""
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+    centroids = vectors[rng.choice(len(vectors), size=k, replace=False)].copy()
+    assignments = np.zeros(len(vectors), dtype=np.int64)
+    for _ in range(iterations):
+        assignments = assign_to_centroids(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters with random points so every code stays usable
+        if empty.any():
+            centroids[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()), replace=False)]
+    return centroids, assign_to_centroids(vectors, centroids)
+
+
+def assign_to_centroids(vectors, centroids, block_rows=65536):
+    """Index of the nearest centroid (squared L2) for every vector."""
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_rows):
+        block = vectors[start:start + block_rows]
+        distances = centroid_norms[None, :] - 2.0 * block @ centroids.T
+        assignments[start:start + block_rows] = distances.argmin(axis=1)
+    return assignments
+
+
+class Float16Codec:
+    """Half-precision codes."""
+
+    name = "fp16"
+
+    def fit(self, vectors):
+        return self
+
+    def encode(self, vectors):
+        return np.asarray(vectors, dtype=np.float16)
+
+    def scores(self, queries, codes):
+        return queries @ np.asarray(codes, dtype=np.float32).T
+
+    def bytes_per_vector(self, dim):
+        return 2 * dim
+
+    def state(self):
+        return {}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls()
+
+
+class Int8Codec:
+    """Symmetric int8 scalar quantization with one scale per dimension."""
+
+    name = "int8"
+
+    def __init__(self, scales=None):
+        self.scales = scales
+
+    def fit(self, vectors):
+        max_abs = np.abs(np.asarray(vectors, dtype=np.float32)).max(axis=0)
+        self.scales = np.maximum(max_abs, 1e-8) / 127.0
+        return self
+
+    def encode(self, vectors):
+        codes = np.rint(np.asarray(vectors, dtype=np.float32) / self.scales)
+        return np.clip(codes, -127, 127).astype(np.int8)
+
+    def scores(self, queries, codes):
+        # Fold the per-dimension scales into the query instead of dequantizing every row
+        return (queries * self.scales) @ np.asarray(codes, dtype=np.float32).T
+
+    def bytes_per_vector(self, dim):
+        return dim
+
+    def state(self):
+        return {"scales": self.scales}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(scales=state["scales"])
+
+
+class ProductQuantizer:
+    """Product quantization with 256 centroids (one uint8 code) per subspace."""
+
+    name = "pq"
+
+    def __init__(self, subspaces=PQ_SUBSPACES, centroids=None, iterations=20):
+        self.subspaces = subspaces
+        self.centroids = centroids  # (subspaces, 256, sub_dim)
+        self.iterations = iterations
+
+    def _split(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[1] % self.subspaces:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} is not divisible by {self.subspaces} PQ subspaces")
+        return vectors.reshape(len(vectors), self.subspaces, -1)
+
+    def fit(self, vectors):
+        parts = self._split(vectors)
+        centroids = []
+        for j in range(self.subspaces):
+            sub_centroids, _ = kmeans(parts[:, j, :], 256, iterations=self.iterations, seed=j)
+            if len(sub_centroids) < 256:
+                # Tiny training sets: pad so codes always index a full table
+                sub_centroids = np.concatenate([sub_centroids, np.repeat(sub_centroids[:1], 256 - len(sub_centroids), axis=0)])
+            centroids.append(sub_centroids)
+        self.centroids = np.stack(centroids)
+        return self
+
+    def encode(self, vectors):
+        parts = self._split(vectors)
+        codes = np.empty((len(parts), self.subspaces), dtype=np.uint8)
+        for j in range(self.subspaces):
+            codes[:, j] = assign_to_centroids(parts[:, j, :], self.centroids[j])
+        return codes
+
+    def scores(self, queries, codes):
+        # Asymmetric distance computation: one lookup table of query/centroid dot products per subspace
+        tables = np.einsum('qjd,jcd->qjc', self._split(queries), self.centroids)
+        codes = np.asarray(codes)
+        scores = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for j in range(self.subspaces):
+            scores += tables[:, j, codes[:, j]]
+        return scores
+
+    def bytes_per_vector(self, dim):
+        return self.subspaces
+
+    def state(self):
+        return {"subspaces": np.array(self.subspaces), "centroids": self.centroids}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(subspaces=int(state["subspaces"]), centroids=state["centroids"])
+
+
+CODECS = {codec.name: codec for codec in (Float16Codec, Int8Codec, ProductQuantizer)}
+
+
+def make_codec(name):
+    """Create an unfitted codec by name ("fp16", "int8" or "pq")."""
+    if name not in CODECS:
+        raise ValueError(f"Unknown quantization mode: {name} (expected one of {', '.join(CODECS)})")
+    return CODECS[name]()
+
+
+def save_codec(codec, path):
+    """Store a fitted codec's parameters in an .npz file."""
+    np.savez(path, codec=np.array(codec.name), **codec.state())
+
+
+def load_codec(path):
+    """Load a codec written by save_codec."""
+    with np.load(path) as state:
+        return CODECS[str(state["codec"])].from_state(dict(state))
+
+
+class QuantizedIndex:
+    """Approximate scan over compressed codes followed by an exact re-rank of the best candidates."""
+
+    def __init__(self, codec, codes, vectors=None, rerank_factor=RERANK_FACTOR, block_rows=65536):
+        self.codec = codec
+        self.codes = codes
+        self.vectors = vectors  # Full-precision rows (may be a memmap); None disables re-ranking
+        self.rerank_factor = rerank_factor
+        self.block_rows = block_rows
+
+    def search(self, queries, k, live=None):
+        """Return (scores, rows) arrays of shape (len(queries), <=k), best first."""
+        rerank = self.vectors is not None and self.rerank_factor > 0
+        n_candidates = k * self.rerank_factor if rerank else k
+        approx_scores, candidates = scan_top_k(
+            lambda start, end: self.codec.scores(queries, self.codes[start:end]),
+            len(self.codes), n_candidates, live, self.block_rows
+        )
+        if not rerank:
+            return approx_scores, candidates
+
+        scores = np.full(candidates.shape, -np.inf, dtype=np.float32)
+        for i, rows in enumerate(candidates):
+            valid = np.isfinite(approx_scores[i])
+            if valid.any():
+                scores[i, valid] = gather_scores(self.vectors, queries[i], rows[valid])
+        keep = top_k(scores, k)
+        return np.take_along_axis(scores, keep, axis=1), np.take_along_axis(candidates, keep, axis=1)
+
+    def rank_candidates(self, query, rows, k):
+        """Score candidate rows (e.g. from an ANN index) with the codes, then re-rank exactly."""
+        rows = np.sort(rows)
+        approx = self.codec.scores(query[None, :], self.codes[rows])[0]
+        if self.vectors is None or self.rerank_factor <= 0:
+            keep = top_k(approx[None, :], k)[0]
+            return approx[keep], rows[keep]
+        shortlist = rows[top_k(approx[None, :], k * self.rerank_factor)[0]]
+        exact = gather_scores(self.vectors, query, shortlist)
+        keep = top_k(exact[None, :], k)[0]
+        return exact[keep], shortlist[keep]
+
+    def nbytes(self):
+        """Resident size of the codes scanned for every query."""
+        return int(self.codes.dtype.itemsize * self.codes.size)
@@ -0,0 +1,57 @@
+"""
+Second-stage re-ranking of a cheap candidate set.
+
+The first stage (quantized codes, IVF / HNSW, shards) only has to get the right
+images into the top RERANK_CANDIDATES. mmr() then re-scores those candidates exactly
+against their stored full-precision vectors and picks them greedily by maximal
+marginal relevance:
+
+    score(c) = lambda * cos(query, c) - (1 - lambda) * max over picked p of cos(c, p)
+
+lambda = 1 keeps the exact-cosine order; lower values trade relevance for diversity,
+so near-duplicate shots of one scene stop crowding the top k. The work is one
+(n, n) similarity product plus k vectorized argmax steps, and no model calls.
+"""
+
+import numpy as np
+from vector_store import normalize
+
+
+def mmr(query, candidates, k, mmr_lambda=1.0):
+    """Indices of up to k candidate rows in MMR order, and their exact cosine scores."""
+    query = normalize(query)[0]
+    candidates = normalize(candidates)
+    relevance = candidates @ query
+    k = min(k, len(candidates))
+    if k == 0:
+        return np.array([], dtype=np.int64), relevance[:0]
+    if mmr_lambda >= 1.0:
+        order = np.argsort(-relevance, kind="stable")[:k]
+        return order, relevance[order]
+
+    similarity = candidates @ candidates.T
+    picked = [int(np.argmax(relevance))]
+    available = np.ones(len(candidates), dtype=bool)
+    available[picked[0]] = False
+    max_similarity = similarity[picked[0]].copy()  # Closest picked image, per candidate
+    for _ in range(k - 1):
+        scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        picked.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    order = np.array(picked)
+    return order, relevance[order]
+
+
+def rerank_hits(query, hits, vectors, k, mmr_lambda=1.0):
+    """
+    Re-rank store hits ({'id', 'score', 'metadata'}) with mmr() using `vectors`
+    ({id: stored embedding}); hits without a stored vector are dropped. Scores become exact cosines.
+    """
+    hits = [hit for hit in hits if hit['id'] in vectors]
+    if not hits:
+        return []
+    order, scores = mmr(query, np.stack([vectors[hit['id']] for hit in hits]), k, mmr_lambda)
+    return [dict(hits[i], score=float(score)) for i, score in zip(order, scores)]
@@ -5,10 +5,12 @@ This script helps you get everything running with proper error checking.
 """
 
 import subprocess
+import argparse
 import sys
 import time
 import requests
 import os
+from config import INFERENCE_SOCKET_PATH, VECTOR_STORE, COLLECTION_NAME
 
 def run_command(command, description):
     """Run a command and return success status"""
@@ -43,40 +45,58 @@ def check_dependencies():
         return True
 
 def check_database():
-    """Check if database exists and has data"""
+    """Check if the configured vector store exists and has data"""
     print("\n Checking database...")
     try:
-        import chromadb
-        client = chromadb.Client()
-        collections = client.list_collections()
-        
-        if not collections:
-            print(" No database found. Need to run data ingestion.")
+        from vector_store import open_vector_store
+        try:
+            store = open_vector_store()
+        except Exception:
+            print(f" No {VECTOR_STORE} vector store '{COLLECTION_NAME}' found. Need to run data ingestion.")
             return False
         
-        collection = client.get_collection('image_search_val')
-        count = collection.count()
+        count = store.count()
         
         if count == 0:
             print("❌ Database is empty. Need to run data ingestion.")
             return False
         else:
-            print(f" Database found with {count} documents")
+            print(f" Database found with {count} images")
             return True
             
     except Exception as e:
         print(f" Database error: {e}")
         return False
 
-def start_api_server():
-    """Start the API server in the background"""
+def start_inference_server(socket_path, timeout=300):
+    """Start the shared inference server and wait until its socket accepts workers"""
+    print("\n🧠 Starting inference server...")
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    process = subprocess.Popen([sys.executable, 'inference_server.py', '--socket', socket_path])
+    deadline = time.time() + timeout
+    while not os.path.exists(socket_path):
+        if process.poll() is not None or time.time() > deadline:
+            print(" Inference server failed to start")
+            process.terminate()
+            return None
+        time.sleep(0.2)
+    return process
+
+def start_api_server(workers=0, socket_path=None):
+    """Start the API server in the background (workers=0: one auto-reloading dev process)"""
     print("\n🚀 Starting API server...")
     try:
+        command = [sys.executable, '-m', 'uvicorn', 'api:app', '--host', '127.0.0.1', '--port', '8000']
+        env = dict(os.environ)
+        if workers:
+            # Workers share the inference server's model instead of loading one each
+            command += ['--workers', str(workers)]
+            env['CLIP_INFERENCE_SOCKET'] = socket_path
+        else:
+            command.append('--reload')
         # Start uvicorn in the background
-        process = subprocess.Popen([
-            sys.executable, '-m', 'uvicorn', 'api:app', 
-            '--reload', '--host', '127.0.0.1', '--port', '8000'
-        ], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
         
         # Wait a moment for server to start
         time.sleep(3)
@@ -100,6 +120,12 @@ def start_api_server():
 
 def main():
     """Main setup and run function"""
+    parser = argparse.ArgumentParser(description="Set up and run the search engine.")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Serve with N uvicorn worker processes sharing one inference server (default: one --reload dev process)")
+    parser.add_argument("--socket", default=INFERENCE_SOCKET_PATH, help="Unix socket of the inference server (with --workers)")
+    args = parser.parse_args()
+
     print(" Multi-Modal Search Engine Setup & Run")
     print("=" * 50)
     
@@ -117,10 +143,17 @@ def main():
         print("\n Data ingestion completed. Please wait a moment...")
         time.sleep(2)
     
-    # Start API server
-    api_process = start_api_server()
+    # Start the inference server, then the API server
+    inference_process = None
+    if args.workers:
+        inference_process = start_inference_server(args.socket)
+        if not inference_process:
+            return
+    api_process = start_api_server(args.workers, args.socket)
     if not api_process:
         print("\n Failed to start API server")
+        if inference_process:
+            inference_process.terminate()
         return
     
     print("\n" + "=" * 50)
@@ -137,6 +170,8 @@ def main():
     except KeyboardInterrupt:
         print("\n\n Stopping server...")
         api_process.terminate()
+        if inference_process:
+            inference_process.terminate()
         print(" Server stopped")
 
 if __name__ == "__main__":
@@ -0,0 +1,218 @@
+"""
+Shared runtime: the CLIP model, its processor and the vector store, loaded lazily.
+
+Importing this module (or any script that uses it) is cheap: torch and transformers
+are only imported, and the model only loaded, on first use. Each resource is a
+process-wide singleton, so the API, CLI tools and tests share one instance, and
+warmup() loads everything up front when startup latency matters more than import time.
+
+The first load from the Hugging Face hub also writes a local safetensors snapshot
+(MODEL_CACHE_DIR) in the configured dtype; later loads read that snapshot directly,
+skipping hub resolution and dtype conversion.
+
+When INFERENCE_SOCKET is set (API workers started by run_search_engine.py --workers),
+encode_text and encode_images are sent to inference_server.py, which owns the only
+copy of the model on the node; the worker itself only loads the image processor.
+"""
+
+import os
+import threading
+from metrics import span
+from config import *
+
+_lock = threading.RLock()
+_model = None
+_processor = None
+_text_encoder = None
+_store = None
+_caption_store = None
+_thumbnail_store = None
+_image_processor = None
+_inference_socket = INFERENCE_SOCKET
+_inference_client = None
+
+
+def device():
+    """DEVICE when CUDA is available, else "cpu"."""
+    import torch
+    return DEVICE if torch.cuda.is_available() else "cpu"
+
+
+def model_dtype():
+    """Torch dtype the model runs in (MODEL_DTYPE; "auto" = fp16 on CUDA, fp32 on CPU)."""
+    import torch
+    name = MODEL_DTYPE
+    if name == "auto":
+        name = "float16" if device() == "cuda" else "float32"
+    return getattr(torch, name)
+
+
+def snapshot_path():
+    """Directory of the local safetensors snapshot for MODEL_NAME in the runtime dtype."""
+    dtype_name = str(model_dtype()).replace("torch.", "")
+    return os.path.join(MODEL_CACHE_DIR, f"{MODEL_NAME.replace('/', '--')}-{dtype_name}")
+
+
+def model_source():
+    """Where to load the model and processors from: the local snapshot if it exists, else MODEL_NAME."""
+    path = snapshot_path()
+    return path if os.path.exists(os.path.join(path, "config.json")) else MODEL_NAME
+
+
+def _write_snapshot(model, processor):
+    """Save a safetensors copy of the loaded model and processor next to the project."""
+    path = snapshot_path()
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        model.save_pretrained(tmp_path, safe_serialization=True)
+        processor.save_pretrained(tmp_path)
+        os.replace(tmp_path, path)
+        print(f"💾 Cached model snapshot in {path}")
+    except OSError as e:
+        print(f"⚠️  Could not cache model snapshot in {path}: {e}")
+
+
+def _load_model():
+    from transformers import CLIPModel, CLIPProcessor
+    source = model_source()
+    print(f"Loading CLIP model from {source}...")
+    model = CLIPModel.from_pretrained(source, torch_dtype=model_dtype(), low_cpu_mem_usage=True)
+    processor = CLIPProcessor.from_pretrained(source)
+    model = model.to(device()).eval()
+    if source == MODEL_NAME and MODEL_CACHE_DIR:
+        _write_snapshot(model, processor)
+    print("CLIP model loaded.")
+    return model, processor
+
+
+def get_model():
+    """The shared CLIPModel in eval mode (loaded on first call)."""
+    global _model, _processor
+    if _model is None:
+        with _lock:
+            if _model is None:
+                _model, _processor = _load_model()
+    return _model
+
+
+def get_processor():
+    """The shared CLIPProcessor (loaded together with the model)."""
+    get_model()
+    return _processor
+
+
+def use_inference_server(socket_path):
+    """Send encode calls to the inference server at socket_path ("" = run the model in this process)."""
+    global _inference_socket, _inference_client
+    _inference_socket = socket_path
+    _inference_client = None
+
+
+def get_inference_client():
+    """The shared connection to the inference server."""
+    global _inference_client
+    if _inference_client is None:
+        with _lock:
+            if _inference_client is None:
+                from inference_server import InferenceClient
+                _inference_client = InferenceClient(_inference_socket)
+    return _inference_client
+
+
+def model_loaded():
+    if _inference_socket:
+        try:
+            return get_inference_client().call("model_loaded")
+        except (OSError, EOFError, RuntimeError):
+            return False
+    return _model is not None or _text_encoder is not None
+
+
+def get_text_encoder():
+    """The shared query text encoder selected by TEXT_ENCODER (see text_encoder.py)."""
+    global _text_encoder
+    if _text_encoder is None:
+        with _lock:
+            if _text_encoder is None:
+                from text_encoder import make_text_encoder
+                _text_encoder = make_text_encoder(TEXT_ENCODER, TEXT_ENCODER_THREADS)
+    return _text_encoder
+
+
+def encode_text(texts):
+    """CLIP text embeddings for a list of strings as a float32 (n, dim) array (not normalized)."""
+    if _inference_socket:
+        return get_inference_client().call("encode_text", list(texts))
+    return get_text_encoder().encode(texts)
+
+
+def get_image_processor():
+    """The CLIP image processor (resize, center-crop, normalize) of the shared processor."""
+    global _image_processor
+    if not _inference_socket:
+        return get_processor().image_processor
+    # The model lives in the inference server; this process only preprocesses uploads
+    if _image_processor is None:
+        with _lock:
+            if _image_processor is None:
+                from transformers import CLIPImageProcessor
+                _image_processor = CLIPImageProcessor.from_pretrained(model_source())
+    return _image_processor
+
+
+def encode_images(pixel_batch):
+    """One batched get_image_features pass over preprocessed pixel values; L2-normalized float32 (n, dim)."""
+    if _inference_socket:
+        return get_inference_client().call("encode_images", list(pixel_batch))
+    import torch
+    import numpy as np
+    model = get_model()
+    pixel_values = torch.from_numpy(np.stack(pixel_batch)).to(device(), dtype=model.dtype)
+    with span("image_forward"), torch.no_grad():
+        image_features = model.get_image_features(pixel_values=pixel_values)
+        # Normalize like CLIPModel's image_embeds so stored vectors are unchanged
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+    return image_features.float().cpu().numpy()
+
+
+def get_store():
+    """The shared vector store configured by VECTOR_STORE (opened on first call)."""
+    global _store
+    if _store is None:
+        with _lock:
+            if _store is None:
+                from vector_store import open_vector_store
+                _store = open_vector_store()
+    return _store
+
+
+def get_caption_store():
+    """The shared caption sidecar."""
+    global _caption_store
+    if _caption_store is None:
+        with _lock:
+            if _caption_store is None:
+                from captions import CaptionStore
+                _caption_store = CaptionStore(CAPTION_DB_PATH)
+    return _caption_store
+
+
+def get_thumbnail_store():
+    """The shared thumbnail index."""
+    global _thumbnail_store
+    if _thumbnail_store is None:
+        with _lock:
+            if _thumbnail_store is None:
+                from thumbnails import ThumbnailStore
+                _thumbnail_store = ThumbnailStore()
+    return _thumbnail_store
+
+
+def warmup(model=True, store=True):
+    """Load resources ahead of the first request and run one tiny forward pass."""
+    if store:
+        get_store()
+        get_caption_store()
+        get_thumbnail_store()
+    if model:
+        encode_text(["warmup"])
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Serve vector store shards to the API and the indexing scripts (see shards.py).
+
+Each server owns one shard store (VECTOR_STORE backend) on its node; clients list
+the servers in SHARD_ADDRESSES, in shard order.
+
+Usage:
+    python shard_server.py --shard 0 --port 7100   # serve shard 0 of this node's index
+    python shard_server.py --local                 # local stand-in: NUM_SHARDS processes on SHARD_BASE_PORT + i
+"""
+
+import sys
+import signal
+import argparse
+import multiprocessing
+from shards import open_shard_store, serve_shard
+from config import *
+
+
+def run_shard(shard, address, create):
+    store = open_shard_store(VECTOR_STORE, shard, create=create)
+    print(f"🧩 Shard {shard} ({store.name}, {store.count()} images) listening on {address}")
+    try:
+        serve_shard(store, address)
+    except KeyboardInterrupt:
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve vector store shards over the network.")
+    parser.add_argument("--shard", type=int, default=0, help="Shard number served by this process")
+    parser.add_argument("--host", default=SHARD_HOST, help="Interface to listen on")
+    parser.add_argument("--port", type=int, default=SHARD_BASE_PORT, help="Port to listen on")
+    parser.add_argument("--local", action="store_true",
+                        help=f"Serve all NUM_SHARDS ({NUM_SHARDS}) shards from local processes on ports {SHARD_BASE_PORT}+i")
+    parser.add_argument("--create", action="store_true", help="Create empty shard stores that do not exist yet")
+    args = parser.parse_args()
+
+    if not args.local:
+        run_shard(args.shard, f"{args.host}:{args.port}", args.create)
+        return
+
+    addresses = [f"{args.host}:{SHARD_BASE_PORT + shard}" for shard in range(NUM_SHARDS)]
+    processes = [multiprocessing.Process(target=run_shard, args=(shard, address, args.create))
+                 for shard, address in enumerate(addresses)]
+    for process in processes:
+        process.start()
+    print(f"Set SHARD_ADDRESSES = {addresses} in config.py to use these shards.")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("\nStopping shard servers...")
+    finally:
+        # Stop the shard processes with their parent, however it exits
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
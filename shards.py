@@ -0,0 +1,307 @@
+"""
+Sharded vector store: one logical collection split across several shard stores.
+
+Images are assigned to a shard by a stable hash of their id, so ingestion, the API
+and the index tools all agree on where an image lives without a lookup table. Each
+shard is a complete VectorStore of its own (a ChromaDB collection or a NumPy
+directory). Queries fan out to every shard concurrently and the per-shard top-k
+lists are merged into the global top-k; since every shard returns its own best k,
+the merge loses nothing.
+
+Shards are either opened in-process (NUM_SHARDS local stores) or reached over the
+network (SHARD_ADDRESSES), each one served by shard_server.py on its own node, so
+the collection can grow beyond one machine's RAM.
+"""
+
+import os
+import heapq
+import zlib
+import socket
+import ipaddress
+import threading
+from itertools import chain
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+import numpy as np
+from vector_store import VectorStore, ChromaVectorStore, NumpyVectorStore
+from config import *
+
+
+def shard_of(image_id, num_shards):
+    """Shard number of an image: crc32 of its id, stable across processes and machines."""
+    return zlib.crc32(str(image_id).encode("utf-8")) % num_shards
+
+
+def open_shard_store(backend, shard, create=False):
+    """Open shard number `shard` of the configured collection as a local store."""
+    if backend == "chroma":
+        return ChromaVectorStore(collection_name=f"{COLLECTION_NAME}_shard{shard:02d}", create=create)
+    if backend == "numpy":
+        return NumpyVectorStore(directory=os.path.join(NUMPY_INDEX_DIR, f"shard-{shard:02d}"), create=create)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def open_sharded_store(backend=VECTOR_STORE, create=False):
+    """Remote shards when SHARD_ADDRESSES is set, else NUM_SHARDS local shard stores."""
+    if SHARD_ADDRESSES:
+        return ShardedVectorStore([RemoteVectorStore(address) for address in SHARD_ADDRESSES])
+    return ShardedVectorStore([open_shard_store(backend, shard, create) for shard in range(NUM_SHARDS)])
+
+
+class ShardedVectorStore(VectorStore):
+    """Partition images across shard stores by id hash; fan operations out to the shards concurrently."""
+
+    def __init__(self, shards):
+        self.shards = list(shards)
+        self.name = self.shards[0].name
+        self._pool = ThreadPoolExecutor(max_workers=len(self.shards), thread_name_prefix="shard")
+
+    def _fan_out(self, call):
+        """Run call(shard) on every shard in parallel; results in shard order."""
+        return list(self._pool.map(call, self.shards))
+
+    def _partition(self, ids):
+        """{shard index: [positions in ids]} for the shards that own at least one id."""
+        positions = {}
+        for position, image_id in enumerate(ids):
+            positions.setdefault(shard_of(image_id, len(self.shards)), []).append(position)
+        return positions
+
+    # --- Interface ---
+    def count(self):
+        return sum(self._fan_out(lambda shard: shard.count()))
+
+    def ids(self):
+        return list(chain.from_iterable(self._fan_out(lambda shard: shard.ids())))
+
+    @property
+    def dim(self):
+        return next((dim for dim in self._fan_out(lambda shard: shard.dim) if dim), 0)
+
+    def upsert(self, ids, embeddings, metadatas):
+        ids = [str(i) for i in ids]
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self._pool_map_parts(self._partition(ids).items(), lambda shard, positions: shard.upsert(
+            [ids[p] for p in positions], embeddings[positions], [metadatas[p] for p in positions]
+        ))
+
+    def delete(self, ids):
+        ids = [str(i) for i in ids]
+        self._pool_map_parts(self._partition(ids).items(),
+                             lambda shard, positions: shard.delete([ids[p] for p in positions]))
+
+    def _pool_map_parts(self, parts, call):
+        """Run call(shard, positions) for each (shard index, positions) pair in parallel."""
+        return list(self._pool.map(lambda part: call(self.shards[part[0]], part[1]), parts))
+
+    def get(self, ids):
+        ids = [str(i) for i in ids]
+        found = self._pool_map_parts(self._partition(ids).items(),
+                                     lambda shard, positions: shard.get([ids[p] for p in positions]))
+        by_id = {}
+        for part in found:
+            by_id.update((row_id, (embedding, meta)) for row_id, embedding, meta
+                         in zip(part['ids'], part['embeddings'], part['metadatas']))
+        ordered = [i for i in ids if i in by_id]
+        embeddings = (np.stack([by_id[i][0] for i in ordered]).astype(np.float32) if ordered
+                      else np.empty((0, self.dim), dtype=np.float32))
+        return {"ids": ordered, "embeddings": embeddings, "metadatas": [by_id[i][1] for i in ordered]}
+
+    def query(self, query_embeddings, k, nprobe=None, ef_search=None, ids=None):
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if ids is None:
+            shard_hits = self._fan_out(lambda shard: shard.query(queries, k, nprobe=nprobe, ef_search=ef_search))
+        else:
+            # A filtered query only visits the shards that own some of the selected images
+            ids = [str(i) for i in ids]
+            shard_hits = self._pool_map_parts(self._partition(ids).items(), lambda shard, positions: shard.query(
+                queries, k, nprobe=nprobe, ef_search=ef_search, ids=[ids[p] for p in positions]
+            ))
+        # Global top-k = best k of the per-shard top-k lists (scores are cosine similarities everywhere)
+        return [heapq.nlargest(k, chain.from_iterable(hits[i] for hits in shard_hits), key=lambda hit: hit['score'])
+                for i in range(len(queries))]
+
+    def iter_batches(self, batch_size=10000):
+        for shard in self.shards:
+            yield from shard.iter_batches(batch_size)
+
+    def clear(self):
+        self._fan_out(lambda shard: shard.clear())
+
+    # --- NumPy store maintenance, applied to every shard ---
+    def refresh(self):
+        self._fan_out(lambda shard: shard.refresh())
+
+    def quantize(self, mode, **params):
+        self._fan_out(lambda shard: shard.quantize(mode, **params))
+
+    def build_ann(self, kind, **params):
+        self._fan_out(lambda shard: shard.build_ann(kind, **params))
+
+    @property
+    def codec(self):
+        return self.shards[0].codec
+
+    @property
+    def ann(self):
+        return self.shards[0].ann
+
+
+# --- Remote shards ---
+def parse_address(address):
+    """("host", port) from "host:port"."""
+    host, _, port = address.rpartition(":")
+    return host or SHARD_HOST, int(port)
+
+
+_DEFAULT_AUTHKEYS = (b"", b"change-me")
+
+
+def check_authkey(address, authkey):
+    """
+    Refuse an unset or default authkey for a shard address that is not loopback:
+    messages are unpickled, so whoever knows the key can run code on the other end.
+    """
+    if authkey not in _DEFAULT_AUTHKEYS:
+        return
+    host = parse_address(address)[0]
+    try:
+        loopback = ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        loopback = False
+    if not loopback:
+        raise ValueError(f"Shard address {address} is not loopback: set CLIP_SHARD_AUTHKEY to a secret "
+                         "on the shard servers and their clients.")
+
+
+class RemoteVectorStore(VectorStore):
+    """VectorStore client for one shard served by shard_server.py (one connection, one call at a time)."""
+
+    def __init__(self, address, authkey=SHARD_AUTHKEY):
+        check_authkey(address, authkey)
+        self.address = address
+        self.authkey = authkey
+        self._conn = None
+        self._lock = threading.Lock()
+        self.name = self._call("attribute", "name")
+
+    def _call(self, method, *args, **kwargs):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = Client(parse_address(self.address), authkey=self.authkey)
+                    self._conn.send((method, args, kwargs))
+                    status, value = self._conn.recv()
+                    break
+                except (EOFError, OSError):
+                    # The shard server restarted: reconnect once, then give up
+                    self._conn = None
+                    if attempt:
+                        raise
+        if status == "error":
+            raise RuntimeError(f"Shard {self.address} failed: {value}")
+        return value
+
+    def count(self):
+        return self._call("count")
+
+    def ids(self):
+        return self._call("ids")
+
+    @property
+    def dim(self):
+        return self._call("attribute", "dim")
+
+    def upsert(self, ids, embeddings, metadatas):
+        self._call("upsert", list(ids), np.asarray(embeddings, dtype=np.float32), list(metadatas))
+
+    def delete(self, ids):
+        self._call("delete", list(ids))
+
+    def get(self, ids):
+        return self._call("get", list(ids))
+
+    def query(self, query_embeddings, k, nprobe=None, ef_search=None, ids=None):
+        return self._call("query", np.asarray(query_embeddings, dtype=np.float32), k,
+                          nprobe=nprobe, ef_search=ef_search, ids=ids)
+
+    def iter_batches(self, batch_size=10000):
+        ids = self.ids()
+        for start in range(0, len(ids), batch_size):
+            found = self.get(ids[start:start + batch_size])
+            yield found['ids'], found['embeddings'], found['metadatas']
+
+    def clear(self):
+        self._call("clear")
+
+    def refresh(self):
+        self._call("refresh")
+
+    def quantize(self, mode, **params):
+        self._call("quantize", mode, **params)
+
+    def build_ann(self, kind, **params):
+        self._call("build_ann", kind, **params)
+
+    @property
+    def codec(self):
+        return self._call("attribute", "codec")
+
+    @property
+    def ann(self):
+        kind = self._call("attribute", "ann_kind")
+        return SimpleNamespace(kind=kind) if kind else None
+
+
+_SHARD_METHODS = {"count", "ids", "upsert", "delete", "get", "query", "clear", "refresh", "quantize", "build_ann"}
+
+
+def _shard_attribute(store, name):
+    if name == "ann_kind":
+        ann = getattr(store, "ann", None)
+        return ann.kind if ann is not None else None
+    if name in ("name", "codec", "dim"):
+        return getattr(store, name, None)
+    raise AttributeError(name)
+
+
+def _serve_connection(store, conn, lock):
+    with conn:
+        while True:
+            try:
+                method, args, kwargs = conn.recv()
+            except EOFError:
+                return
+            try:
+                with lock:  # Stores are not thread-safe; one call at a time across clients
+                    if method == "attribute":
+                        result = _shard_attribute(store, *args)
+                    elif method in _SHARD_METHODS:
+                        result = getattr(store, method)(*args, **kwargs)
+                    else:
+                        raise AttributeError(f"Unknown shard method: {method}")
+                conn.send(("ok", result))
+            except Exception as e:
+                conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+def serve_shard(store, address, authkey=SHARD_AUTHKEY):
+    """
+    Serve a store to RemoteVectorStore clients until interrupted, one thread per client.
+    Messages are pickled: the authkey handshake keeps strangers out, but run shard
+    servers on a trusted network only. A non-loopback address needs a non-default authkey.
+    """
+    check_authkey(address, authkey)
+    lock = threading.Lock()
+    with Listener(parse_address(address), authkey=authkey) as listener:
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError as e:
+                print(f"Shard connection failed: {e}")  # e.g. a client with the wrong authkey
+                continue
+            threading.Thread(target=_serve_connection, args=(store, conn, lock), daemon=True).start()
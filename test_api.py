@@ -5,43 +5,40 @@ Run this to identify issues with your search engine setup.
 """
 
 import requests
-import chromadb
 import json
-import sys
 
 def test_database():
-    """Test ChromaDB database status"""
+    """Test vector store status"""
     print("=== Testing Database ===")
     try:
-        from config import CHROMA_DB_PATH
-        client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-        collections = client.list_collections()
-        print(f"Available collections: {[c.name for c in collections]}")
-        
-        if collections:
-            try:
-                from config import COLLECTION_NAME
-                collection = client.get_collection(COLLECTION_NAME)
-                count = collection.count()
-                print(f"✅ Collection '{COLLECTION_NAME}' found with {count} documents")
-                
-                # Test a simple query
-                if count > 0:
-                    test_results = collection.query(
-                        query_embeddings=[[0.0] * 512],  # Dummy embedding
-                        n_results=1,
-                        include=['metadatas']
-                    )
-                    print(f"✅ Database query test successful")
-                    return True, count
-                else:
-                    print("❌ Collection is empty - need to run ingest_data.py")
-                    return False, 0
-            except Exception as e:
-                print(f"❌ Error accessing collection: {e}")
+        from config import COLLECTION_NAME, VECTOR_STORE
+        from vector_store import open_vector_store
+        try:
+            store = open_vector_store()
+        except Exception as e:
+            print(f"❌ No {VECTOR_STORE} vector store '{COLLECTION_NAME}' found ({e}) - need to run ingest_data.py")
+            return False, 0
+
+        try:
+            count = store.count()
+            print(f"✅ {store.name} vector store '{COLLECTION_NAME}' found with {count} images")
+
+            # Test a simple query
+            if count > 0:
+                test_results = store.query([[1.0] * 512], 1)  # Dummy embedding
+                print(f"✅ Database query test successful")
+                # Unknown ids must come back as an empty result, not an error
+                missing = store.get(["-1"])
+                if missing["ids"] or len(missing["embeddings"]):
+                    print("❌ Vector store returned rows for an unknown id")
+                    return False, count
+                print(f"✅ Unknown id lookup test successful")
+                return True, count
+            else:
+                print("❌ Vector store is empty - need to run ingest_data.py")
                 return False, 0
-        else:
-            print("❌ No collections found - need to run ingest_data.py")
+        except Exception as e:
+            print(f"❌ Error accessing vector store: {e}")
             return False, 0
     except Exception as e:
         print(f"❌ Database connection error: {e}")
@@ -124,7 +121,7 @@ def main():
         print("   → Try opening: http://127.0.0.1:8000/search?query=test")
     else:
         print("✅ EVERYTHING LOOKS GOOD!")
-        print(f"   → Database has {doc_count} documents")
+        print(f"   → Database has {doc_count} images")
         print("   → API is responding correctly")
         print("   → Frontend should work properly")
         print("\n🎉 Try opening frontend/index.html in your browser!")
@@ -0,0 +1,174 @@
+"""
+Selectable CLIP text-encoder backends for CPU search nodes.
+
+- torch: the stock PyTorch model (the runtime's shared CLIPModel, fp16 on CUDA).
+- int8:  a copy of the text tower with dynamically int8-quantized Linear layers (CPU).
+- onnx:  an ONNX Runtime session over the text tower, exported once from the same
+         weights into MODEL_CACHE_DIR (optional dependencies: pip install onnxruntime onnx).
+
+Every backend returns the same float32 (n, dim) text_embeds as get_text_features and
+honours TEXT_ENCODER_THREADS (intra-op threads; 0 keeps the library default).
+evaluate_model.py --text-encoders compares them for cosine parity, latency and Recall@K.
+
+Prompt ensembles (expand_query, encode_ensembles) average a query over several
+prompt templates and sub-queries; all variants go through one batched forward pass.
+"""
+
+import os
+import numpy as np
+from metrics import span
+from config import *
+
+TEXT_ENCODERS = ["torch", "int8", "onnx"]
+
+
+def _set_torch_threads(threads):
+    import torch
+    if threads > 0:
+        torch.set_num_threads(threads)
+
+
+def _text_tower(model):
+    """nn.Module mapping (input_ids, attention_mask) to projected text embeddings."""
+    import torch
+
+    class TextTower(torch.nn.Module):
+        def __init__(self, model):
+            super().__init__()
+            self.text_model = model.text_model
+            self.text_projection = model.text_projection
+
+        def forward(self, input_ids, attention_mask):
+            pooled = self.text_model(input_ids=input_ids, attention_mask=attention_mask).pooler_output
+            return self.text_projection(pooled)
+
+    return TextTower(model)
+
+
+class TorchTextEncoder:
+    """get_text_features on the shared runtime model."""
+
+    name = "torch"
+
+    def __init__(self, threads=TEXT_ENCODER_THREADS):
+        import runtime
+        _set_torch_threads(threads)
+        self.model = runtime.get_model()
+        self.tokenizer = runtime.get_processor().tokenizer
+        self.device = runtime.device()
+
+    def encode(self, texts):
+        import torch
+        with span("tokenize"):
+            inputs = self.tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True).to(self.device)
+        with span("text_forward"), torch.no_grad():
+            return self.model.get_text_features(**inputs).float().cpu().numpy()
+
+
+class Int8TextEncoder:
+    """Dynamically int8-quantized copy of the text tower, run on the CPU."""
+
+    name = "int8"
+
+    def __init__(self, threads=TEXT_ENCODER_THREADS):
+        import copy
+        import torch
+        import runtime
+        _set_torch_threads(threads)
+        tower = copy.deepcopy(_text_tower(runtime.get_model())).float().cpu().eval()
+        self.tower = torch.quantization.quantize_dynamic(tower, {torch.nn.Linear}, dtype=torch.qint8)
+        self.tokenizer = runtime.get_processor().tokenizer
+
+    def encode(self, texts):
+        import torch
+        with span("tokenize"):
+            inputs = self.tokenizer(list(texts), return_tensors="pt", padding=True, truncation=True)
+        with span("text_forward"), torch.no_grad():
+            return self.tower(inputs["input_ids"], inputs["attention_mask"]).float().numpy()
+
+
+class OnnxTextEncoder:
+    """ONNX Runtime session over the exported text tower; the export is cached next to the model snapshot."""
+
+    name = "onnx"
+
+    def __init__(self, threads=TEXT_ENCODER_THREADS):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx text encoder needs the optional onnxruntime package: pip install onnxruntime onnx")
+        import runtime
+        from transformers import AutoTokenizer
+        path = self.export_path()
+        if not os.path.exists(path):
+            self.export(path)
+        options = onnxruntime.SessionOptions()
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        # Only the tokenizer is needed at query time; the PyTorch model is not loaded once exported
+        self.tokenizer = AutoTokenizer.from_pretrained(runtime.model_source())
+
+    @staticmethod
+    def export_path():
+        return os.path.join(MODEL_CACHE_DIR or ".", f"{MODEL_NAME.replace('/', '--')}-text.onnx")
+
+    @staticmethod
+    def export(path):
+        """Export the fp32 text tower with dynamic batch and sequence axes."""
+        import copy
+        import torch
+        import runtime
+        print(f"📤 Exporting the CLIP text encoder to {path}...")
+        tower = copy.deepcopy(_text_tower(runtime.get_model())).float().cpu().eval()
+        inputs = runtime.get_processor().tokenizer(["a photo of a dog"], return_tensors="pt", padding=True)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        torch.onnx.export(
+            tower, (inputs["input_ids"], inputs["attention_mask"]), tmp_path,
+            input_names=["input_ids", "attention_mask"], output_names=["text_embeds"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                          "attention_mask": {0: "batch", 1: "sequence"},
+                          "text_embeds": {0: "batch"}},
+            opset_version=17, dynamo=False
+        )
+        os.replace(tmp_path, path)
+
+    def encode(self, texts):
+        with span("tokenize"):
+            inputs = self.tokenizer(list(texts), return_tensors="np", padding=True, truncation=True)
+        feeds = {"input_ids": inputs["input_ids"].astype(np.int64),
+                 "attention_mask": inputs["attention_mask"].astype(np.int64)}
+        with span("text_forward"):
+            return self.session.run(["text_embeds"], feeds)[0].astype(np.float32)
+
+
+def make_text_encoder(name=TEXT_ENCODER, threads=TEXT_ENCODER_THREADS):
+    """Create a text encoder by backend name ("torch", "int8" or "onnx")."""
+    encoders = {encoder.name: encoder for encoder in (TorchTextEncoder, Int8TextEncoder, OnnxTextEncoder)}
+    if name not in encoders:
+        raise ValueError(f"Unknown text encoder: {name} (expected one of {', '.join(TEXT_ENCODERS)})")
+    return encoders[name](threads=threads)
+
+
+# --- Prompt ensembles ---
+def expand_query(query, templates=QUERY_PROMPT_TEMPLATES):
+    """Prompt variants of a query: every template applied to every "|"-separated sub-query."""
+    parts = [part.strip() for part in query.split("|") if part.strip()] or [query]
+    return list(dict.fromkeys(template.format(part) for part in parts for template in templates))
+
+
+def ensemble_embedding(embeddings):
+    """Mean of the L2-normalized variant embeddings, normalized again: one (dim,) float32 query vector."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    mean = (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).mean(axis=0)
+    return mean / np.linalg.norm(mean)
+
+
+def encode_ensembles(encode, queries, templates=QUERY_PROMPT_TEMPLATES):
+    """Ensemble embeddings of many queries from a single encode() call over all their variants."""
+    variants = [expand_query(query, templates) for query in queries]
+    texts = list(dict.fromkeys(text for query_variants in variants for text in query_variants))
+    encoded = dict(zip(texts, encode(texts)))
+    return np.stack([ensemble_embedding([encoded[text] for text in query_variants]) for query_variants in variants])
@@ -0,0 +1,112 @@
+"""
+Thumbnail tier for the search results grid.
+
+Ingestion writes small WebP (or JPEG) copies of every image at THUMBNAIL_SIZES into
+a content-addressed directory: <THUMBNAIL_DIR>/<size>/<sha1[:2]>/<sha1>.<ext>, where
+sha1 is the hash of the original file. Identical images share files, and a changed
+image gets a new name, so thumbnail URLs never change meaning and can be cached forever.
+A small SQLite index maps image_id to the current sha1.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from config import *
+
+_DIGEST_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+_FORMATS = {"webp": ("WEBP", "image/webp"), "jpeg": ("JPEG", "image/jpeg")}
+
+
+def thumbnail_path(digest, size, directory=THUMBNAIL_DIR, fmt=THUMBNAIL_FORMAT):
+    """File of the `size` thumbnail of the image whose bytes hash to `digest`."""
+    return os.path.join(directory, str(size), digest[:2], f"{digest}.{fmt}")
+
+
+def is_digest(value):
+    return bool(_DIGEST_PATTERN.match(value))
+
+
+def media_type(fmt=THUMBNAIL_FORMAT):
+    return _FORMATS[fmt][1]
+
+
+def write_thumbnails(image, digest, sizes=THUMBNAIL_SIZES, directory=THUMBNAIL_DIR,
+                     fmt=THUMBNAIL_FORMAT, quality=THUMBNAIL_QUALITY):
+    """Write every missing thumbnail size for a decoded RGB PIL image (safe to call from worker processes)."""
+    for size in sizes:
+        path = thumbnail_path(digest, size, directory, fmt)
+        if os.path.exists(path):
+            continue
+        thumbnail = image.copy()
+        thumbnail.thumbnail((size, size))  # Keeps the aspect ratio; the longer side becomes `size`
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        thumbnail.save(tmp_path, format=_FORMATS[fmt][0], quality=quality)
+        os.replace(tmp_path, path)
+
+
+class ThumbnailStore:
+    """SQLite index of image_id -> content digest for the thumbnail directory, safe to share across threads."""
+
+    def __init__(self, directory=THUMBNAIL_DIR, sizes=THUMBNAIL_SIZES, fmt=THUMBNAIL_FORMAT):
+        self.directory = directory
+        self.sizes = tuple(sizes)
+        self.fmt = fmt
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite3"), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS thumbnails (image_id TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+
+    def path(self, digest, size):
+        return thumbnail_path(digest, size, self.directory, self.fmt)
+
+    def has(self, digest):
+        """True if every configured size exists for this digest."""
+        return all(os.path.exists(self.path(digest, size)) for size in self.sizes)
+
+    def record(self, digests_by_image):
+        """Point each image_id in {image_id: digest} at its thumbnails (only digests whose files exist)."""
+        rows = [(str(image_id), digest) for image_id, digest in digests_by_image.items() if digest and self.has(digest)]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO thumbnails (image_id, digest) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def digests(self, image_ids):
+        """Return {image_id: digest} for the given images that have thumbnails."""
+        image_ids = [str(i) for i in image_ids]
+        if not image_ids:
+            return {}
+        placeholders = ",".join("?" * len(image_ids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT image_id, digest FROM thumbnails WHERE image_id IN ({placeholders})", image_ids
+            ).fetchall()
+        return dict(rows)
+
+    def image_ids(self):
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT image_id FROM thumbnails")}
+
+    def url(self, digest, size=None):
+        """API path of a thumbnail; the default size is the first configured one."""
+        return f"/thumbnails/{size or self.sizes[0]}/{digest}.{self.fmt}"
+
+    def delete_images(self, image_ids):
+        """Forget images; their files stay until clear(), since other images may share a digest."""
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM thumbnails WHERE image_id = ?", [(str(i),) for i in image_ids])
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM thumbnails")
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM thumbnails").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,546 @@
+"""
+Pluggable vector stores for the image index.
+
+Both stores hold one L2-normalized embedding per image plus a small metadata dict
+(image_id, image_path) and expose the same interface, so api.py, search_engine.py,
+evaluate_model.py and ingest_data.py do not care which one is configured:
+
+- ChromaVectorStore: the ChromaDB collection used so far.
+- NumpyVectorStore: a contiguous .npy matrix opened with np.memmap and searched
+  with one brute-force matmul + argpartition. Several uvicorn workers opening the
+  same file share one page-cached copy of the index.
+
+Scores are cosine similarities (higher is better) for both stores.
+"""
+
+import os
+import json
+import heapq
+import threading
+from itertools import chain
+import numpy as np
+from config import *
+
+
+def normalize(embeddings):
+    """Return float32 row-wise L2-normalized embeddings."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if embeddings.ndim == 1:
+        embeddings = embeddings[None, :]
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def top_k(scores, k):
+    """Indices of the k largest scores in each row, sorted best first (argpartition + small sort)."""
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+def scan_top_k(score_block, n_rows, k, live=None, block_rows=65536):
+    """
+    Blocked top-k scan. score_block(start, end) returns the (n_queries, end - start)
+    scores of rows [start, end); rows with live == False are never returned.
+    Returns (scores, rows) of shape (n_queries, <=k), best first, padded with -inf.
+    """
+    best_scores = best_rows = None
+    for start in range(0, n_rows, block_rows):
+        end = min(start + block_rows, n_rows)
+        scores = np.asarray(score_block(start, end), dtype=np.float32)
+        if live is not None:
+            scores[:, ~live[start:end]] = -np.inf
+        rows = np.broadcast_to(np.arange(start, end), scores.shape)
+        if best_scores is not None:
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, rows], axis=1)
+        keep = top_k(scores, k)
+        best_scores = np.take_along_axis(scores, keep, axis=1)
+        best_rows = np.take_along_axis(rows, keep, axis=1)
+    return best_scores, best_rows
+
+
+def gather_scores(vectors, query, rows):
+    """Exact scores of `rows` (any order) against one query, reading the rows in sorted order."""
+    order = np.argsort(rows)
+    scores = np.empty(len(rows), dtype=np.float32)
+    scores[order] = np.asarray(vectors[rows[order]], dtype=np.float32) @ query
+    return scores
+
+
+class VectorStore:
+    """Interface shared by all image vector stores."""
+
+    name = "base"
+
+    def count(self):
+        """Number of images in the store."""
+        raise NotImplementedError
+
+    def ids(self):
+        """List of all image ids in the store."""
+        raise NotImplementedError
+
+    @property
+    def dim(self):
+        """Embedding width (0 while the store is empty)."""
+        raise NotImplementedError
+
+    def upsert(self, ids, embeddings, metadatas):
+        """Insert or replace images."""
+        raise NotImplementedError
+
+    def delete(self, ids):
+        """Remove images by id (unknown ids are ignored)."""
+        raise NotImplementedError
+
+    def get(self, ids):
+        """Return {"ids", "embeddings" (float32 array), "metadatas"} for the ids that exist, in request order."""
+        raise NotImplementedError
+
+    def query(self, query_embeddings, k, nprobe=None, ef_search=None, ids=None):
+        """
+        Return, for each query embedding, up to k hits sorted best first.
+        Each hit is {"id": str, "score": float, "metadata": dict}.
+        nprobe / ef_search tune an approximate index per query; stores without one ignore them.
+        ids, if given, restricts the search to those images (a metadata pre-filter).
+        """
+        raise NotImplementedError
+
+    def iter_batches(self, batch_size=10000):
+        """Yield (ids, embeddings, metadatas) over the whole store, e.g. to export or evaluate."""
+        raise NotImplementedError
+
+    def clear(self):
+        """Remove every image from the store."""
+        raise NotImplementedError
+
+
+class ChromaVectorStore(VectorStore):
+    """Vector store backed by a persistent ChromaDB collection (cosine space)."""
+
+    name = "chroma"
+
+    def __init__(self, path=CHROMA_DB_PATH, collection_name=COLLECTION_NAME, create=False):
+        import chromadb
+        self.client = chromadb.PersistentClient(path=path)
+        self.collection_name = collection_name
+        self._dim = 0
+        if create:
+            self.collection = self.client.get_or_create_collection(name=collection_name, metadata=COLLECTION_METADATA)
+        else:
+            self.collection = self.client.get_collection(name=collection_name)
+
+    def count(self):
+        return self.collection.count()
+
+    def ids(self):
+        ids = []
+        for batch_ids, _, _ in self.iter_batches(include_embeddings=False):
+            ids.extend(batch_ids)
+        return ids
+
+    @property
+    def dim(self):
+        if not self._dim:
+            found = self.collection.get(limit=1, include=['embeddings'])
+            if len(found['ids']):
+                self._dim = len(found['embeddings'][0])
+        return self._dim
+
+    def upsert(self, ids, embeddings, metadatas):
+        self.collection.upsert(
+            embeddings=normalize(embeddings).tolist(),
+            metadatas=metadatas,
+            ids=[str(i) for i in ids]
+        )
+
+    def delete(self, ids):
+        if len(ids):
+            self.collection.delete(ids=[str(i) for i in ids])
+
+    def get(self, ids):
+        ids = [str(i) for i in ids]
+        found = self.collection.get(ids=ids, include=['embeddings', 'metadatas'])
+        by_id = {row_id: (embedding, meta) for row_id, embedding, meta
+                 in zip(found['ids'], found['embeddings'], found['metadatas'])}
+        ordered = [i for i in ids if i in by_id]
+        embeddings = (np.array([by_id[i][0] for i in ordered], dtype=np.float32).reshape(len(ordered), -1) if ordered
+                      else np.empty((0, self.dim), dtype=np.float32))
+        return {"ids": ordered, "embeddings": embeddings, "metadatas": [by_id[i][1] for i in ordered]}
+
+    def query(self, query_embeddings, k, nprobe=None, ef_search=None, ids=None):
+        queries = normalize(query_embeddings)
+        if ids is not None and not len(ids):
+            return [[] for _ in range(len(queries))]
+        if ids is None or len(ids) <= CHROMA_FILTER_CHUNK:
+            return self._query(queries, k, ids)
+        # SQLite caps the variables of one statement: search a large selection in chunks
+        # and merge the per-chunk top-k lists (scores are cosine similarities in every chunk)
+        ids = [str(i) for i in ids]
+        parts = [self._query(queries, k, ids[start:start + CHROMA_FILTER_CHUNK])
+                 for start in range(0, len(ids), CHROMA_FILTER_CHUNK)]
+        return [heapq.nlargest(k, chain.from_iterable(hits[i] for hits in parts), key=lambda hit: hit['score'])
+                for i in range(len(queries))]
+
+    def _query(self, queries, k, ids=None):
+        # ChromaDB fixes hnsw:search_ef when the collection is created (see COLLECTION_METADATA)
+        results = self.collection.query(
+            query_embeddings=queries.tolist(),
+            n_results=k,
+            where={"image_id": {"$in": [str(i) for i in ids]}} if ids is not None else None,
+            include=['metadatas', 'distances']
+        )
+        hits = []
+        for ids, metadatas, distances in zip(results['ids'], results['metadatas'], results['distances']):
+            # Cosine space: distance = 1 - cosine similarity
+            hits.append([{"id": row_id, "score": 1.0 - distance, "metadata": meta}
+                         for row_id, meta, distance in zip(ids, metadatas, distances)])
+        return hits
+
+    def refresh(self):
+        """Nothing to reload: ChromaDB reads the persisted collection on every call (called for shards)."""
+
+    def iter_batches(self, batch_size=10000, include_embeddings=True):
+        include = ['embeddings', 'metadatas'] if include_embeddings else ['metadatas']
+        offset = 0
+        while True:
+            page = self.collection.get(include=include, limit=batch_size, offset=offset)
+            if not page['ids']:
+                return
+            embeddings = np.array(page['embeddings'], dtype=np.float32) if include_embeddings else None
+            yield page['ids'], embeddings, page['metadatas']
+            offset += len(page['ids'])
+
+    def clear(self):
+        self.client.delete_collection(name=self.collection_name)
+        self.collection = self.client.get_or_create_collection(name=self.collection_name, metadata=COLLECTION_METADATA)
+
+
+# --- Memory-mapped NumPy store ---
+_NPY_HEADER_SIZE = 128  # Fixed .npy header so the row count can be rewritten in place after appends
+
+
+def _write_npy_header(f, dtype, rows, dim):
+    """Write a version 1.0 .npy header padded to a fixed size at the start of `f`."""
+    header = repr({'descr': np.dtype(dtype).str, 'fortran_order': False, 'shape': (rows, dim)})
+    preamble = b"\x93NUMPY\x01\x00"
+    padding = _NPY_HEADER_SIZE - len(preamble) - 2 - len(header) - 1
+    header = (header + " " * padding + "\n").encode("latin1")
+    f.seek(0)
+    f.write(preamble + len(header).to_bytes(2, "little") + header)
+
+
+def _write_npy_rows(path, rows, start):
+    """Write 2-D `rows` at row `start` of an appendable .npy file, then update its row count."""
+    rows = np.ascontiguousarray(rows)
+    mode = 'r+b' if os.path.exists(path) and start > 0 else 'w+b'
+    with open(path, mode) as f:
+        if mode == 'w+b':
+            _write_npy_header(f, rows.dtype, 0, rows.shape[1])
+        f.seek(_NPY_HEADER_SIZE + start * rows.shape[1] * rows.dtype.itemsize)
+        f.write(rows.tobytes())
+        f.truncate()
+        f.flush()
+        os.fsync(f.fileno())
+        _write_npy_header(f, rows.dtype, start + len(rows), rows.shape[1])
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class NumpyVectorStore(VectorStore):
+    """
+    Exact-search store kept in a directory:
+      vectors.npy      L2-normalized embeddings (float32 or float16), append-only
+      metadata.jsonl   one {"id", "metadata"} line per vector row
+      tombstones.txt   row numbers superseded by an upsert or removed by a delete
+      codes.npy        optional compressed codes, one row per vector (see quantization.py)
+      codec.npz        parameters of the codec that produced codes.npy
+      ann.json, ivf.npz / hnsw.bin   optional approximate index (see ann.py)
+    Rows are only ever appended, so readers can memory-map the matrix while a writer
+    adds images; call refresh() to pick up rows written by another process.
+
+    With codes present, queries scan the codes and re-rank the best k * RERANK_FACTOR
+    candidates against the full-precision vectors, so only the codes need to stay in RAM.
+    With an ANN index present, only its candidate rows (plus rows appended after it was
+    built) are scored.
+    """
+
+    name = "numpy"
+
+    def __init__(self, directory=NUMPY_INDEX_DIR, dtype=NUMPY_INDEX_DTYPE, create=False, block_rows=65536):
+        self.directory = directory
+        self.vectors_path = os.path.join(directory, "vectors.npy")
+        self.metadata_path = os.path.join(directory, "metadata.jsonl")
+        self.tombstones_path = os.path.join(directory, "tombstones.txt")
+        self.codes_path = os.path.join(directory, "codes.npy")
+        self.codec_path = os.path.join(directory, "codec.npz")
+        self.dtype = np.dtype(dtype)
+        self.block_rows = block_rows
+        self._lock = threading.Lock()
+        if not os.path.exists(self.metadata_path):
+            if not create:
+                raise FileNotFoundError(f"No NumPy index found in {directory}")
+            os.makedirs(directory, exist_ok=True)
+            open(self.metadata_path, 'a').close()
+        self.refresh()
+
+    # --- Loading ---
+    def refresh(self):
+        """(Re)load ids, metadata and the memory-mapped matrix from disk."""
+        with self._lock:
+            row_ids, metadatas = [], []
+            with open(self.metadata_path, 'r') as f:
+                for line in f:
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # Torn last line from an interrupted writer
+                    row_ids.append(row['id'])
+                    metadatas.append(row['metadata'])
+
+            matrix = None
+            if os.path.exists(self.vectors_path):
+                matrix = np.load(self.vectors_path, mmap_mode='r')
+                self.dtype = matrix.dtype
+            rows = min(len(row_ids), 0 if matrix is None else matrix.shape[0])
+            row_ids, metadatas = row_ids[:rows], metadatas[:rows]
+
+            live = np.ones(rows, dtype=bool)
+            if os.path.exists(self.tombstones_path):
+                with open(self.tombstones_path, 'r') as f:
+                    dead = [int(line) for line in f if line.strip()]
+                dead = [row for row in dead if row < rows]
+                live[dead] = False
+
+            self._row_ids = row_ids
+            self._metadatas = metadatas
+            self._matrix = matrix[:rows] if matrix is not None else None
+            self._live = live
+            self._row_of = {row_ids[row]: row for row in np.flatnonzero(live)}
+            self._load_codes()
+            self._load_ann()
+
+    def _load_ann(self):
+        from ann import load_ann
+        self.ann = load_ann(self.directory)
+
+    def _load_codes(self):
+        """Open codes.npy if it covers every vector row; otherwise queries stay exact."""
+        from quantization import QuantizedIndex, load_codec
+        self.codec = load_codec(self.codec_path) if os.path.exists(self.codec_path) else None
+        self._quantized = None
+        if self.codec is None or not os.path.exists(self.codes_path) or self._matrix is None:
+            return
+        codes = np.load(self.codes_path, mmap_mode='r')
+        if codes.shape[0] >= self._matrix.shape[0]:
+            self._quantized = QuantizedIndex(self.codec, codes[:self._matrix.shape[0]], self._matrix,
+                                             block_rows=self.block_rows)
+
+    # --- Interface ---
+    def count(self):
+        return len(self._row_of)
+
+    def ids(self):
+        return list(self._row_of)
+
+    def upsert(self, ids, embeddings, metadatas):
+        ids = [str(i) for i in ids]
+        embeddings = normalize(embeddings).astype(self.dtype)
+        with self._lock:
+            start = len(self._row_ids)
+            superseded = [self._row_of[i] for i in ids if i in self._row_of]
+
+            # 1. Append vector rows (and their codes), then bump the row counts in the headers
+            _write_npy_rows(self.vectors_path, embeddings, start)
+            if self._quantized is not None:
+                _write_npy_rows(self.codes_path, self.codec.encode(embeddings), start)
+
+            # 2. Metadata lines make the rows visible to readers
+            with open(self.metadata_path, 'a') as f:
+                for row_id, meta in zip(ids, metadatas):
+                    f.write(json.dumps({"id": row_id, "metadata": meta}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+            # 3. Hide the rows that were replaced
+            self._append_tombstones(superseded)
+
+            # Update the in-memory view without re-reading the whole metadata file
+            self._row_ids.extend(ids)
+            self._metadatas.extend(metadatas)
+            self._live = np.concatenate([self._live, np.ones(len(ids), dtype=bool)])
+            self._live[superseded] = False
+            self._row_of.update((row_id, start + offset) for offset, row_id in enumerate(ids))
+            self._matrix = np.load(self.vectors_path, mmap_mode='r')
+            self._load_codes()
+
+    def delete(self, ids):
+        with self._lock:
+            rows = [self._row_of.pop(str(i)) for i in ids if str(i) in self._row_of]
+            self._append_tombstones(rows)
+            self._live[rows] = False
+
+    def _append_tombstones(self, rows):
+        if not rows:
+            return
+        with open(self.tombstones_path, 'a') as f:
+            f.write("".join(f"{row}\n" for row in rows))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @property
+    def dim(self):
+        return self._matrix.shape[1] if self._matrix is not None else 0
+
+    def get(self, ids):
+        rows = [self._row_of[str(i)] for i in ids if str(i) in self._row_of]
+        embeddings = (np.asarray(self._matrix[rows], dtype=np.float32) if rows
+                      else np.empty((0, self.dim), dtype=np.float32))
+        return {
+            "ids": [self._row_ids[row] for row in rows],
+            "embeddings": embeddings,
+            "metadatas": [self._metadatas[row] for row in rows],
+        }
+
+    def query(self, query_embeddings, k, nprobe=None, ef_search=None, ids=None):
+        queries = normalize(query_embeddings)
+        if self._matrix is None or not len(self._row_of):
+            return [[] for _ in range(len(queries))]
+
+        if ids is not None:
+            best_scores, best_rows = self._filtered_search(queries, k, ids)
+        elif self.ann is not None:
+            best_scores, best_rows = self._ann_search(queries, k, nprobe, ef_search)
+        elif self._quantized is not None:
+            best_scores, best_rows = self._quantized.search(queries, k, self._live)
+        else:
+            # Blocked brute-force scan keeps the score buffer small on large matrices
+            best_scores, best_rows = scan_top_k(
+                lambda start, end: queries @ np.asarray(self._matrix[start:end], dtype=np.float32).T,
+                self._matrix.shape[0], k, self._live, self.block_rows
+            )
+
+        hits = []
+        for scores, rows in zip(best_scores, best_rows):
+            hits.append([{"id": self._row_ids[row], "score": float(score), "metadata": self._metadatas[row]}
+                         for score, row in zip(scores, rows) if np.isfinite(score)])
+        return hits
+
+    def _filtered_search(self, queries, k, ids):
+        """
+        Exact search restricted to `ids`. Small selections score only their own rows;
+        larger ones scan everything with the other rows masked out. The ANN index is
+        skipped because its candidate lists would be cut down by the filter.
+        """
+        rows = np.array(sorted(self._row_of[str(i)] for i in ids if str(i) in self._row_of), dtype=np.int64)
+        if not len(rows):
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        if len(rows) <= self.block_rows:
+            scores = queries @ np.asarray(self._matrix[rows], dtype=np.float32).T
+            keep = top_k(scores, k)
+            return np.take_along_axis(scores, keep, axis=1), rows[keep]
+        mask = np.zeros(len(self._live), dtype=bool)
+        mask[rows] = True
+        if self._quantized is not None:
+            return self._quantized.search(queries, k, mask)
+        return scan_top_k(
+            lambda start, end: queries @ np.asarray(self._matrix[start:end], dtype=np.float32).T,
+            self._matrix.shape[0], k, mask, self.block_rows
+        )
+
+    def _ann_search(self, queries, k, nprobe, ef_search):
+        """Score only the ANN candidates plus the rows appended after the index was built."""
+        tail = np.arange(min(self.ann.built_rows, len(self._live)), len(self._live))
+        best_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), k), dtype=np.int64)
+        for i, rows in enumerate(self.ann.candidates(queries, k, nprobe=nprobe, ef_search=ef_search)):
+            rows = np.unique(np.concatenate([rows, tail]))
+            rows = rows[self._live[rows]]
+            if not len(rows):
+                continue
+            if self._quantized is not None:
+                scores, rows = self._quantized.rank_candidates(queries[i], rows, k)
+            else:
+                scores = gather_scores(self._matrix, queries[i], rows)
+                keep = top_k(scores[None, :], k)[0]
+                scores, rows = scores[keep], rows[keep]
+            best_scores[i, :len(rows)] = scores
+            best_rows[i, :len(rows)] = rows
+        return best_scores, best_rows
+
+    def build_ann(self, kind, **params):
+        """Build an "ivf" or "hnsw" index over the live rows; "none" removes it."""
+        from ann import ANN_INDEXES, save_ann, remove_ann
+        with self._lock:
+            remove_ann(self.directory)
+            if kind != "none" and self._matrix is not None and len(self._row_of):
+                save_ann(ANN_INDEXES[kind].build(self._matrix, self._live, **params), self.directory)
+            self._load_ann()
+
+    def iter_batches(self, batch_size=10000):
+        live_rows = np.flatnonzero(self._live)
+        for start in range(0, len(live_rows), batch_size):
+            rows = live_rows[start:start + batch_size]
+            yield ([self._row_ids[row] for row in rows],
+                   np.asarray(self._matrix[rows], dtype=np.float32),
+                   [self._metadatas[row] for row in rows])
+
+    def quantize(self, mode, train_size=QUANTIZATION_TRAIN_SIZE):
+        """
+        Fit a codec ("fp16", "int8" or "pq") on the stored vectors and write codes for
+        every row; "none" removes the codes. Rows added later are encoded with the same codec.
+        """
+        from quantization import make_codec, save_codec
+        with self._lock:
+            for path in (self.codes_path, self.codec_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            if mode != "none" and self._matrix is not None and len(self._row_of):
+                live_rows = np.flatnonzero(self._live)
+                sample = np.random.default_rng(0).choice(live_rows, size=min(train_size, len(live_rows)), replace=False)
+                codec = make_codec(mode).fit(np.asarray(self._matrix[np.sort(sample)], dtype=np.float32))
+                for start in range(0, self._matrix.shape[0], self.block_rows):
+                    block = np.asarray(self._matrix[start:start + self.block_rows], dtype=np.float32)
+                    _write_npy_rows(self.codes_path, codec.encode(block), start)
+                save_codec(codec, self.codec_path)
+            self._load_codes()
+
+    def clear(self):
+        from ann import remove_ann
+        with self._lock:
+            for path in (self.vectors_path, self.tombstones_path, self.codes_path, self.codec_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            remove_ann(self.directory)
+            open(self.metadata_path, 'w').close()
+        self.refresh()
+
+
+def open_vector_store(backend=VECTOR_STORE, create=False):
+    """Open the configured vector store ("chroma" or "numpy"), sharded if NUM_SHARDS or SHARD_ADDRESSES say so."""
+    if NUM_SHARDS > 1 or SHARD_ADDRESSES:
+        from shards import open_sharded_store
+        return open_sharded_store(backend, create=create)
+    if backend == "chroma":
+        return ChromaVectorStore(create=create)
+    if backend == "numpy":
+        return NumpyVectorStore(create=create)
+    raise ValueError(f"Unknown vector store backend: {backend}")
+
+
+def copy_store(source, target, batch_size=10000):
+    """Copy every image from one store into another (e.g. ChromaDB -> NumPy)."""
+    copied = 0
+    for ids, embeddings, metadatas in source.iter_batches(batch_size):
+        target.upsert(ids, embeddings, metadatas)
+        copied += len(ids)
+        print(f"Copied {copied}/{source.count()} images...")
+    return copied